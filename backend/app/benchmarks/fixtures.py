@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import json
+import random
+import time as timer
+import zlib
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta, time
+from pathlib import Path
+from util.market_calendar import market_today
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures"
+
+WORDS = ("market stock price earnings growth revenue launch product chip ai cloud phone "
+         "regulation lawsuit layoffs record profit loss guidance ceo deal merger users privacy "
+         "great terrible love hate bullish bearish buy sell hold crash rally best worst").split()
+
+
+### Stand-ins for the asyncpraw objects read by services.reddit
+class FakeComment:
+    def __init__(self, body: str, score: int):
+        self.body = body
+        self.score = score
+
+
+class FakeComments(list):
+    async def replace_more(self, limit=None):
+        return []
+
+
+class FakeSubmission:
+    def __init__(self, post: dict, latency: float = 0):
+        self.id = post["id"]
+        self.title = post["title"]
+        self.url = post["url"]
+        self.permalink = post.get("permalink", f"/r/{post['subreddit']}/comments/{post['id']}/")
+        self.subreddit = post["subreddit"]
+        self.created_utc = post["created_utc"]
+        self.score = post["score"]
+        self.upvote_ratio = post["upvote_ratio"]
+        self.num_comments = post["num_comments"]
+        self.crosspost_parent = post.get("crosspost_parent")
+        self.comments = FakeComments()
+        self.comment_sort = None
+        self.comment_limit = None
+        self._comments = post["comments"]
+        self._latency = latency
+
+    async def load(self):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        limit = self.comment_limit or len(self._comments)
+        self.comments = FakeComments(FakeComment(body, score) for body, score in self._comments[:limit])
+
+
+class FakeSubreddit:
+    def __init__(self, name: str, posts: list, latency: float = 0):
+        self.display_name = name
+        self.posts = posts
+        self.latency = latency
+
+    # Recorded posts whose title matches the query, best scored first like sort="top"
+    async def search(self, query: str, time_filter: str = "all", sort: str = "top", limit: int = 100):
+        term = query.split(":", 1)[-1].lower()
+        matches = [post for post in self.posts if term in post["title"].lower()] or self.posts
+        for post in sorted(matches, key=lambda p: -p["score"])[:limit]:
+            yield FakeSubmission(post, self.latency)
+
+
+class FakeReddit:
+    def __init__(self, posts: list, latency: float = 0):
+        self.posts = posts
+        self.latency = latency
+
+    async def subreddit(self, name: str):
+        posts = [post for post in self.posts if post["subreddit"].lower() == name.lower()]
+        return FakeSubreddit(name, posts, self.latency)
+
+
+### Stand-in for yfinance.download, bars are built from recorded (or synthetic) daily returns
+class FakeYFinance:
+    def __init__(self, returns: dict, latency: float = 0):
+        self.returns = returns
+        self.latency = latency
+        self.calls = 0
+
+    def bars(self, ticker: str, dates: pd.DatetimeIndex) -> pd.DataFrame:
+        # Anchor the path at a fixed date so any window of the same ticker is consistent
+        anchor = pd.Timestamp("2000-01-03")
+        offsets = np.busday_count(anchor.date(), dates.values.astype("datetime64[D]"))
+        returns = self.returns.get(ticker) or self.returns["default"]
+        daily = np.asarray(returns)[offsets % len(returns)]
+
+        # Cumulative path over the cycle so prices stay in a sane range for any window length
+        cycle = np.cumsum(np.asarray(returns))
+        close = 100 * np.exp(cycle[offsets % len(returns)])
+        return pd.DataFrame({
+            "Close": close,
+            "High": close * (1 + np.abs(daily) / 2),
+            "Low": close * (1 - np.abs(daily) / 2),
+            "Open": close / (1 + daily),
+            "Volume": np.full(len(dates), 1_000_000.0),
+        }, index=dates)
+
+    def download(self, tickers, start=None, end=None, interval="1d", **kwargs) -> pd.DataFrame:
+        self.calls += 1
+        if self.latency:
+            timer.sleep(self.latency)
+
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        dates = pd.bdate_range(start=start, end=end, inclusive="left", name="Date")
+        if len(dates) == 0:
+            return pd.DataFrame()
+
+        frames = {ticker: self.bars(ticker, dates) for ticker in tickers}
+        data = pd.concat(frames, axis=1).swaplevel(0, 1, axis=1).sort_index(axis=1)
+        data.columns.names = ["Price", "Ticker"]
+        return data
+
+
+### Replayable stand-in for services.live_stream.LiveFeed
+class ReplayFeed:
+    '''
+        Bars and submissions before `start` make up the history, the rest is replayed in time order
+        `speed` times faster than it happened (gaps capped at max_gap_seconds).
+    '''
+    def __init__(self, bars: dict, posts: list, interval: str, start: datetime, speed: float = 60,
+                 max_gap_seconds: float = 2, latency: float = 0):
+        self.bars = bars
+        self.posts = posts
+        self.interval = interval
+        self.start = start
+        self.speed = speed
+        self.max_gap_seconds = max_gap_seconds
+        self.latency = latency
+
+    # Tickers without their own recorded returns replay the default series
+    def series(self, symbol: str) -> pd.DataFrame:
+        return self.bars.get(symbol, self.bars["default"])
+
+    async def history(self, symbols: list, start_date: datetime, end_date: datetime) -> dict:
+        return {symbol: self.series(symbol)[(self.series(symbol)["Date"] >= start_date) &
+                                            (self.series(symbol)["Date"] < self.start)].reset_index(drop=True)
+                for symbol in symbols}
+
+    async def run(self, symbols: list, queue: asyncio.Queue, since: dict):
+        events = [(row.Date, ("bar", symbol, row.Date, row.Close))
+                  for symbol in symbols
+                  for row in self.series(symbol).itertuples() if row.Date >= self.start]
+        events += [(pd.Timestamp(datetime.fromtimestamp(post["created_utc"])), ("submission", FakeSubmission(post, self.latency)))
+                   for post in self.posts if datetime.fromtimestamp(post["created_utc"]) >= self.start]
+        events.sort(key=lambda e: e[0])
+
+        previous = None
+        for at, event in events:
+            if previous is not None and at > previous:
+                await asyncio.sleep(min((at - previous).total_seconds() / self.speed, self.max_gap_seconds))
+            previous = at
+            await queue.put(event)
+
+
+### Intraday bars during market hours (9:30 - 16:00) from daily returns, one random walk per symbol
+def intraday_bars(returns: dict, symbols: list, start: datetime, end: datetime, interval: str = "1h", seed: int = 42) -> dict:
+    freq = interval.replace("m", "min") if interval.endswith("m") else interval
+    days = pd.bdate_range(start=start.date(), end=end.date())
+    dates = pd.DatetimeIndex(np.concatenate([
+        pd.date_range(day + pd.Timedelta(hours=9, minutes=30), day + pd.Timedelta(hours=16), freq=freq, inclusive="left")
+        for day in days
+    ]))
+    dates = dates[(dates >= start) & (dates < end)]
+    bars_per_day = max(1, int(pd.Timedelta(hours=6.5) / pd.Timedelta(freq)))
+
+    bars = {}
+    for symbol in symbols:
+        daily = np.asarray(returns.get(symbol) or returns["default"])
+        rng = np.random.default_rng(seed + zlib.crc32(symbol.encode()))
+        steps = rng.choice(daily, size=len(dates)) / np.sqrt(bars_per_day)
+        bars[symbol] = pd.DataFrame({"Date": dates, "Close": 100 * np.exp(np.cumsum(steps))})
+    return bars
+
+
+### Replay feed of the last `days` days, history for the rolling windows reaches `lookback_days` further back
+def replay_feed(query: str, subreddit: str = "technology", interval: str = "1h", days: int = 1,
+                lookback_days: int = 90, speed: float = 60, fixtures: Path = None, seed: int = 42) -> ReplayFeed:
+    from services.yahoo import FEAR_GREED_TICKERS
+
+    end = datetime.now()
+    start = datetime.combine(end.date(), time.min) - timedelta(days=days)
+    if fixtures and (Path(fixtures) / "posts.json").exists():
+        data = load_fixtures(fixtures, days + 1)
+    else:
+        data = synthetic_fixtures(days + 1, subreddit, query, posts_per_day=24, seed=seed)
+
+    symbols = list(dict.fromkeys(list(data["returns"]) + FEAR_GREED_TICKERS))
+    bars = intraday_bars(data["returns"], symbols, start - timedelta(days=lookback_days), end, interval, seed)
+    return ReplayFeed(bars, data["posts"], interval, start, speed)
+
+
+### Fixtures generated from a seed, used when nothing was recorded
+def synthetic_fixtures(days: int, subreddit: str, query: str, posts_per_day: float = 1.0,
+                       comments_per_post: int = 10, seed: int = 42) -> dict:
+    rng = random.Random(seed)
+    end = market_today()
+
+    def sentence(n_words: int) -> str:
+        return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+    posts = []
+    for i in range(max(1, int(days * posts_per_day))):
+        created = end - timedelta(days=rng.uniform(0, days))
+        n_comments = rng.randint(0, comments_per_post)
+        posts.append({
+            "id": f"p{i}",
+            "subreddit": subreddit,
+            "title": f"{query} {sentence(rng.randint(4, 16))}",
+            "url": f"https://example.com/{i}",
+            "created_utc": created.timestamp(),
+            "score": rng.randint(1, 50000),
+            "upvote_ratio": rng.uniform(0.5, 1.0),
+            "num_comments": rng.randint(n_comments, 5000),
+            # Comment lengths are long tailed like real threads
+            "comments": [(sentence(min(int(rng.paretovariate(1.2) * 8), 400)), rng.randint(1, 5000))
+                         for _ in range(n_comments)],
+        })
+
+    np_rng = np.random.default_rng(seed)
+    returns = {"default": list(np_rng.normal(0.0003, 0.012, 2520))}
+    return {"posts": posts, "returns": returns}
+
+
+### Recorded fixtures re-dated onto the last `days` days, so any scale can be played back
+def load_fixtures(path: Path, days: int) -> dict:
+    path = Path(path)
+    with open(path / "posts.json") as f:
+        recorded = json.load(f)
+    with open(path / "returns.json") as f:
+        returns = json.load(f)
+
+    end = market_today().timestamp()
+    newest = max(post["created_utc"] for post in recorded)
+    span = days * 86400
+
+    # Tile the recorded posts back in time over the window, the newest recording lands on today
+    recorded_span = max(newest - min(post["created_utc"] for post in recorded), 86400)
+    posts = []
+    for copy in range(int(np.ceil(span / recorded_span))):
+        for post in recorded:
+            created = end - (newest - post["created_utc"]) - copy * recorded_span
+            if created >= end - span:
+                # Tiled copies are tagged so they don't collapse into the original as duplicates
+                tag = f" ({copy})" if copy else ""
+                posts.append({**post, "id": f"{post['id']}_{copy}", "created_utc": created,
+                              "title": post["title"] + tag, "url": post["url"] + (f"#{copy}" if copy else "")})
+
+    return {"posts": posts, "returns": returns}
+
+
+### Record live Reddit posts and Yahoo returns for later playback
+async def record_fixtures(path: Path, subreddit: str, query: str, time_filter: str, tickers: list, limit: int = 250):
+    from services.reddit import get_reddit
+    from services.yahoo import download_stock_data, FEAR_GREED_TICKERS
+    reddit = get_reddit()
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    posts = []
+    source = await reddit.subreddit(subreddit)
+    async for submission in source.search(f'title:{query}', time_filter=time_filter, sort="top", limit=limit):
+        submission.comment_sort = "top"
+        submission.comment_limit = 10
+        await submission.load()
+        await submission.comments.replace_more(limit=0)
+        posts.append({
+            "id": submission.id,
+            "subreddit": subreddit,
+            "title": submission.title,
+            "url": submission.url,
+            "created_utc": submission.created_utc,
+            "score": submission.score,
+            "upvote_ratio": submission.upvote_ratio,
+            "num_comments": submission.num_comments,
+            "crosspost_parent": getattr(submission, "crosspost_parent", None),
+            "comments": [(comment.body, comment.score) for comment in submission.comments],
+        })
+
+    end = datetime.now()
+    start = end - timedelta(days=3 * 365)
+    bars = await asyncio.to_thread(download_stock_data, list(dict.fromkeys(tickers + FEAR_GREED_TICKERS)),
+                                   start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), "1d")
+    returns = {ticker: list(np.log(data["Close"]).diff().dropna()) for ticker, data in bars.items() if not data.empty}
+    returns["default"] = returns.get("^GSPC") or next(iter(returns.values()))
+
+    with open(path / "posts.json", "w") as f:
+        json.dump(posts, f)
+    with open(path / "returns.json", "w") as f:
+        json.dump(returns, f)
+
+    return len(posts), len(returns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record Reddit / Yahoo fixtures for the offline benchmarks")
+    parser.add_argument("--out", default=str(FIXTURE_DIR / "recorded"))
+    parser.add_argument("--subreddit", default="technology")
+    parser.add_argument("--query", default="Apple")
+    parser.add_argument("--time-filter", default="year")
+    parser.add_argument("--tickers", default="AAPL")
+    parser.add_argument("--limit", type=int, default=250)
+    args = parser.parse_args()
+
+    n_posts, n_tickers = asyncio.run(record_fixtures(args.out, args.subreddit, args.query, args.time_filter,
+                                                     args.tickers.split(","), args.limit))
+    print(f"Recorded {n_posts} posts and {n_tickers} return series to {args.out}")
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import importlib
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+import numpy as np
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import main  # loads every router / service module that gets instrumented
+from benchmarks.fixtures import FIXTURE_DIR, FakeReddit, FakeYFinance, load_fixtures, synthetic_fixtures
+from services.batch_inference import BatchInferenceEngine
+from services.market_table import MARKET_TABLE, MARKET_TABLE_UPDATED
+from services.price_store import price_store
+from services.resource_init import MODELS, predict_sentiment_batch, sentiment_model_id
+from services.sentiment_cache import SentimentCache
+from util.market_calendar import market_today
+
+# Stage name -> (module, function), every module holding the same function object gets the timed version
+STAGES = {
+    "calculate_post_sentiment": ("services.reddit", "calculate_post_sentiment"),
+    "fetch_social_sentiment": ("services.reddit", "fetch_social_sentiment"),
+    "fetch_vix": ("services.yahoo", "fetch_vix"),
+    "fetch_market_momentum": ("services.yahoo", "fetch_market_momentum"),
+    "fetch_safe_haven_demand": ("services.yahoo", "fetch_safe_haven_demand"),
+    "fetch_yield_spread": ("services.yahoo", "fetch_yield_spread"),
+    "calculate_rolling_correlations": ("util.util", "calculate_rolling_correlations"),
+    "calculate_rolling_correlations_many": ("util.util", "calculate_rolling_correlations_many"),
+    "process_sentiment_data": ("util.util", "process_sentiment_data"),
+    "endpoint:stock_price": ("routers.stock_price", "get_stock_data"),
+    "endpoint:market_sentiment": ("routers.market_sentiment", "get_market_sentiment"),
+    "endpoint:social_sentiment": ("routers.social_sentiment", "get_social_sentiment"),
+    "endpoint:analyze_market": ("routers.analyze_market", "analyze_market"),
+    "endpoint:analyze_market_batch": ("routers.analyze_market", "analyze_market_batch"),
+}
+
+APP_PACKAGES = ("services.", "util.", "routers.")
+
+
+### Replace a module attribute everywhere it was imported
+def patch_everywhere(original, replacement):
+    for name, module in list(sys.modules.items()):
+        if module is None or not (name == "main" or name.startswith(APP_PACKAGES)):
+            continue
+        for attr, value in list(vars(module).items()):
+            if value is original:
+                setattr(module, attr, replacement)
+
+
+### Per-stage call timings
+class Recorder:
+    def __init__(self):
+        self.calls = {}
+
+    def reset(self):
+        self.calls = {}
+
+    def wrap(self, stage: str, func):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.calls.setdefault(stage, []).append((start, time.perf_counter()))
+
+        timed.__wrapped__ = func
+        if hasattr(func, "cache_clear"):
+            timed.cache_clear = func.cache_clear
+        return timed
+
+    def instrument(self):
+        for stage, (module_name, attr) in STAGES.items():
+            original = getattr(importlib.import_module(module_name), attr)
+            patch_everywhere(original, self.wrap(stage, original))
+
+    def summary(self) -> dict:
+        stages = {}
+        for stage, calls in self.calls.items():
+            durations = np.array([end - start for start, end in calls]) * 1000
+            # Calls of a stage overlap, throughput is measured over the stage's busy span
+            span = max(end for _, end in calls) - min(start for start, _ in calls)
+            stages[stage] = {
+                "calls": len(calls),
+                "p50_ms": float(np.percentile(durations, 50)),
+                "p99_ms": float(np.percentile(durations, 99)),
+                "mean_ms": float(durations.mean()),
+                "throughput_per_s": len(calls) / span if span > 0 else float("inf"),
+            }
+        return stages
+
+
+### Deterministic stand-in for the ONNX model, cost_ms emulates a forward pass
+def fake_predict_batch(cost_ms: float):
+    def predict_batch(texts: list) -> list:
+        if cost_ms:
+            time.sleep(cost_ms * len(texts) / 1000)
+        rows = []
+        for text in texts:
+            positive = (zlib.crc32(text.encode()) % 1000) / 1000
+            rows.append(np.array([1 - positive, positive], dtype=np.float32))
+        return rows
+
+    return predict_batch
+
+
+async def install_model(args, cache_dir: Path):
+    if args.model == "onnx":
+        from services.resource_init import load_sentiment_model
+        model, tokenizer = load_sentiment_model()
+        predict_batch = lambda texts: predict_sentiment_batch(model, tokenizer, texts)
+        model_id = sentiment_model_id()
+    else:
+        predict_batch = fake_predict_batch(args.fake_model_ms)
+        model_id = f"fake:{args.fake_model_ms}"
+
+    engine = BatchInferenceEngine(predict_batch, max_batch_size=args.batch_size, max_wait_ms=args.batch_wait_ms)
+    await engine.start()
+    MODELS["social_sentiment"] = {"engine": engine, "predict": engine.predict}
+
+    if args.sentiment_cache:
+        cache = SentimentCache(engine.predict, model_id=model_id, path=cache_dir / "sentiment_cache.sqlite")
+        MODELS["social_sentiment"].update({"cache": cache, "predict": cache.predict})
+
+    return engine
+
+
+### Drop everything the previous repeat left behind so every repeat starts cold
+def reset_caches(args, workdir: Path, repeat: int):
+    for module_name, attr in STAGES.values():
+        func = getattr(importlib.import_module(module_name), attr)
+        if hasattr(func, "cache_clear"):
+            func.cache_clear()
+    MARKET_TABLE.clear()
+    MARKET_TABLE_UPDATED.clear()
+    price_store.path = workdir / f"prices_{repeat}"
+
+    cache = MODELS["social_sentiment"].get("cache")
+    if cache is not None:
+        cache.memory.clear()
+        cache.db.execute("DELETE FROM sentiment")
+        cache.db.commit()
+
+
+async def run_repeat(args, companies: list):
+    from routers.analyze_market import analyze_market, analyze_market_batch
+    from models.models import MarketPair
+    from routers.market_sentiment import get_market_sentiment
+    from routers.social_sentiment import get_social_sentiment
+    from routers.stock_price import get_stock_data
+    from fastapi.encoders import jsonable_encoder
+
+    # End to end: every ticker's full analysis at once, like a dashboard burst
+    if args.batch_analyze:
+        results = await analyze_market_batch(pairs=[MarketPair(ticker=ticker, company=company)
+                                                    for ticker, company in companies], time_filter="year")
+    else:
+        results = await asyncio.gather(*(analyze_market(ticker=ticker, company=company, time_filter="year")
+                                         for ticker, company in companies))
+    jsonable_encoder(results)
+
+    # The lighter endpoints, after the analyses so they see the caches those left behind
+    if args.endpoints:
+        results = await asyncio.gather(
+            get_market_sentiment(indicator="fear_greed_score", time_filter="year"),
+            *(get_stock_data(ticker=ticker, time_filter="year") for ticker, _ in companies),
+            *(get_social_sentiment(subreddit=args.subreddit, query=company, time_filter="year")
+              for _, company in companies),
+        )
+        jsonable_encoder(results)
+
+
+async def run_scenario(args, days: int, n_tickers: int, recorder: Recorder, workdir: Path) -> dict:
+    companies = [(f"TCK{i}", f"Company{i}") for i in range(n_tickers)]
+    if args.companies:
+        companies = [tuple(pair.split(":", 1)) for pair in args.companies.split(",")][:n_tickers]
+
+    # Fixtures for the whole window, recorded ones when available
+    if args.fixtures and (Path(args.fixtures) / "posts.json").exists():
+        fixtures = load_fixtures(args.fixtures, days)
+    else:
+        fixtures = {"posts": [], "returns": None}
+        for i, (_, company) in enumerate(companies):
+            generated = synthetic_fixtures(days, args.subreddit, company, args.posts_per_day, seed=args.seed + i)
+            fixtures["posts"] += generated["posts"]
+            fixtures["returns"] = generated["returns"]
+
+    services_reddit = importlib.import_module("services.reddit")
+    services_yahoo = importlib.import_module("services.yahoo")
+    services_reddit.reddit = FakeReddit(fixtures["posts"], latency=args.reddit_latency_ms / 1000)
+    services_yahoo.yf = FakeYFinance(fixtures["returns"], latency=args.yahoo_latency_ms / 1000)
+
+    # Every time filter maps to the scenario window
+    end_date = market_today()
+    start_date = end_date - timedelta(days=days)
+
+    async def convert_time_filter(time_filter: str):
+        return start_date, end_date, "1d"
+
+    util = importlib.import_module("util.util")
+    original_convert_time_filter = util.convert_time_filter
+    patch_everywhere(original_convert_time_filter, convert_time_filter)
+
+    engine = await install_model(args, workdir)
+    wall = []
+    try:
+        for repeat in range(args.repeat):
+            reset_caches(args, workdir, repeat)
+            start = time.perf_counter()
+            await run_repeat(args, companies)
+            wall.append(time.perf_counter() - start)
+
+        stages = recorder.summary()
+
+        # One more cold run under tracemalloc, it slows Python down so it isn't timed
+        peak_mb = None
+        if args.memory:
+            reset_caches(args, workdir, args.repeat)
+            tracemalloc.start()
+            await run_repeat(args, companies)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    finally:
+        await engine.stop()
+        cache = MODELS["social_sentiment"].get("cache")
+        if cache is not None:
+            await cache.close()
+        patch_everywhere(convert_time_filter, original_convert_time_filter)
+
+    wall = np.array(wall) * 1000
+    return {
+        "days": days,
+        "tickers": n_tickers,
+        "posts": len(fixtures["posts"]),
+        "wall_p50_ms": float(np.percentile(wall, 50)),
+        "wall_p99_ms": float(np.percentile(wall, 99)),
+        "analyses_per_s": n_tickers / (np.median(wall) / 1000),
+        "peak_traced_mb": peak_mb,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "provider_calls": services_yahoo.yf.calls,
+        "stages": stages,
+    }
+
+
+def print_scenario(result: dict):
+    print(f"\n=== {result['days']} days x {result['tickers']} tickers ({result['posts']} posts) ===")
+    print(f"wall p50 {result['wall_p50_ms']:.1f} ms  p99 {result['wall_p99_ms']:.1f} ms  "
+          f"{result['analyses_per_s']:.2f} analyses/s  provider calls {result['provider_calls']}")
+    if result["peak_traced_mb"] is not None:
+        print(f"peak traced {result['peak_traced_mb']:.1f} MB  max rss {result['max_rss_mb']:.1f} MB")
+    print(f"{'stage':34} {'calls':>7} {'p50 ms':>10} {'p99 ms':>10} {'calls/s':>10}")
+    for stage, s in result["stages"].items():
+        print(f"{stage:34} {s['calls']:>7} {s['p50_ms']:>10.2f} {s['p99_ms']:>10.2f} {s['throughput_per_s']:>10.1f}")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+async def main_async(args) -> list:
+    recorder = Recorder()
+    recorder.instrument()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for days in [int(d) for d in args.days.split(",")]:
+            for n_tickers in [int(n) for n in args.tickers.split(",")]:
+                recorder.reset()
+                result = await run_scenario(args, days, n_tickers, recorder, Path(tmp))
+                print_scenario(result)
+                results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline MarketPulse pipeline benchmarks (run from backend/app)")
+    parser.add_argument("--days", default="7,30,365", help="Comma separated window sizes in days")
+    parser.add_argument("--tickers", default="1", help="Comma separated numbers of tickers analyzed at once")
+    parser.add_argument("--companies", default=None, help="ticker:company pairs, e.g. AAPL:Apple,MSFT:Microsoft")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--fixtures", default=str(FIXTURE_DIR / "recorded"), help="Recorded fixtures, synthetic if missing")
+    parser.add_argument("--subreddit", default="technology")
+    parser.add_argument("--posts-per-day", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--model", choices=["fake", "onnx"], default="fake")
+    parser.add_argument("--fake-model-ms", type=float, default=0, help="Emulated inference cost per text")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--batch-wait-ms", type=float, default=10)
+    parser.add_argument("--sentiment-cache", action="store_true")
+    parser.add_argument("--reddit-latency-ms", type=float, default=0)
+    parser.add_argument("--yahoo-latency-ms", type=float, default=0)
+    parser.add_argument("--batch-analyze", action="store_true", help="One /analyze-market/batch call for all tickers")
+    parser.add_argument("--no-endpoints", dest="endpoints", action="store_false")
+    parser.add_argument("--no-memory", dest="memory", action="store_false")
+    parser.add_argument("--json", default=None, help="Write the results here to compare commits")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"commit": git_commit(), "created_at": datetime.now().isoformat(),
+                       "args": vars(args), "scenarios": results}, f, indent=2)
@@ -1,25 +1,63 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from motor.core import AgnosticCollection
+from pymongo import ASCENDING, DeleteMany, IndexModel, UpdateOne
+from typing import AsyncIterator
 from decouple import config
 
 class MongoDB:
-    def __init__(self, uri: str, db_name: str):
-        self.client = AsyncIOMotorClient(uri)
+    def __init__(self, uri: str, db_name: str, client=None):
+        # Any Motor compatible client works, e.g. mongomock_motor.AsyncMongoMockClient() in tests
+        self.client = client if client is not None else AsyncIOMotorClient(uri)
         self.db = self.client[db_name]
-    
+
     def get_collection(self, collection_name: str)->AgnosticCollection:
         return self.db[collection_name]
-    
+
     async def find(self, collection: AgnosticCollection, query: dict, limit: int):
         cursor = collection.find(query).limit(limit)
         documents = await  cursor.to_list(length=limit)
         return documents
-    
+
+    async def find_one(self, collection: AgnosticCollection, query: dict, projection: dict = None):
+        return await collection.find_one(query, projection)
+
+    # Documents come in batches of batch_size as the cursor is read, never all at once
+    async def stream(self, collection: AgnosticCollection, query: dict, projection: dict = None,
+                     sort: list = None, batch_size: int = 1000) -> AsyncIterator[dict]:
+        cursor = collection.find(query, projection).batch_size(batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        async for document in cursor:
+            yield document
+
     async def insert_one(self, collection: AgnosticCollection, document):
         result = await collection.insert_one(document)
         return str(result.inserted_id)
-    
+
+    ### Insert or update many documents in one round trip, matched on their `keys` fields
+    async def bulk_upsert(self, collection: AgnosticCollection, documents: list, keys: tuple, prune: dict = None) -> int:
+        '''
+            keys: ("key", "timestamp") -> fields identifying a document, they should have a unique index
+            prune: query of documents to delete in the same batch, e.g. rows of the range that are gone now
+        '''
+        operations = [UpdateOne({k: document[k] for k in keys}, {"$set": document}, upsert=True) for document in documents]
+        if prune is not None:
+            operations.append(DeleteMany(prune))
+        if not operations:
+            return 0
+
+        # Unordered, so the server can apply the batch in parallel
+        result = await collection.bulk_write(operations, ordered=False)
+        return result.upserted_count + result.modified_count
+
+    async def create_indexes(self, collection: AgnosticCollection, indexes: list):
+        '''
+            indexes: [(fields, unique)] e.g. [(("key", "timestamp"), True)] -> compound ascending indexes
+        '''
+        models = [IndexModel([(field, ASCENDING) for field in fields], unique=unique) for fields, unique in indexes]
+        return await collection.create_indexes(models)
+
     async def delete_one(self, collection: AgnosticCollection, query:dict):
         result = await collection.delete_one(query)
         return result.deleted_count
-    
\ No newline at end of file
+
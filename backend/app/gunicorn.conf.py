@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+from decouple import config
+
+# Run from backend/app: gunicorn main:app
+bind = config("BIND", default="0.0.0.0:8000")
+workers = config("WEB_CONCURRENCY", default=multiprocessing.cpu_count(), cast=int)
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# True -> one inference process hosts the model for every worker (one copy in RAM)
+# False -> every worker loads its own copy, the cores are split between their ONNX sessions
+# The workers read the resulting INFERENCE_MODE (remote / local, see services/resource_init.py)
+INFERENCE_SERVER = config("INFERENCE_SERVER", default=True, cast=bool)
+
+# Longest pause before restarting an inference server that keeps exiting
+INFERENCE_RESTART_MAX_SECONDS = config("INFERENCE_RESTART_MAX_SECONDS", default=60, cast=float)
+
+inference_server = None
+stopping = threading.Event()
+
+
+def start_inference_server(env: dict) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", "services.inference_server"], env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+### Restart the inference server whenever it exits, the workers' clients reconnect to the new one
+def supervise_inference_server(server, env: dict):
+    global inference_server
+    started, delay = time.monotonic(), 1
+    while not stopping.wait(1):
+        code = inference_server.poll()
+        if code is None:
+            continue
+        # A server that ran for a while starts over with a short pause, one failing at startup backs off
+        delay = 1 if time.monotonic() - started > INFERENCE_RESTART_MAX_SECONDS else min(delay * 2, INFERENCE_RESTART_MAX_SECONDS)
+        server.log.error("Inference server exited with code %s, restarting in %.0fs", code, delay)
+        if stopping.wait(delay):
+            return
+        inference_server = start_inference_server(env)
+        started = time.monotonic()
+
+
+def on_starting(server):
+    global inference_server
+    cores = multiprocessing.cpu_count()
+
+    if INFERENCE_SERVER:
+        # Set before the workers fork, so they all come up as socket clients
+        os.environ["INFERENCE_MODE"] = "remote"
+        env = {**os.environ, "ONNX_INTRA_OP_THREADS": os.environ.get("ONNX_INTRA_OP_THREADS", str(cores))}
+        inference_server = start_inference_server(env)
+        threading.Thread(target=supervise_inference_server, args=(server, env), daemon=True).start()
+    else:
+        os.environ["INFERENCE_MODE"] = "local"
+        os.environ.setdefault("ONNX_INTRA_OP_THREADS", str(max(1, cores // workers)))
+
+
+def on_exit(server):
+    stopping.set()
+    if inference_server is not None:
+        inference_server.terminate()
+        inference_server.wait(timeout=10)
@@ -1,7 +1,14 @@
-from fastapi import FastAPI
-from routers import market_sentiment, social_sentiment, stock_price, analyze_market
+import time
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response
+from starlette.routing import compile_path
+from decouple import config
+from routers import market_sentiment, social_sentiment, stock_price, analyze_market, analysis_jobs, live_stream
 from fastapi.middleware.cors import CORSMiddleware
-from services.resource_init import lifespan
+from services.resource_init import lifespan, MODEL_STATE
+from util.metrics import metrics, request_timings, server_timing_header
+from util.response_cache import ResponseCache, response_ttl, etag_matches
+from util.response_format import accepted_format
 
 app = FastAPI(lifespan=lifespan)
 
@@ -31,11 +38,111 @@ app.include_router(market_sentiment.router, prefix="/api", tags=["market-sentime
 # Include Marked events router
 app.include_router(analyze_market.router, prefix="/api", tags=["analyze-market"])
 
+# Include background analysis jobs router
+app.include_router(analysis_jobs.router, prefix="/api", tags=["analyze-market"])
+
+# Include live streaming router
+app.include_router(live_stream.router, prefix="/api", tags=["stream"])
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to the MarketPulse!"}
 
 
+# Readiness, 503 until the sentiment model is loaded and warmed up (MODEL_LOAD=background)
+@app.get("/health", include_in_schema=False)
+async def health(response: Response):
+    ready = MODEL_STATE["status"] == "ready"
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else MODEL_STATE["status"], "model": MODEL_STATE}
+
+
+# Prometheus scrape endpoint
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Finished responses of the GET endpoints, route -> parameters normalized like their coalesce keys
+CACHED_ROUTES = {
+    "/api/stock-price/{ticker}": {},
+    "/api/market-sentiment/{indicator}": {},
+    "/api/social-sentiment/{subreddit}": {"query": str.lower},
+    "/api/analyze-market/{company}": {"company": str.lower},
+}
+response_cache = ResponseCache(max_entries=config("RESPONSE_CACHE_SIZE", default=512, cast=int),
+                               redis_url=config("REDIS_URL", default=""))
+INTRADAY_TTL_SECONDS = config("RESPONSE_CACHE_INTRADAY_TTL_SECONDS", default=60, cast=float)
+# Matched against the request path itself, how the router nests included routes changes between FastAPI versions
+CACHED_ROUTE_PATTERNS = {route: compile_path(route)[0] for route in CACHED_ROUTES}
+
+
+# Cached route of a request path and its path parameters, (None, None) for the other paths
+def cached_route(path: str):
+    for route, pattern in CACHED_ROUTE_PATTERNS.items():
+        match = pattern.match(path)
+        if match:
+            return route, match.groupdict()
+    return None, None
+
+
+@app.middleware("http")
+async def cache_responses(request: Request, call_next):
+    if request.method != "GET":
+        return await call_next(request)
+
+    route, path_params = cached_route(request.scope["path"])
+    if route is None:
+        return await call_next(request)
+    # The request counts under its route even when the router never runs
+    request.scope["route_path"] = route
+
+    # Arrow and JSON answers of the same query are different entries
+    params = {**path_params, **request.query_params, "accept": accepted_format(request.headers.get("accept"))}
+    key = response_cache.key(route, params, CACHED_ROUTES[route])
+    entry, result = await response_cache.get(key)
+
+    if entry is None:
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        ttl = response_ttl(request.query_params.get("time_filter", "year"), intraday_ttl=INTRADAY_TTL_SECONDS)
+        entry = await response_cache.set(key, body, response.headers.get("content-type"), ttl)
+
+    headers = {"ETag": entry["etag"], "Cache-Control": f"max-age={max(0, int(entry['expires_at'] - time.time()))}"}
+    # Unchanged dashboards only get the headers back
+    if etag_matches(request.headers.get("if-none-match", ""), entry["etag"]):
+        metrics.inc("response_cache_requests_total", route=route, result="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    metrics.inc("response_cache_requests_total", route=route, result=result)
+    return Response(content=entry["body"], media_type=entry["media_type"], headers=headers)
+
+
+# Per-request stage breakdown, sent back as a Server-Timing header
+SERVER_TIMING = config("SERVER_TIMING", default=True, cast=bool)
+
+@app.middleware("http")
+async def record_request_timings(request: Request, call_next):
+    timings = {}
+    token = request_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+
+    total = time.perf_counter() - start
+    route = request.scope.get("route_path") or getattr(request.scope.get("route"), "path", "unmatched")
+    metrics.observe("http_request_seconds", total, method=request.method, route=route, status=response.status_code)
+
+    if SERVER_TIMING and timings:
+        response.headers["Server-Timing"] = server_timing_header({**timings, "total": total})
+    return response
+
+
 
 # Note to self:
 #   To run the app for FASTAPI: uvicorn main:app --reload
\ No newline at end of file
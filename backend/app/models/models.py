@@ -2,4 +2,8 @@ from pydantic import BaseModel
 
 class User(BaseModel):
     name: str
-    email: str
\ No newline at end of file
+    email: str
+
+class MarketPair(BaseModel):
+    ticker: str
+    company: str
@@ -0,0 +1,47 @@
+from typing import Annotated
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import JSONResponse
+from routers.analyze_market import run_market_analysis
+from services.job_queue import analysis_jobs, QueueFullError
+from util.response_format import render
+
+
+router = APIRouter()
+
+# Highest priority a client can ask for, jobs above the default still can't starve everyone else's
+MAX_JOB_PRIORITY = 3
+
+
+# Queue a market analysis and return right away, poll the job for progress and result
+@router.post("/analyze-market/{company}/jobs", status_code=202)
+async def submit_market_analysis(ticker: str, company: str, time_filter: str = "year",
+                                 priority: Annotated[int, Query(ge=0, le=MAX_JOB_PRIORITY)] = 0):
+    try:
+        job = analysis_jobs.submit(
+            lambda progress: run_market_analysis(ticker=ticker, company=company,
+                                                 time_filter=time_filter, progress=progress),
+            key=("analyze_market", ticker, company.lower(), time_filter),
+            priority=priority,
+            params={"ticker": ticker, "company": company, "time_filter": time_filter},
+        )
+    except QueueFullError as e:
+        return JSONResponse(status_code=429, content={"detail": str(e)}, headers={"Retry-After": "30"})
+
+    return job_status(job)
+
+
+@router.get("/analyze-market/jobs/{job_id}")
+async def get_market_analysis_job(job_id: str):
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or expired")
+
+    return job_status(job)
+
+
+def job_status(job: dict) -> dict:
+    status = {k: v for k, v in job.items() if k != "result"}
+    status["queue_position"] = analysis_jobs.position(job["job_id"])
+    if job["status"] == "done":
+        status["result"] = render(job["result"], fill="")
+    return status
@@ -1,18 +1,74 @@
+import asyncio
 import time
-import matplotlib.pyplot as plt
+from datetime import timedelta
+from typing import Annotated, Callable
 import pandas as pd
 import numpy as np
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import Response
+from decouple import config
+from models.models import MarketPair
 from routers.stock_price import get_stock_data
-from services.reddit import fetch_social_sentiment
+from services.reddit import fetch_social_sentiment, daily_rows
+from services.yahoo import fetch_multiple_stock_data
+from services.market_table import get_market_indicators
 from util.util import convert_time_filter, process_sentiment_data\
-        ,calculate_fear_greed_score,  calculate_rolling_correlations
+        ,calculate_rolling_correlations, calculate_rolling_correlations_many
+from util.coalesce import coalesce
+from util.correlation import lagged_rolling_correlations
+from util.response_format import response_format, accepted_format, render, encode_json
 
 
 router = APIRouter()
 
+BATCH_MAX_TICKERS = config("BATCH_ANALYZE_MAX_TICKERS", default=50, cast=int)
+# Several (e.g. "technology,stocks,investing") are searched together under one post budget
+# and cross-posts between them are only scored once
+ANALYZE_SUBREDDITS = config("ANALYZE_SUBREDDITS", default="technology")
+SWEEP_MAX_LAGS = config("CORRELATION_SWEEP_MAX_LAGS", default=30, cast=int)
+SWEEP_MAX_WINDOWS = config("CORRELATION_SWEEP_MAX_WINDOWS", default=10, cast=int)
+
+# Whole watchlist in one call, market indicators, prices and inference batches are shared
+@router.post("/analyze-market/batch")
+async def analyze_market_batch(pairs: list[MarketPair], time_filter: str = "year",
+                               format: str = None, accept: Annotated[str | None, Header()] = None):
+    format = response_format(format, accept)
+    if not pairs:
+        raise HTTPException(status_code=400, detail="No tickers given")
+    if len(pairs) > BATCH_MAX_TICKERS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_TICKERS} tickers per batch")
+
+    analysis = await run_market_analysis_many(pairs=[(pair.ticker, pair.company) for pair in pairs], time_filter=time_filter)
+    return render(analysis, format, fill="")
+
+# Users opening the same ticker share one analysis
 @router.get("/analyze-market/{company}")
-async def analyze_market(ticker: str, company: str, time_filter: str = "year"):
+@coalesce(ttl=config("COALESCE_TTL_SECONDS", default=10, cast=float), normalize={"company": str.lower, "accept": accepted_format})
+async def analyze_market(ticker: str, company: str, time_filter: str = "year",
+                         format: str = None, accept: Annotated[str | None, Header()] = None):
+    format = response_format(format, accept)
+    analysis = await run_market_analysis(ticker=ticker, company=company, time_filter=time_filter)
+    return render(analysis, format, fill="")
+
+# Lag / window sweep of price against fear / greed score and social sentiment
+@router.get("/analyze-market/{company}/correlations")
+@coalesce(ttl=config("COALESCE_TTL_SECONDS", default=10, cast=float), normalize={"company": str.lower})
+async def market_correlations(ticker: str, company: str, time_filter: str = "year",
+                              lags: str = "0,1,2,3,5", windows: str = "7,14,30"):
+    lags, windows = parse_ints(lags, "lags"), parse_ints(windows, "windows")
+    if len(lags) > SWEEP_MAX_LAGS or len(windows) > SWEEP_MAX_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"At most {SWEEP_MAX_LAGS} lags and {SWEEP_MAX_WINDOWS} windows")
+    if min(windows) < 2:
+        raise HTTPException(status_code=400, detail="Windows need at least 2 rows")
+
+    sweep = await run_correlation_sweep(ticker=ticker, company=company, time_filter=time_filter, lags=lags, windows=windows)
+    return Response(encode_json(sweep), media_type="application/json")
+
+
+### Full analysis pipeline, progress(stage, fraction) is called as the stages complete
+# "market_analyzed" is a DataFrame, render() turns it into the response format
+async def run_market_analysis(ticker: str, company: str, time_filter: str = "year", progress: Callable = None):
+    progress = progress or (lambda stage, fraction: None)
     try:
         # Calculate latency for for total analysis
         start = time.time()
@@ -23,95 +79,186 @@ async def analyze_market(ticker: str, company: str, time_filter: str = "year"):
         stock_data = await get_stock_data(ticker=ticker, 
                         time_filter=time_filter,interval=interval)
         stock_data = pd.DataFrame(stock_data[ticker])
+        progress("stock_price", 0.1)
 
-        # Get fear greed score
-        fear_greed_score = await calculate_fear_greed_score(start_date=start_date, end_date=end_date, interval=interval)
+        # Get fear greed score from the shared market table
+        market_indicators = await get_market_indicators(start_date=start_date, end_date=end_date, interval=interval)
+        fear_greed_score = market_indicators["fear_greed_score"]
+        progress("fear_greed_score", 0.2)
 
         #  Calculate the rolling correlations between fear/greed score and stock price
         rolling_correlations = await calculate_rolling_correlations(stock_data=stock_data, fear_greed_score=fear_greed_score)
-        start_sentiment_date = pd.to_datetime(rolling_correlations['timestamp']).min()
+        progress("rolling_correlations", 0.3)
 
         # Get social sentiment
-        social_data = await fetch_social_sentiment(subreddit="technology", 
+        social_data = await fetch_social_sentiment(subreddit=ANALYZE_SUBREDDITS, 
                         query=company, time_filter=time_filter)
-        
-        extreme_pos_threshold, extreme_neg_threshold, social_data = await process_sentiment_data(start_date=start_sentiment_date, data=social_data)
-
-        '''
-        - positive spike sentiment and positive correlation suggests increase stock and greed (momentum) -> mark event + action: Momentum trade
-        - negative spike sentiment and positive correlation suggests decrease stock and greed (fight or flight)-> mark event + action: Potential exit
-        - else give mixed signal -> actional insights
-        '''
-
-        # Merge based on stock price timestamps
-        merged = pd.merge(
-            rolling_correlations,
-            social_data,
-            on='timestamp',
-            how='left'
-        )
-
-        # Identify signals
-        conditions = [
-            (merged["positive_spike"] & (merged['correlation'] > 0.3)),
-            (merged["negative_spike"] & (merged['correlation'] > 0.3)),
-            ((merged['positive_spike'] | merged['negative_spike']) & (merged['correlation'] <= 0))
-        ]
-        options = ['Momentum trade', 'Potential exit', 'Mixed signal']
-
-        merged['action'] = np.select(
-            conditions,
-            options,
-            default='no signal'
-        )
-
-        # # PLOT FOR DEBUGGING
-        # signals_data = merged[merged['action'] != 'no signal']
-        # fig, ax1 = plt.subplots(figsize=(14, 7))
-        # ax1.plot(
-        #     merged['timestamp'],
-        #     merged['price'],
-        #     label='Stock Price (Trading Days)',
-        #     color='red',
-        #     linestyle='-'
-        # )
-        # ax1.set_ylabel('Stock Price', color='red')
-        # ax1.tick_params(axis='y', labelcolor='red')
-        # ax2 = ax1.twinx()
-        # ax2.plot(
-        #     merged['timestamp'],
-        #     merged['sentiment'],
-        #     label='Sentiment (All Days)',
-        #     color='blue',
-        #     linestyle='--'
-        # )
-        # ax2.set_ylabel('Sentiment', color='blue')
-        # ax2.tick_params(axis='y', labelcolor='blue')
-        # colors = {'Momentum trade': 'green', 'Potential exit': 'orange', 'Mixed signal': 'purple'}
-        # for action, color in colors.items():
-        #     filtered_data = signals_data[signals_data['action'] == action]
-        #     ax2.scatter(
-        #         filtered_data['timestamp'],
-        #         filtered_data['sentiment'],
-        #         label=f'Signal: {action}',
-        #         color=color,
-        #         s=100,
-        #         alpha=0.8
-        #     )
-        # fig.legend(loc='upper left', bbox_to_anchor=(0.1, 0.85), bbox_transform=ax1.transAxes)
-        # plt.title('Stock Price and Sentiment with Signals')
-        # plt.grid()
-        # plt.tight_layout()
-        # plt.show()
-    
-        merged = merged.fillna("")
-        merged = merged.to_dict("records")
+        progress("social_sentiment", 0.9)
+
+        analysis = await build_market_signals(rolling_correlations, social_data, key=(ticker, company.lower(), time_filter))
+
+        latency = time.time() - start
+
+        return {"latency": latency, **analysis}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'An Error occured: {str(e)} from analyze_market()')
+
+
+def parse_ints(values: str, name: str) -> list:
+    try:
+        parsed = [int(value) for value in values.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be comma separated integers")
+    if not parsed:
+        raise HTTPException(status_code=400, detail=f"No {name} given")
+    return parsed
+
+
+### Rolling correlations of price against every signal for all lags and windows in one pass
+async def run_correlation_sweep(ticker: str, company: str, time_filter: str, lags: list, windows: list) -> dict:
+    '''
+        lags: [0, 1, 2] -> lag 1 correlates today's price with yesterday's signal
+        Returns "correlation" as nested lists [lag][window][row][signal], rows follow "timestamp"
+        and are null until a window is full
+    '''
+    try:
+        start = time.time()
+        start_date, end_date, interval = await convert_time_filter(time_filter=time_filter)
+
+        social_task = asyncio.ensure_future(fetch_social_sentiment(subreddit=ANALYZE_SUBREDDITS,
+                            query=company, time_filter=time_filter))
+        try:
+            stock_data = await get_stock_data(ticker=ticker, time_filter=time_filter, interval=interval)
+            stock_data = pd.DataFrame(stock_data[ticker])
+            market_indicators = await get_market_indicators(start_date=start_date, end_date=end_date, interval=interval)
+        except Exception:
+            social_task.cancel()
+            raise
+
+        # Trading days with a fear / greed score, the same rows calculate_rolling_correlations uses
+        data = pd.concat([stock_data.set_index("timestamp"),
+                          market_indicators["fear_greed_score"].set_index("timestamp")], axis=1).dropna()
+
+        social_data = await social_task
+        _, _, sentiment = await process_sentiment_data(start_date=pd.to_datetime(data.index).min(), data=daily_rows(social_data),
+                                                       missing=None, key=("correlations", ticker, company.lower(), time_filter))
+        sentiment = sentiment.set_index("timestamp")["sentiment"]
+        sentiment.index = pd.to_datetime(sentiment.index)
+        data["sentiment"] = sentiment.reindex(pd.to_datetime(data.index)).values
+
+        signals = ["fear_greed_score", "sentiment"]
+        correlations = lagged_rolling_correlations(data["price"].to_numpy(), data[signals].to_numpy(),
+                                                   windows, lags, dtype=np.float32)[:, :, :, 0, :]
+
+        return {
+            "latency": time.time() - start,
+            "ticker": ticker,
+            "timestamp": pd.to_datetime(data.index).strftime("%Y-%m-%d %H:%M:%S").tolist(),
+            "lags": lags,
+            "windows": windows,
+            "signals": signals,
+            "correlation": np.where(np.isnan(correlations), None, correlations).tolist(),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'An Error occured: {str(e)} from market_correlations()')
+
+
+### Analysis of several (ticker, company) pairs sharing every stage that doesn't depend on the pair
+async def run_market_analysis_many(pairs: list, time_filter: str = "year") -> dict:
+    try:
+        start = time.time()
+
+        start_date, end_date, interval = await convert_time_filter(time_filter=time_filter)
+        tickers = list(dict.fromkeys(ticker for ticker, _ in pairs))
+        # Companies are searched case-insensitively, like the single ticker endpoint
+        companies = list(dict.fromkeys(company.lower() for _, company in pairs))
+
+        # Reddit crawls start right away, they share the Reddit I/O limit and the inference batches
+        social_tasks = [asyncio.ensure_future(fetch_social_sentiment(subreddit=ANALYZE_SUBREDDITS,
+                            query=company, time_filter=time_filter)) for company in companies]
+
+        try:
+            # Every price in one download, same 5 day cutoff as /stock-price
+            cutoff_date = start_date - timedelta(days=5)
+            stock_data = await fetch_multiple_stock_data(tickers, start_date=cutoff_date.strftime('%Y-%m-%d'),
+                                                         end_date=end_date.strftime('%Y-%m-%d'), interval=interval,
+                                                         skip_missing=True)
+            prices = pd.concat({
+                ticker: data.set_index("Date")[f"Close_{ticker}"] for ticker, data in stock_data.items()
+            }, axis=1)
+            prices = prices[pd.to_datetime(prices.index) >= start_date].rename_axis("timestamp")
+
+            # Fear greed score once for the whole watchlist
+            market_indicators = await get_market_indicators(start_date=start_date, end_date=end_date, interval=interval)
+
+            correlations = await calculate_rolling_correlations_many(prices, market_indicators["fear_greed_score"])
+        except Exception:
+            for task in social_tasks:
+                task.cancel()
+            raise
+
+        social_results = await asyncio.gather(*social_tasks, return_exceptions=True)
+        social_data = dict(zip(companies, social_results))
+
+        results = {}
+        for ticker, company in pairs:
+            social = social_data[company.lower()]
+            if ticker not in correlations:
+                results[ticker] = {"company": company, "error": f"No data avalaible for {ticker}"}
+            elif isinstance(social, Exception):
+                results[ticker] = {"company": company, "error": getattr(social, "detail", str(social))}
+            else:
+                # The same company can back several tickers, every analysis gets its own copy
+                analysis = await build_market_signals(correlations[ticker], social.copy(),
+                                                      key=(ticker, company.lower(), time_filter))
+                results[ticker] = {"company": company, **analysis}
 
         latency = time.time() - start
 
-        return {"latency": latency,
-                "extreme_postive_threshold": extreme_pos_threshold, 
-                "extreme_negative_threshold": extreme_neg_threshold,
-                "market_analyzed": merged}
+        return {"latency": latency, "time_filter": time_filter, "results": results}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f'An Error occured: {str(e)} from analyze_market()')
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f'An Error occured: {str(e)} from analyze_market_batch()')
+
+
+### Spot sentiment spikes and turn them into signals given the rolling correlations
+# key: (ticker, company, time_filter) -> the sentiment series is kept and only its new days are processed next time
+async def build_market_signals(rolling_correlations: pd.DataFrame, social_data: pd.DataFrame, key: tuple = None) -> dict:
+    # Sentiment is daily, hourly bars (the "day" filter) start the series at their day
+    start_sentiment_date = pd.to_datetime(rolling_correlations['timestamp']).min().normalize()
+
+    # The "day" filter has hourly posts, the strongest one of each day goes into the daily series
+    extreme_pos_threshold, extreme_neg_threshold, social_data = await process_sentiment_data(start_date=start_sentiment_date, data=daily_rows(social_data), missing=None, key=key)
+
+    '''
+    - positive spike sentiment and positive correlation suggests increase stock and greed (momentum) -> mark event + action: Momentum trade
+    - negative spike sentiment and positive correlation suggests decrease stock and greed (fight or flight)-> mark event + action: Potential exit
+    - else give mixed signal -> actional insights
+    '''
+
+    # Merge based on stock price timestamps, an hourly bar takes the sentiment of its day
+    merged = pd.merge(
+        rolling_correlations.assign(day=rolling_correlations['timestamp'].astype(str).str[:10]),
+        social_data.rename(columns={'timestamp': 'day'}),
+        on='day',
+        how='left'
+    ).drop(columns='day')
+
+    # Identify signals
+    conditions = [
+        (merged["positive_spike"] & (merged['correlation'] > 0.3)),
+        (merged["negative_spike"] & (merged['correlation'] > 0.3)),
+        ((merged['positive_spike'] | merged['negative_spike']) & (merged['correlation'] <= 0))
+    ]
+    options = ['Momentum trade', 'Potential exit', 'Mixed signal']
+
+    # Four labels, stored once as categories instead of a string object per row
+    merged['action'] = pd.Categorical.from_codes(
+        np.select(conditions, list(range(len(options))), default=len(options)),
+        categories=options + ['no signal']
+    )
+
+    return {"extreme_postive_threshold": extreme_pos_threshold, 
+            "extreme_negative_threshold": extreme_neg_threshold,
+            "market_analyzed": merged}
\ No newline at end of file
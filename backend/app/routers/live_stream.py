@@ -0,0 +1,47 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from decouple import config
+from services.live_stream import LiveFeed, stream_market, STREAM_LOOKBACK_DAYS
+from util.util import convert_time_filter
+
+
+router = APIRouter()
+
+# Replay recorded / synthetic fixtures instead of the live providers (local testing)
+STREAM_REPLAY = config("STREAM_REPLAY", default=False, cast=bool)
+
+# Live "day" view: price bars, fear / greed scores and new post sentiments as server-sent events
+@router.get("/stream/{ticker}")
+async def stream_ticker(ticker: str, company: str, interval: str = "1h", subreddit: str = "technology"):
+    if interval not in STREAM_LOOKBACK_DAYS:
+        raise HTTPException(status_code=400, detail=f"Interval must be one of {', '.join(STREAM_LOOKBACK_DAYS)}")
+
+    start_date, end_date, _ = await convert_time_filter(time_filter="day")
+
+    if STREAM_REPLAY:
+        from benchmarks.fixtures import replay_feed
+        feed = replay_feed(query=company, subreddit=subreddit, interval=interval,
+                           lookback_days=STREAM_LOOKBACK_DAYS[interval],
+                           speed=config("STREAM_REPLAY_SPEED", default=60, cast=float),
+                           fixtures=config("STREAM_REPLAY_FIXTURES", default=None))
+    else:
+        feed = LiveFeed(interval=interval, subreddit=subreddit, query=company,
+                        poll_seconds=config("STREAM_POLL_SECONDS", default=30, cast=float))
+
+    events = stream_market(ticker, feed, start_date=start_date, end_date=end_date,
+                           heartbeat_seconds=config("STREAM_HEARTBEAT_SECONDS", default=15, cast=float))
+
+    # Seeding happens before the response starts, so a failing provider is still a proper error
+    try:
+        snapshot = await anext(events)
+    except Exception as e:
+        await events.aclose()
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)} from stream_ticker()")
+
+    async def send():
+        yield snapshot
+        async for event in events:
+            yield event
+
+    return StreamingResponse(send(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,36 +1,29 @@
-from fastapi import APIRouter, HTTPException
-from util.util import convert_time_filter, calculate_fear_greed_score
-from services.yahoo import fetch_vix, fetch_market_momentum, fetch_safe_haven_demand, fetch_yield_spread
+from typing import Annotated
+from fastapi import APIRouter, Header, HTTPException
+from util.util import convert_time_filter
+from services.market_table import get_market_indicators
+from util.coalesce import coalesce
+from util.response_format import response_format, accepted_format, render
+from decouple import config
 
 
 
 router = APIRouter()
 # Fetch market sentiment indicators
 @router.get("/market-sentiment/{indicator}")
-async def get_market_sentiment(indicator: str, time_filter: str = "year"):
+@coalesce(ttl=config("COALESCE_TTL_SECONDS", default=10, cast=float), normalize={"accept": accepted_format})
+async def get_market_sentiment(indicator: str, time_filter: str = "year",
+                               format: str = None, accept: Annotated[str | None, Header()] = None):
+    format = response_format(format, accept)
     try:
         start_date, end_date, interval = await convert_time_filter(time_filter)
 
-        data = None
-        if indicator == "vix":
-            data = await fetch_vix(start_date=start_date, end_date=end_date, interval=interval)
-        elif indicator == "market_momentum":
-            data = await fetch_market_momentum(start_date=start_date, end_date=end_date, interval=interval)
-        elif indicator == "safe_haven":
-            data = await fetch_safe_haven_demand(start_date=start_date, end_date=end_date, interval=interval)
-        elif indicator == "yield_spread":
-            data = await fetch_yield_spread(start_date=start_date, end_date=end_date, interval=interval)
-        elif indicator == "fear_greed_score":
-            data = await calculate_fear_greed_score(start_date=start_date, end_date=end_date, interval=interval)
+        # vix, market_momentum, safe_haven, yield_spread or fear_greed_score
+        indicators = await get_market_indicators(start_date=start_date, end_date=end_date, interval=interval)
+        data = indicators[indicator]
         
-        data = data.to_dict("records")
-        return {f'{indicator}': data}
+        return render({f'{indicator}': data}, format)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)} from get_market_sentiment")
-    
 
-'''
-TODO:
-- Real time for one day API calling
-'''
\ No newline at end of file
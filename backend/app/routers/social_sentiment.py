@@ -1,12 +1,18 @@
 import time
-from fastapi import APIRouter, HTTPException
+from typing import Annotated
+from fastapi import APIRouter, Header, HTTPException
 from services.reddit import fetch_social_sentiment
+from util.coalesce import coalesce
+from util.response_format import response_format, accepted_format, render
+from decouple import config
 
 
 router = APIRouter()
 
 @router.get("/social-sentiment/{subreddit}")
-async def get_social_sentiment(subreddit: str, query: str, time_filter: str, limit: int = None):
+@coalesce(ttl=config("COALESCE_TTL_SECONDS", default=10, cast=float), normalize={"query": str.lower, "accept": accepted_format})
+async def get_social_sentiment(subreddit: str, query: str, time_filter: str, limit: int = None,
+                               format: str = None, accept: Annotated[str | None, Header()] = None):
     """
     API endpoint to fetch Reddit posts from a subreddit.
 
@@ -15,10 +21,12 @@ async def get_social_sentiment(subreddit: str, query: str, time_filter: str, lim
         query (str): query within the subreddit
         sort_by (str): sort the post by hot, popularity, best, relevance
         limit (int): Number of posts to fetch (default: 10).
+        format (str): records (default), columnar or arrow, see util.response_format
 
     Returns:
         JSON response with that subreddit posts sentiment score
     """
+    format = response_format(format, accept)
     try:
         # Fetch social sentiment
         if limit == None:
@@ -28,9 +36,7 @@ async def get_social_sentiment(subreddit: str, query: str, time_filter: str, lim
              analyzed_sentiment = await fetch_social_sentiment(
                 subreddit=subreddit, query=query, time_filter=time_filter, limit=limit)
         
-        analyzed_sentiment = analyzed_sentiment.to_dict("records")                                      
-        
-        return {"subreddit": subreddit, "analyzed_sentiment": analyzed_sentiment}
+        return render({"subreddit": subreddit, "analyzed_sentiment": analyzed_sentiment}, format)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,13 +1,20 @@
 import pandas as pd
+from typing import Annotated
 from util.util import convert_time_filter
 from datetime import timedelta
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 from services.yahoo import fetch_stock_data
+from util.coalesce import coalesce
+from util.response_format import response_format, accepted_format, render
+from decouple import config
 
 router = APIRouter()
 
 @router.get("/stock-price/{ticker}")
-async def get_stock_data(ticker: str, time_filter: str = "year", interval: str = "1d"):
+@coalesce(ttl=config("COALESCE_TTL_SECONDS", default=10, cast=float), normalize={"accept": accepted_format})
+async def get_stock_data(ticker: str, time_filter: str = "year", interval: str = "1d",
+                         format: str = None, accept: Annotated[str | None, Header()] = None):
+    format = response_format(format, accept)
     try:
         
         start_date, end_date, interval = await convert_time_filter(time_filter=time_filter)
@@ -24,10 +31,10 @@ async def get_stock_data(ticker: str, time_filter: str = "year", interval: str =
         data["price"] = data[f"Close_{ticker}"]
         data = data[pd.to_datetime(data["timestamp"]) >= start_date]
         
-        data = data[["timestamp", "price"]].to_dict(orient="records")
+        data = data[["timestamp", "price"]]
         
 
-        return {f"{ticker}": data}
+        return render({f"{ticker}": data}, format)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
\ No newline at end of file
@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from decouple import config
+from services import resource_init
+from services.batch_inference import BatchInferenceEngine
+from services.market_store import market_store
+from services.reddit import (stream_reddit_posts, calculate_post_sentiment, scored_post, daily_top_posts,
+                             search_time_filter, day_epoch, ScoredPost)
+from services.resource_init import MODELS, PROJECT_DIR, SENTIMENT_CACHE_PATH
+from services.sentiment_cache import SentimentCache
+from util.market_calendar import market_today
+
+logger = logging.getLogger(__name__)
+
+# Reddit listings stop at about 1000 results per search
+BACKFILL_SEARCH_LIMIT = config("BACKFILL_SEARCH_LIMIT", default=1000, cast=int)
+BACKFILL_CHUNK_SIZE = config("BACKFILL_CHUNK_SIZE", default=32, cast=int)
+
+# Model, event loop and sentiment cache of the current worker process, set by init_worker
+WORKER = {}
+
+
+### Worker process: load the model once, its ONNX session gets this worker's share of the cores
+def init_worker(intra_op_threads: int, cache_path: str):
+    logging.basicConfig(level=logging.INFO)
+    resource_init.ONNX_INTRA_OP_THREADS = intra_op_threads
+    model, tokenizer = resource_init.load_sentiment_model()
+    WORKER["predict_batch"] = lambda texts: resource_init.predict_sentiment_batch(model, tokenizer, texts)
+    WORKER["model_id"] = resource_init.sentiment_model_id()
+
+    # Every chunk runs on this loop, so the engine and the cache (and its SQLite connection) are made once
+    loop = WORKER["loop"] = asyncio.new_event_loop()
+    engine = WORKER["engine"] = BatchInferenceEngine(WORKER["predict_batch"], max_batch_size=BACKFILL_CHUNK_SIZE,
+                                                     max_wait_ms=5)
+    loop.run_until_complete(engine.start())
+    # Every scored text lands in the API's sentiment cache, live requests for these posts skip the model
+    cache = WORKER["cache"] = SentimentCache(engine.predict, model_id=WORKER["model_id"], path=cache_path)
+    MODELS["social_sentiment"] = {"predict": cache.predict}
+
+
+### Worker process: score a chunk of posts, same scoring as a live request
+def score_chunk(posts: list) -> list:
+    return WORKER["loop"].run_until_complete(score_chunk_async(posts))
+
+
+async def score_chunk_async(posts: list) -> list:
+    try:
+        sentiments = await asyncio.gather(*(
+            calculate_post_sentiment(post["title"], post["comments"], post["interest_score"]) for post in posts))
+    finally:
+        # The worker may exit after any chunk, its scored texts are on disk before the chunk returns
+        await WORKER["cache"].drain()
+    return [scored_post(post, sentiment) for post, sentiment in zip(posts, sentiments)]
+
+
+### Progress file, a unit (subreddit, company, range) is recorded once its rows are stored
+class Checkpoint:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.units = json.loads(self.path.read_text())["units"] if self.path.exists() else {}
+
+    @staticmethod
+    def unit(subreddit: str, company: str, start: date, end: date) -> str:
+        return f"{subreddit.lower()}:{company.lower()}:{start}:{end}"
+
+    def done(self, unit: str) -> bool:
+        return unit in self.units
+
+    def record(self, unit: str, **summary):
+        self.units[unit] = {**summary, "completed_at": datetime.now().isoformat()}
+        # Written to a temporary file first, a crash never leaves half a checkpoint
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_suffix(".tmp")
+        temporary.write_text(json.dumps({"units": self.units}, indent=2))
+        os.replace(temporary, self.path)
+
+
+### Crawl, score and store one (subreddit, company) pair over [start, end]
+async def backfill_unit(pool: ProcessPoolExecutor, subreddit: str, company: str, start: date, end: date,
+                        limit: int = BACKFILL_SEARCH_LIMIT, chunk_size: int = BACKFILL_CHUNK_SIZE) -> dict:
+    '''
+        Chunks go to the pool as soon as they are loaded, so the worker processes score while
+        the search is still paging. Returns the unit's summary for the checkpoint.
+    '''
+    loop = asyncio.get_running_loop()
+    # Same days and keys as live requests (services.reddit.fetch_social_sentiment), they read what is written here
+    # when they would search at most as many days with at most this limit
+    first, last = str(start), str(end + timedelta(days=1))
+    time_filter = search_time_filter(first)
+    key = market_store.social_key(subreddit, company)
+    # A rerun over stored posts only scores the new ones
+    known = {post["id"]: post for post in await market_store.read_posts(key, first, last)}
+    chunks, chunk, reused = [], [], []
+
+    async for post in stream_reddit_posts(subreddit, company, time_filter, limit,
+                                          created_between=(day_epoch(first), day_epoch(last)), known=known):
+        if post["id"] in known:
+            reused.append(ScoredPost.from_record(post))
+            continue
+        chunk.append(post)
+        if len(chunk) == chunk_size:
+            chunks.append(loop.run_in_executor(pool, score_chunk, chunk))
+            chunk = []
+    if chunk:
+        chunks.append(loop.run_in_executor(pool, score_chunk, chunk))
+
+    posts = [post for scored in await asyncio.gather(*chunks) for post in scored]
+    daily = daily_top_posts(reused + posts)
+
+    # One bulk write per unit for the new posts and one for the daily rows
+    await asyncio.gather(
+        market_store.write_posts(key, [post.record() for post in posts]),
+        market_store.write_social_days(subreddit, company, daily, first, last, time_filter, limit),
+    )
+    return {"posts": len(posts) + len(reused), "scored": len(posts), "days": len(daily)}
+
+
+### Backfill every (subreddit, company) pair, pairs already in the checkpoint are skipped
+async def backfill(companies: list, subreddits: list, start: date, end: date, workers: int = None,
+                   checkpoint: Path = None, concurrent_units: int = 4, limit: int = BACKFILL_SEARCH_LIMIT,
+                   chunk_size: int = BACKFILL_CHUNK_SIZE, cache_path: str = SENTIMENT_CACHE_PATH) -> dict:
+    '''
+        workers: None -> one process per core, the cores are split between their ONNX sessions
+        concurrent_units: 4 -> pairs crawled at once, Reddit requests still go through the crawler's I/O limit
+    '''
+    workers = workers or os.cpu_count()
+    checkpoint = Checkpoint(checkpoint or PROJECT_DIR / "data" / "backfill_checkpoint.json")
+    if not market_store.enabled:
+        logger.warning("MONGO_URI is not set, posts are only scored into the sentiment cache, nothing is stored")
+    await market_store.ensure_indexes()
+
+    units = [(subreddit, company) for subreddit in subreddits for company in companies
+             if not checkpoint.done(Checkpoint.unit(subreddit, company, start, end))]
+    logger.info("Backfilling %d of %d pairs from %s to %s on %d workers",
+                len(units), len(subreddits) * len(companies), start, end, workers)
+
+    # Spawned workers don't inherit the event loop or the Reddit client of this process
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_worker, initargs=(max(1, os.cpu_count() // workers), cache_path))
+    running = asyncio.Semaphore(concurrent_units)
+    results = {}
+
+    async def run(subreddit: str, company: str):
+        unit = Checkpoint.unit(subreddit, company, start, end)
+        async with running:
+            started = time.time()
+            try:
+                summary = await backfill_unit(pool, subreddit, company, start, end, limit, chunk_size)
+            except Exception as e:
+                # The other pairs go on, this one is retried by the next run
+                logger.error("Backfill of %s failed: %s", unit, e)
+                results[unit] = {"error": str(e)}
+                return
+            summary["seconds"] = round(time.time() - started, 1)
+            checkpoint.record(unit, **summary)
+            results[unit] = summary
+            logger.info("Backfilled %s: %s", unit, summary)
+
+    try:
+        await asyncio.gather(*(run(subreddit, company) for subreddit, company in units))
+    finally:
+        pool.shutdown(cancel_futures=True)
+    return results
+
+
+def parse_day(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+# Note to self:
+#   python -m services.backfill --companies Apple,Microsoft --subreddits technology,stocks --start 2024-01-01
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute social sentiment for a watchlist (run from backend/app)")
+    parser.add_argument("--companies", required=True, help="Comma separated search queries, e.g. Apple,Microsoft")
+    parser.add_argument("--subreddits", default="technology", help="Comma separated subreddits")
+    parser.add_argument("--start", required=True, type=parse_day, help="First day, YYYY-MM-DD")
+    parser.add_argument("--end", default=market_today().date(), type=parse_day, help="Last day (inclusive), default today")
+    parser.add_argument("--workers", type=int, default=None, help="Scoring processes, default one per core")
+    parser.add_argument("--concurrent-units", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=BACKFILL_SEARCH_LIMIT, help="Search results per pair")
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE, help="Posts per worker task")
+    parser.add_argument("--checkpoint", default=None, help="Progress file, rerun with the same one to resume")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results = asyncio.run(backfill(
+        companies=[company.strip() for company in args.companies.split(",") if company.strip()],
+        subreddits=[subreddit.strip() for subreddit in args.subreddits.split(",") if subreddit.strip()],
+        start=args.start, end=args.end, workers=args.workers, checkpoint=args.checkpoint,
+        concurrent_units=args.concurrent_units, limit=args.limit, chunk_size=args.chunk_size,
+    ))
+    failed = [unit for unit, summary in results.items() if "error" in summary]
+    if failed:
+        raise SystemExit(f"{len(failed)} pairs failed, rerun to retry them: {', '.join(failed)}")
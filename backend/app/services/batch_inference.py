@@ -0,0 +1,100 @@
+import asyncio
+from typing import Callable
+
+
+### Dynamic micro-batching for model inference
+class BatchInferenceEngine:
+    '''
+        Collects texts from every concurrent caller into one queue and runs a single
+        forward pass per batch instead of one per text.
+
+        predict_batch: sync function taking a list of texts and returning one result per text
+        max_batch_size: 32 -> upper bound of texts per forward pass
+        max_wait_ms: 10 -> how long the first text of a batch waits for others to join
+    '''
+    def __init__(self, predict_batch: Callable[[list], list], max_batch_size: int = 32, max_wait_ms: float = 10):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = None
+        self.worker: asyncio.Task = None
+        # Texts taken off the queue and not answered yet, while a batch fills up or runs
+        self.batch = []
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
+
+        # Fail whatever is still waiting, in the queue or in the batch the worker had, so no caller hangs on shutdown
+        waiting = self.batch
+        self.batch = []
+        while not self.queue.empty():
+            waiting.append(self.queue.get_nowait())
+        for _, future in waiting:
+            if not future.done():
+                future.set_exception(RuntimeError("Inference engine stopped"))
+
+    # Queue one text and wait for its batch to be scored
+    async def predict(self, text: str):
+        if self.worker is None:
+            raise RuntimeError("Inference engine is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    # Gather up to max_batch_size texts or until max_wait runs out
+    async def _next_batch(self) -> list:
+        self.batch = batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already queued without waiting
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+
+            # Callers that gave up (e.g. request cancelled) don't need a forward pass
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            texts = [text for text, _ in batch]
+            try:
+                results = await asyncio.to_thread(self.predict_batch, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self.batch = []
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            self.batch = []
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from decouple import config
+from util.metrics import timer
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_SOCKET = config("INFERENCE_SOCKET", default="/tmp/marketpulse-inference.sock")
+
+# Longest wait for the answer to one batch, a stuck server fails the batch instead of hanging the worker
+INFERENCE_REQUEST_TIMEOUT = config("INFERENCE_REQUEST_TIMEOUT", default=30, cast=float)
+
+# Messages are a 4 byte big-endian length followed by that many bytes of JSON
+HEADER = struct.Struct(">I")
+
+
+def encode_message(message: dict) -> bytes:
+    body = json.dumps(message).encode()
+    return HEADER.pack(len(body)) + body
+
+
+async def read_message(reader: asyncio.StreamReader) -> dict:
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return json.loads(await reader.readexactly(length))
+
+
+def receive_exactly(sock: socket.socket, length: int) -> bytes:
+    chunks = []
+    while length > 0:
+        chunk = sock.recv(length)
+        if not chunk:
+            raise ConnectionError("Inference server closed the connection")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+
+### Model hosted by the inference server, used by the API workers in place of a local ONNX session
+class RemoteModel:
+    '''
+        predict_batch has the same contract as resource_init.predict_sentiment_batch, so it drops into
+        a BatchInferenceEngine: each worker batches its own texts, the server then merges the batches
+        of every worker into its forward passes.
+
+        connect_timeout: 60 -> how long to keep trying a server that is (re)loading the model
+        request_timeout: 30 -> socket timeout of one batch, the connection is dropped after it
+        retries: 2 -> a batch whose connection broke is sent again, after 0.5 s then 1 s (`backoff`)
+    '''
+    def __init__(self, path: str = INFERENCE_SOCKET, connect_timeout: float = 60,
+                 request_timeout: float = INFERENCE_REQUEST_TIMEOUT, retries: int = 2, backoff: float = 0.5):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sock = None
+        # The engine sends one batch at a time, the lock only guards against other callers
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        delay = self.backoff
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.request_timeout)
+            try:
+                sock.connect(self.path)
+                self.sock = sock
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def _request(self, texts: list) -> dict:
+        if self.sock is None:
+            self._connect()
+        self.sock.sendall(encode_message({"texts": texts}))
+        (length,) = HEADER.unpack(receive_exactly(self.sock, HEADER.size))
+        return json.loads(receive_exactly(self.sock, length))
+
+    def predict_batch(self, texts: list) -> list:
+        with self.lock, timer("inference_remote"):
+            for attempt in range(self.retries + 1):
+                try:
+                    response = self._request(texts)
+                    break
+                except TimeoutError:
+                    # A late answer would be read as the next batch's, the connection can't be reused
+                    self.close()
+                    raise TimeoutError(f"Inference server did not answer within {self.request_timeout}s")
+                except (ConnectionError, OSError) as e:
+                    # The server restarted, its replacement is reached through a new connection.
+                    # Not reaching any server already waited connect_timeout, that isn't retried
+                    self.close()
+                    if attempt == self.retries or isinstance(e, (FileNotFoundError, ConnectionRefusedError)):
+                        raise
+                    time.sleep(self.backoff * 2 ** attempt)
+
+        if "error" in response:
+            raise RuntimeError(f"Inference server: {response['error']}")
+        return list(np.asarray(response["probabilities"], dtype=np.float32))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+### Load the model once and answer every API worker over a unix socket
+async def serve(path: str = INFERENCE_SOCKET):
+    # Imported here, API workers only need the client above
+    from services.batch_inference import BatchInferenceEngine
+    from services.resource_init import load_sentiment_model, predict_sentiment_batch
+
+    model, tokenizer = load_sentiment_model()
+    engine = BatchInferenceEngine(
+        lambda texts: predict_sentiment_batch(model, tokenizer, texts),
+        max_batch_size=config("INFERENCE_MAX_BATCH_SIZE", default=32, cast=int),
+        max_wait_ms=config("INFERENCE_MAX_WAIT_MS", default=10, cast=float),
+    )
+    await engine.start()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await read_message(reader)
+                try:
+                    # Texts of every connected worker land in the same batches
+                    probabilities = await asyncio.gather(*(engine.predict(text) for text in request["texts"]))
+                    response = {"probabilities": [p.tolist() for p in probabilities]}
+                except Exception as e:
+                    response = {"error": str(e)}
+                writer.write(encode_message(response))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path=path)
+    logger.info("Inference server listening on %s", path)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await engine.stop()
+
+
+# Note to self:
+#   Started by gunicorn.conf.py, by hand: python -m services.inference_server
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())
@@ -0,0 +1,135 @@
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+### Bounded background worker pool for long running jobs
+class JobQueue:
+    '''
+        Jobs wait in a priority queue and at most `workers` of them run at the same time.
+        When `max_queued` jobs are already waiting, new submissions are rejected right away
+        instead of piling up. Finished jobs are kept for `retention_seconds` so clients can poll them.
+
+        A job is submitted as run(progress), where progress(stage, fraction) updates its status.
+        Submitting a job whose key matches a queued or running job returns that job instead.
+    '''
+    def __init__(self, workers: int = 2, max_queued: int = 20, retention_seconds: float = 3600):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.retention_seconds = retention_seconds
+
+        self.jobs = {}
+        self.active = {}
+        self.counter = itertools.count()
+        self.queue: asyncio.PriorityQueue = None
+        self.tasks = []
+
+    async def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def queued(self) -> int:
+        return sum(1 for job in self.jobs.values() if job["status"] == "queued")
+
+    def submit(self, run: Callable[[Callable], Awaitable], key=None, priority: int = 0, params: dict = None) -> dict:
+        '''
+            priority: 0 -> default, higher runs earlier, same priority runs first come first served
+        '''
+        self._prune()
+
+        if key is not None and key in self.active:
+            return self.jobs[self.active[key]]
+
+        if self.queued() >= self.max_queued:
+            raise QueueFullError(f"{self.max_queued} jobs are already waiting")
+
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = {
+            "job_id": job_id,
+            "status": "queued",
+            "params": params or {},
+            "priority": priority,
+            "stage": None,
+            "progress": 0.0,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        if key is not None:
+            self.active[key] = job_id
+
+        self.queue.put_nowait((-priority, next(self.counter), job_id, key, run))
+        return self.jobs[job_id]
+
+    def get(self, job_id: str) -> dict:
+        self._prune()
+        return self.jobs.get(job_id)
+
+    # Position in the queue, 0 means next
+    def position(self, job_id: str) -> int:
+        job = self.jobs.get(job_id)
+        if job is None or job["status"] != "queued":
+            return None
+        ahead = sorted((-j["priority"], j["submitted_at"]) for j in self.jobs.values() if j["status"] == "queued")
+        return ahead.index((-job["priority"], job["submitted_at"]))
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job["finished_at"] is not None and now - job["finished_at"] > self.retention_seconds:
+                del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            _, _, job_id, key, run = await self.queue.get()
+            job = self.jobs[job_id]
+
+            def progress(stage: str, fraction: float):
+                job["stage"] = stage
+                job["progress"] = fraction
+
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            try:
+                job["result"] = await run(progress)
+                job["status"] = "done"
+                job["progress"] = 1.0
+            except asyncio.CancelledError:
+                job["status"] = "failed"
+                job["error"] = "Cancelled"
+                raise
+            except Exception as e:
+                logger.exception("Job %s failed", job_id)
+                job["status"] = "failed"
+                job["error"] = getattr(e, "detail", str(e))
+            finally:
+                job["finished_at"] = time.time()
+                if key is not None:
+                    self.active.pop(key, None)
+                self.queue.task_done()
+
+
+# Analyses submitted through /api/analyze-market/{company}/jobs
+analysis_jobs = JobQueue(
+    workers=config("ANALYSIS_WORKERS", default=2, cast=int),
+    max_queued=config("ANALYSIS_MAX_QUEUED", default=20, cast=int),
+    retention_seconds=config("ANALYSIS_JOB_RETENTION_SECONDS", default=3600, cast=float),
+)
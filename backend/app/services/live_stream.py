@@ -0,0 +1,349 @@
+import asyncio
+import json
+import logging
+import math
+import pandas as pd
+import services.reddit
+from datetime import datetime, timedelta
+from services.reddit import load_post, calculate_post_sentiment
+from services.reddit_crawler import with_retries
+from services.price_store import price_store
+from services.yahoo import download_stock_data, fetch_multiple_stock_data, zscore_to_score, \
+    timestamp_format, FEAR_GREED_TICKERS
+from util.market_calendar import MARKET_CLOSE, market_now, market_today
+from util.streaming import RollingWindow, RunningStats
+
+logger = logging.getLogger(__name__)
+
+# Lookback of the history that seeds the rolling windows, Yahoo keeps 1m bars for about a week only
+STREAM_LOOKBACK_DAYS = {"1m": 5, "2m": 30, "5m": 30, "15m": 30, "30m": 30, "1h": 90}
+
+
+### Fear / greed indicators updated one bar at a time
+class IndicatorStream:
+    '''
+        Same indicators as services.yahoo, but every bar only updates running state:
+        moving averages are rolling windows and the z-score statistics are Welford means / variances
+        of everything seen so far (seed history included), so a score only uses data up to its own bar.
+    '''
+    def __init__(self, vix_moving_avg: int = 50, momentum_moving_avg: int = 125, safe_haven_difference: int = 20):
+        self.closes = {
+            "^VIX": RollingWindow(vix_moving_avg),
+            "^GSPC": RollingWindow(momentum_moving_avg),
+            "SPY": RollingWindow(safe_haven_difference + 1),
+            "TLT": RollingWindow(safe_haven_difference + 1),
+            "HYG": RollingWindow(2),
+            "LQD": RollingWindow(2),
+        }
+        self.stats = {name: RunningStats() for name in ("vix", "market_momentum", "safe_haven", "yield_spread")}
+        self.last_momentum_diff = None
+        # Legs of the two ETF pairs waiting for their partner: (indicator, timestamp) -> {symbol: value}
+        self.pending = {}
+        self.scores = {}
+
+    # Feed one bar, returns {indicator: score} for the indicators it moved
+    def update(self, symbol: str, timestamp: datetime, close: float) -> dict:
+        window = self.closes.get(symbol)
+        if window is None or close is None or math.isnan(close):
+            return {}
+        window.push(close)
+
+        updated = {}
+        if symbol == "^VIX" and window.full:
+            diff = close - window.mean
+            self.stats["vix"].add(diff)
+            updated["vix"] = self.score("vix", diff, bound=2)
+
+        elif symbol == "^GSPC" and window.full:
+            diff = close - window.mean
+            if self.last_momentum_diff is not None:
+                change = diff - self.last_momentum_diff
+                self.stats["market_momentum"].add(change)
+                updated["market_momentum"] = self.score("market_momentum", change, bound=3)
+            self.last_momentum_diff = diff
+
+        elif symbol in ("SPY", "TLT") and window.full:
+            spread = self.pair("safe_haven", symbol, timestamp, close / window[0] - 1, ("SPY", "TLT"))
+            if spread is not None:
+                self.stats["safe_haven"].add(spread)
+                updated["safe_haven"] = self.score("safe_haven", spread, bound=2)
+
+        elif symbol in ("HYG", "LQD") and window.full:
+            spread = self.pair("yield_spread", symbol, timestamp, close / window[0], ("HYG", "LQD"))
+            if spread is not None:
+                self.stats["yield_spread"].add(spread)
+                updated["yield_spread"] = self.score("yield_spread", spread, bound=2)
+
+        updated = {name: score for name, score in updated.items() if not math.isnan(score)}
+        self.scores.update(updated)
+        return updated
+
+    # First leg minus second leg once both arrived for the same bar
+    def pair(self, indicator: str, symbol: str, timestamp: datetime, value: float, legs: tuple):
+        legs_seen = self.pending.setdefault((indicator, timestamp), {})
+        legs_seen[symbol] = value
+        if len(legs_seen) < 2:
+            # A leg whose partner never shows up must not pile up
+            if len(self.pending) > 256:
+                self.pending.pop(next(iter(self.pending)))
+            return None
+
+        del self.pending[(indicator, timestamp)]
+        return legs_seen[legs[0]] - legs_seen[legs[1]]
+
+    def score(self, indicator: str, value: float, bound: float) -> float:
+        return float(zscore_to_score(self.stats[indicator].zscore(value), bound=bound))
+
+    # Average of the latest indicator scores, None until every indicator has one
+    @property
+    def fear_greed_score(self):
+        if len(self.scores) < len(self.stats):
+            return None
+        return sum(self.scores.values()) / len(self.scores)
+
+
+### Post sentiments with a rolling average and spike thresholds kept up to date per post
+class SentimentStream:
+    def __init__(self, rolling_avg: int = 7, pos_std_multiplier: float = 1, neg_std_multiplier: float = 1):
+        self.window = RollingWindow(rolling_avg)
+        self.stats = RunningStats()
+        self.pos_std_multiplier = pos_std_multiplier
+        self.neg_std_multiplier = neg_std_multiplier
+
+    def update(self, sentiment: float) -> dict:
+        self.window.push(sentiment)
+        # Like .rolling(window, min_periods=1) the average starts with the first post
+        rolling_avg = self.window.stats.mean
+        self.stats.add(rolling_avg)
+
+        std = self.stats.std
+        positive_threshold = self.stats.mean + std * self.pos_std_multiplier
+        negative_threshold = self.stats.mean - std * self.neg_std_multiplier
+        return {
+            "sentiment": rolling_avg,
+            "raw_sentiment": sentiment,
+            "positive_spike": not math.isnan(std) and rolling_avg > positive_threshold,
+            "negative_spike": not math.isnan(std) and rolling_avg < negative_threshold,
+            "extreme_postive_threshold": None if math.isnan(std) else positive_threshold,
+            "extreme_negative_threshold": None if math.isnan(std) else negative_threshold,
+        }
+
+
+### Yahoo bars and new Reddit submissions as they show up
+class LiveFeed:
+    '''
+        Events put on the queue:
+            ("bar", symbol, timestamp, close) -> a bar that just completed
+            ("submission", submission) -> a new submission whose title mentions the query
+    '''
+    def __init__(self, interval: str, subreddit: str, query: str, poll_seconds: float = 30):
+        self.interval = interval
+        self.subreddit = subreddit
+        self.query = query
+        self.poll_seconds = poll_seconds
+
+    async def history(self, symbols: list, start_date: datetime, end_date: datetime) -> dict:
+        data = await fetch_multiple_stock_data(symbols, start_date=start_date.strftime('%Y-%m-%d'),
+                                               end_date=end_date.strftime('%Y-%m-%d'), interval=self.interval,
+                                               skip_missing=True)
+        now = market_now()
+
+        history = {}
+        for symbol, df in data.items():
+            bars = pd.DataFrame({"Date": pd.to_datetime(df["Date"]), "Close": df[f"Close_{symbol}"]})
+            # The newest bar may still be forming, poll_bars sends it once it completed
+            history[symbol] = completed_bars(bars, self.interval, now)
+        return history
+
+    async def run(self, symbols: list, queue: asyncio.Queue, since: dict):
+        await asyncio.gather(self.poll_bars(symbols, queue, since), self.watch_submissions(queue))
+
+    # A bar is sent once the next one has started, its interval ended or the session closed
+    async def poll_bars(self, symbols: list, queue: asyncio.Queue, since: dict):
+        key = (tuple(symbols), self.interval)
+        poller = BAR_POLLERS.get(key)
+        if poller is None:
+            poller = BAR_POLLERS[key] = BarPoller(symbols, self.interval, self.poll_seconds)
+        updates = poller.subscribe()
+        try:
+            while True:
+                bars = await updates.get()
+                now = market_now()
+                for symbol, df in bars.items():
+                    for row in completed_bars(df, self.interval, now).itertuples():
+                        if since.get(symbol) is None or row.Date > since[symbol]:
+                            since[symbol] = row.Date
+                            await queue.put(("bar", symbol, row.Date, row.Close))
+        finally:
+            poller.unsubscribe(updates)
+
+    async def watch_submissions(self, queue: asyncio.Queue):
+        # Looked up at call time, the client can be swapped (e.g. for playback)
+        reddit = services.reddit.get_reddit()
+        subreddit = await reddit.subreddit(self.subreddit)
+        async for submission in subreddit.stream.submissions(skip_existing=True):
+            if self.query.lower() in submission.title.lower():
+                await queue.put(("submission", submission))
+
+
+# Bars without the newest one while it is still forming, the session's last bar is complete at the close
+def completed_bars(bars: pd.DataFrame, interval: str, now: datetime) -> pd.DataFrame:
+    if bars.empty:
+        return bars
+    last = bars["Date"].iloc[-1]
+    if last + pd.Timedelta(interval) <= now or datetime.combine(last.date(), MARKET_CLOSE) <= now:
+        return bars
+    return bars.iloc[:-1]
+
+
+### Today's bars of a symbol set, downloaded once per poll for every stream watching them
+class BarPoller:
+    '''
+        Streams of the same ticker and interval share one poller: each poll reads the bars through the
+        price store and hands the result to every subscriber, which picks the bars it hasn't sent yet.
+        A subscriber that falls behind only gets the latest poll. The poller stops with its last subscriber.
+    '''
+    def __init__(self, symbols: list, interval: str, poll_seconds: float = 30):
+        self.symbols = list(symbols)
+        self.interval = interval
+        self.poll_seconds = poll_seconds
+        self.subscribers = set()
+        self.task = None
+
+    def subscribe(self) -> asyncio.Queue:
+        updates = asyncio.Queue(maxsize=1)
+        self.subscribers.add(updates)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return updates
+
+    def unsubscribe(self, updates: asyncio.Queue):
+        self.subscribers.discard(updates)
+        if not self.subscribers:
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+            if BAR_POLLERS.get((tuple(self.symbols), self.interval)) is self:
+                del BAR_POLLERS[(tuple(self.symbols), self.interval)]
+
+    async def run(self):
+        while True:
+            today = market_today()
+            try:
+                # Earlier bars missing from the store are filled in, today's come from the provider
+                bars = await price_store.get_prices(self.symbols, today.strftime('%Y-%m-%d'),
+                                                    (today + timedelta(days=1)).strftime('%Y-%m-%d'),
+                                                    self.interval, download=download_stock_data)
+            except Exception as e:
+                logger.warning("Live bars download failed: %s", e)
+                bars = None
+
+            if bars is not None:
+                for updates in list(self.subscribers):
+                    if updates.full():
+                        updates.get_nowait()
+                    updates.put_nowait(bars)
+
+            await asyncio.sleep(self.poll_seconds)
+
+
+# (symbols, interval) -> the BarPoller every stream of them shares
+BAR_POLLERS = {}
+
+
+### Server-sent events of a ticker's bars, fear / greed scores and new post sentiments
+async def stream_market(ticker: str, feed, start_date: datetime, end_date: datetime, heartbeat_seconds: float = 15):
+    fmt = timestamp_format(feed.interval)
+    symbols = list(dict.fromkeys([ticker] + FEAR_GREED_TICKERS))
+    indicators = IndicatorStream()
+    sentiments = SentimentStream()
+    price = {"last": None}
+
+    out = asyncio.Queue()
+
+    def event(name: str, payload: dict) -> str:
+        return f"event: {name}\ndata: {json.dumps(payload)}\n\n"
+
+    def on_bar(symbol: str, timestamp: datetime, close: float) -> list:
+        events = []
+        if symbol == ticker:
+            change = None if price["last"] is None else close / price["last"] - 1
+            price["last"] = close
+            events.append(event("price", {"timestamp": timestamp.strftime(fmt), "price": close, "change": change}))
+
+        updated = indicators.update(symbol, timestamp, close)
+        if updated:
+            events.append(event("indicator", {"timestamp": timestamp.strftime(fmt), **updated,
+                                              "fear_greed_score": indicators.fear_greed_score}))
+        return events
+
+    # Posts are loaded and scored off the main loop so bars keep flowing meanwhile
+    async def on_submission(submission):
+        try:
+            post = await with_retries(lambda: load_post(submission), client=services.reddit.get_reddit())
+            sentiment = await calculate_post_sentiment(post["title"], post["comments"], post["interest_score"])
+        except Exception as e:
+            logger.warning("Skipping live post: %s", getattr(e, "detail", e))
+            return
+        await out.put(event("post", {
+            "timestamp": post["timestamp"],
+            "title": post["title"],
+            "article_url": post["article_url"],
+            "top_comment": post["comments"][0][0] if post["comments"] else "",
+            **sentiments.update(sentiment),
+        }))
+
+    # Seed every rolling window from history, only the end state is sent
+    lookback = timedelta(days=STREAM_LOOKBACK_DAYS.get(feed.interval, 30))
+    history = await feed.history(symbols, start_date - lookback, end_date)
+    rows = sorted((row.Date, symbol, row.Close) for symbol, df in history.items() for row in df.itertuples())
+    since = {}
+    for timestamp, symbol, close in rows:
+        on_bar(symbol, timestamp, close)
+        since[symbol] = timestamp
+
+    yield event("snapshot", {
+        "ticker": ticker,
+        "interval": feed.interval,
+        "price": price["last"],
+        "indicators": indicators.scores,
+        "fear_greed_score": indicators.fear_greed_score,
+        "bars": {symbol: since[symbol].strftime(fmt) for symbol in since},
+    })
+
+    feed_queue = asyncio.Queue(maxsize=1000)
+    post_tasks = set()
+
+    async def pump():
+        while True:
+            item = await feed_queue.get()
+            if item[0] == "bar":
+                for text in on_bar(*item[1:]):
+                    await out.put(text)
+            elif item[0] == "submission":
+                task = asyncio.create_task(on_submission(item[1]))
+                post_tasks.add(task)
+                task.add_done_callback(post_tasks.discard)
+
+    feed_task = asyncio.create_task(feed.run(symbols, feed_queue, since))
+    pump_task = asyncio.create_task(pump())
+    tasks = [feed_task, pump_task]
+    try:
+        while True:
+            try:
+                yield await asyncio.wait_for(out.get(), timeout=heartbeat_seconds)
+            except asyncio.TimeoutError:
+                # Comment line keeping proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+
+            # A finite feed (replay) ends the stream once everything it sent went out
+            if feed_task.done() and feed_queue.empty() and not post_tasks and out.empty():
+                yield event("end", {"ticker": ticker})
+                return
+    finally:
+        for task in tasks + list(post_tasks):
+            task.cancel()
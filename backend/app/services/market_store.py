@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import time
+import pandas as pd
+from datetime import date, datetime
+from decouple import config
+from db.db_manager import MongoDB
+from util.market_calendar import MARKET_TIMEZONE
+from util.metrics import metrics, timer
+
+logger = logging.getLogger(__name__)
+
+### Scored posts, daily sentiment and indicator series persisted in MongoDB
+class MarketStore:
+    '''
+        Every series row is one document keyed by `key` (a query or an indicator window) and its
+        `timestamp` string, with a unique compound index on both, so reading a window is one index range scan.
+
+        Next to the rows a coverage document per (collection, key) records the range that was written,
+        its columns and when. A read only answers when the coverage holds the whole requested range
+        (and is recent enough), otherwise the caller fetches from the provider and writes the result back.
+        Social days are written by searches of different sizes, their coverage keeps a segment per search
+        (see read_social_days).
+
+        Without a database every read misses and every write is skipped. Database errors are logged
+        and handled the same way, so the store never fails a request.
+    '''
+    SERIES = ("daily_sentiment", "indicators")
+    # Reddit search time filters from the densest to the sparsest, at the same limit
+    SEARCH_TIME_FILTERS = ("day", "week", "month", "year", "all")
+
+    def __init__(self, database: MongoDB = None, batch_size: int = 1000):
+        self.database = database
+        self.batch_size = batch_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.database is not None
+
+    def collection(self, name: str):
+        return self.database.get_collection(name)
+
+    # Called at startup, an unreachable database only means every read misses until it is back
+    async def ensure_indexes(self):
+        if not self.enabled:
+            return
+        try:
+            for name in self.SERIES:
+                await self.database.create_indexes(self.collection(name), [(("key", "timestamp"), True)])
+            await self.database.create_indexes(self.collection("posts"), [(("key", "id"), True), (("key", "timestamp"), False)])
+            await self.database.create_indexes(self.collection("coverage"), [(("collection", "key"), True)])
+        except Exception as e:
+            logger.warning("Could not create MongoDB indexes: %s", e)
+
+    ### Replace the rows of [start, end) with `rows` and record the range as covered
+    async def write_series(self, collection: str, key: str, rows: pd.DataFrame, start: str, end: str,
+                           scope: dict = None):
+        '''
+            scope: {"time_filter": "week", "limit": 250} -> the search the rows come from, [start, end) becomes
+                a segment of the coverage, the stored segments only lose the days it rewrites
+        '''
+        if not self.enabled:
+            return
+        try:
+            with timer("store_write"):
+                documents = [{"key": key, **row} for row in rows.to_dict("records")]
+                timestamps = [document["timestamp"] for document in documents]
+                # Rows of the range the new data no longer has go in the same batch
+                await self.database.bulk_upsert(self.collection(collection), documents, keys=("key", "timestamp"),
+                                                prune={"key": key, "timestamp": {"$gte": start, "$lt": end, "$nin": timestamps}})
+                coverage = {"collection": collection, "key": key, "columns": list(rows.columns), "updated_at": time.time()}
+                if scope is None:
+                    coverage.update(start=start, end=end)
+                else:
+                    stored = await self.database.find_one(self.collection("coverage"), {"collection": collection, "key": key})
+                    coverage["segments"] = add_segment(stored.get("segments", []) if stored else [], {
+                        "start": start, "end": end, **scope, "updated_at": coverage["updated_at"]})
+                await self.database.bulk_upsert(self.collection("coverage"), [coverage], keys=("collection", "key"))
+            metrics.inc("store_rows_written_total", len(documents), collection=collection)
+        except Exception as e:
+            logger.warning("Could not store %s %s: %s", collection, key, e)
+
+    ### Rows of [start, end) when the stored coverage holds the whole range, otherwise None
+    async def read_series(self, collection: str, key: str, start: str, end: str, max_age: float = None):
+        '''
+            max_age: 3600 -> coverage written more than an hour ago is a miss (None -> never expires)
+        '''
+        if not self.enabled:
+            return None
+        try:
+            with timer("store_read"):
+                coverage = await self.database.find_one(self.collection("coverage"), {"collection": collection, "key": key})
+                if (coverage is None or coverage["start"] > start or coverage["end"] < end
+                        or (max_age is not None and time.time() - coverage["updated_at"] > max_age)):
+                    metrics.inc("store_reads_total", collection=collection, result="miss")
+                    return None
+
+                columns = coverage["columns"]
+                rows = [document async for document in self.database.stream(
+                    self.collection(collection), {"key": key, "timestamp": {"$gte": start, "$lt": end}},
+                    projection={"_id": 0, **{column: 1 for column in columns}},
+                    sort=[("timestamp", 1)], batch_size=self.batch_size)]
+        except Exception as e:
+            logger.warning("Could not read %s %s: %s", collection, key, e)
+            return None
+
+        metrics.inc("store_reads_total", collection=collection, result="hit")
+        return pd.DataFrame(rows, columns=columns)
+
+    ### Upsert scored posts, a post seen again (e.g. by another time filter) is updated in place
+    async def write_posts(self, key: str, posts: list):
+        if not self.enabled or not posts:
+            return
+        try:
+            with timer("store_write"):
+                await self.database.bulk_upsert(self.collection("posts"), [{"key": key, **post} for post in posts],
+                                                keys=("key", "id"))
+            metrics.inc("store_rows_written_total", len(posts), collection="posts")
+        except Exception as e:
+            logger.warning("Could not store posts %s: %s", key, e)
+
+    # Posts of [start, end), a read error only means they are crawled again
+    async def read_posts(self, key: str, start: str, end: str) -> list:
+        if not self.enabled:
+            return []
+        try:
+            with timer("store_read"):
+                return [document async for document in self.database.stream(
+                    self.collection("posts"), {"key": key, "timestamp": {"$gte": start, "$lt": end}},
+                    projection={"_id": 0, "key": 0}, sort=[("timestamp", 1)], batch_size=self.batch_size)]
+        except Exception as e:
+            logger.warning("Could not read posts %s: %s", key, e)
+            return []
+
+    ### Daily top posts of a query in one subreddit, a date series shared by every time filter and the backfill
+    @staticmethod
+    def social_key(subreddit: str, query: str) -> str:
+        return f"{subreddit.lower()}:{query.lower()}"
+
+    # Stored days of [start, end) written by searches at least as dense as the caller's, whatever part of it they hold
+    async def read_social_days(self, subreddit: str, query: str, start: str, end: str, time_filter: str, limit: int,
+                               max_age: float = None):
+        '''
+            time_filter, limit: the search the caller would crawl [start, end) with, a day only counts as covered
+                when the search that wrote it had at most this time filter and at least this limit,
+                e.g. days of a "year" search of 250 posts don't cover a "week" request of 250
+            max_age: 3600 -> days from the one a segment was last written on stop being covered an hour
+                after that write, a day still open then may have had more posts since
+
+            Returns (rows, covered_start, covered_end) or None when none of the range is covered.
+        '''
+        def segments(coverage):
+            return [segment for segment in coverage.get("segments", []) if self.dense_enough(segment, time_filter, limit)]
+
+        return await self.read_segments("daily_sentiment", self.social_key(subreddit, query), start, end,
+                                        segments, max_age=max_age)
+
+    ### Rows of the part of [start, end) the coverage segments hold, (rows, covered_start, covered_end) or None
+    async def read_segments(self, collection: str, key: str, start: str, end: str, segments=None,
+                            max_age: float = None, whole: bool = False):
+        '''
+            segments: coverage document -> the segments that count, None -> all of them
+            whole: True -> None unless the segments hold all of [start, end)
+        '''
+        if not self.enabled:
+            return None
+        try:
+            with timer("store_read"):
+                coverage = await self.database.find_one(self.collection("coverage"), {"collection": collection, "key": key})
+                covered = None
+                if coverage is not None:
+                    held = segments(coverage) if segments is not None else coverage.get("segments", [])
+                    covered = covered_range(held, start, end, max_age)
+                if covered is None or (whole and covered != (start, end)):
+                    metrics.inc("store_reads_total", collection=collection, result="miss")
+                    return None
+
+                covered_start, covered_end = covered
+                columns = coverage["columns"]
+                rows = [document async for document in self.database.stream(
+                    self.collection(collection), {"key": key, "timestamp": {"$gte": covered_start, "$lt": covered_end}},
+                    projection={"_id": 0, **{column: 1 for column in columns}},
+                    sort=[("timestamp", 1)], batch_size=self.batch_size)]
+        except Exception as e:
+            logger.warning("Could not read %s %s: %s", collection, key, e)
+            return None
+
+        metrics.inc("store_reads_total", collection=collection, result="hit")
+        return pd.DataFrame(rows, columns=columns), covered_start, covered_end
+
+    ### Write the rows of [start, end) the coverage doesn't hold yet, for series whose stored rows never change
+    async def append_series(self, collection: str, key: str, rows: pd.DataFrame, start: str, end: str):
+        if not self.enabled or start >= end:
+            return
+        try:
+            coverage = await self.database.find_one(self.collection("coverage"), {"collection": collection, "key": key})
+        except Exception as e:
+            logger.warning("Could not read coverage %s %s: %s", collection, key, e)
+            return
+        covered = covered_range(coverage.get("segments", []) if coverage else [], start, end)
+        if covered == (start, end):
+            return
+        if covered is not None:
+            # Same span the caller of read_segments would be missing
+            start, end = (start if covered[0] > start else covered[1]), (end if covered[1] < end else covered[0])
+        rows = rows[(rows["timestamp"] >= start) & (rows["timestamp"] < end)]
+        await self.write_series(collection, key, rows, start, end, scope={})
+
+    # Crawled days replace the stored ones, the coverage remembers the search they come from
+    async def write_social_days(self, subreddit: str, query: str, daily: pd.DataFrame, start: str, end: str,
+                                time_filter: str, limit: int):
+        await self.write_series("daily_sentiment", self.social_key(subreddit, query), daily, start, end,
+                                scope={"time_filter": time_filter, "limit": limit})
+
+    # A search over fewer days with at least as many posts finds every post the caller's would
+    @classmethod
+    def dense_enough(cls, segment: dict, time_filter: str, limit: int) -> bool:
+        return (cls.SEARCH_TIME_FILTERS.index(segment["time_filter"]) <= cls.SEARCH_TIME_FILTERS.index(time_filter)
+                and segment["limit"] >= limit)
+
+    ### One series of signal rows per indicator and interval, every window is a range of it
+    @staticmethod
+    def indicator_key(name: str, interval: str) -> str:
+        return f"{name}:{interval}"
+
+    # Rows of [start, end) of every indicator, None unless all of them are stored
+    async def read_indicators(self, names: list, interval: str, start: str, end: str):
+        frames = await asyncio.gather(*(
+            self.read_segments("indicators", self.indicator_key(name, interval), start, end, whole=True)
+            for name in names))
+        if any(frame is None for frame in frames):
+            return None
+        return {name: frame[0] for name, frame in zip(names, frames)}
+
+    # Closed bars never change, only those of [start, end) not stored yet are written
+    async def write_indicators(self, signals: dict, interval: str, start: str, end: str):
+        await asyncio.gather(*(
+            self.append_series("indicators", self.indicator_key(name, interval), rows, start, end)
+            for name, rows in signals.items()))
+
+
+# What a segment says about the data besides its range, e.g. the search that wrote it
+def scope(segment: dict) -> dict:
+    return {field: value for field, value in segment.items() if field not in ("start", "end", "updated_at")}
+
+
+# Market day a write happened on
+def written_on(updated_at: float) -> str:
+    return datetime.fromtimestamp(updated_at, MARKET_TIMEZONE).strftime("%Y-%m-%d")
+
+
+### Coverage segments once `segment` was written, the days it rewrote belong to it alone
+def add_segment(segments: list, segment: dict) -> list:
+    kept = []
+    for stored in segments:
+        for part_start, part_end in ((stored["start"], min(stored["end"], segment["start"])),
+                                     (max(stored["start"], segment["end"]), stored["end"])):
+            if part_start < part_end:
+                kept.append({**stored, "start": part_start, "end": part_end})
+
+    # A segment of the same search that ends where this one starts joins it, unless it still has open days
+    for stored in kept:
+        if (stored["end"] == segment["start"] and stored["end"] <= written_on(stored["updated_at"])
+                and scope(stored) == scope(segment)):
+            kept.remove(stored)
+            segment = {**segment, "start": stored["start"]}
+            break
+    return sorted(kept + [segment], key=lambda stored: stored["start"])
+
+
+# Day number of a timestamp string, "" and "~" are before and after every day
+def day_number(day: str) -> int:
+    if not day[:1].isdigit():
+        return 0 if day < "0" else date.max.toordinal()
+    return date.fromisoformat(day[:10]).toordinal()
+
+
+### Part of [start, end) held by touching segments that leaves the least of it to crawl, None when there is none
+def covered_range(segments: list, start: str, end: str, max_age: float = None):
+    '''
+        The caller crawls from the first to the last day it misses (services.reddit.missing_span),
+        so of every run of touching segments the one leaving the shortest such span is taken.
+    '''
+    ranges = []
+    for segment in sorted(segments, key=lambda segment: segment["start"]):
+        segment_start, segment_end = segment["start"], segment["end"]
+        if max_age is not None and time.time() - segment["updated_at"] > max_age:
+            segment_end = min(segment_end, written_on(segment["updated_at"]))
+        if segment_start >= segment_end:
+            continue
+        if ranges and ranges[-1][1] >= segment_start:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], segment_end))
+        else:
+            ranges.append((segment_start, segment_end))
+
+    best = None
+    for range_start, range_end in ranges:
+        covered_start, covered_end = max(start, range_start), min(end, range_end)
+        if covered_start >= covered_end:
+            continue
+        if covered_start <= start and covered_end >= end:
+            return covered_start, covered_end
+        missing_start = start if covered_start > start else covered_end
+        missing_end = end if covered_end < end else covered_start
+        missing = day_number(missing_end) - day_number(missing_start)
+        if best is None or missing < best[0]:
+            best = (missing, covered_start, covered_end)
+    return best and best[1:]
+
+
+# Persistence is off unless MONGO_URI is set
+MONGO_URI = config("MONGO_URI", default="")
+market_store = MarketStore(MongoDB(MONGO_URI, config("MONGO_DB_NAME", default="marketpulse")) if MONGO_URI else None)
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+from decouple import config
+from fastapi import HTTPException
+from util.metrics import metrics
+from util.util import convert_time_filter, calculate_market_indicators, calculate_market_indicators_many
+
+logger = logging.getLogger(__name__)
+
+# Materialized market indicators: (start_date, end_date, interval) -> {indicator: DataFrame}
+# The z-scores are normalized over the requested window, so every time filter keeps its own table
+MARKET_TABLE = {}
+# key -> when its indicators were computed
+MARKET_TABLE_UPDATED = {}
+
+# Time filters kept warm by the scheduler
+REFRESH_TIME_FILTERS = ["year", "month", "week"]
+
+# Intraday windows (the "day" filter) get new bars all session, a request recomputes one older than this
+INTRADAY_MAX_AGE_MINUTES = config("MARKET_TABLE_INTRADAY_MAX_AGE_MINUTES", default=5, cast=float)
+
+table_locks = {}
+
+
+# Daily windows are refreshed by the scheduler, intraday ones expire
+def is_fresh(key: tuple) -> bool:
+    if key not in MARKET_TABLE:
+        return False
+    return key[2] == "1d" or time.time() - MARKET_TABLE_UPDATED.get(key, 0) <= INTRADAY_MAX_AGE_MINUTES * 60
+
+
+### Compute one window and store it in the table
+async def materialize_market_indicators(start_date, end_date, interval: str, refresh: bool = True):
+    key = (start_date, end_date, interval)
+
+    # Requests for a window that is being computed wait for that computation
+    async with table_locks.setdefault(key, asyncio.Lock()):
+        if refresh or not is_fresh(key):
+            MARKET_TABLE[key] = await calculate_market_indicators(
+                start_date=start_date, end_date=end_date, interval=interval)
+            MARKET_TABLE_UPDATED[key] = time.time()
+
+
+### Read the market indicators of a window, computed once and shared by every request
+async def get_market_indicators(start_date, end_date, interval: str) -> dict:
+    key = (start_date, end_date, interval)
+
+    fresh = is_fresh(key)
+    metrics.inc("market_table_requests_total", result="hit" if fresh else "miss")
+    if not fresh:
+        await materialize_market_indicators(start_date, end_date, interval, refresh=False)
+
+    # Callers are free to modify what they get back
+    return {name: data.copy() for name, data in MARKET_TABLE[key].items()}
+
+
+### Recompute every scheduled window in one pass and drop the ones that rolled over
+async def refresh_market_table():
+    windows = [await convert_time_filter(time_filter=time_filter) for time_filter in REFRESH_TIME_FILTERS]
+    try:
+        results = await calculate_market_indicators_many(windows)
+    except HTTPException as e:
+        # Keep serving the previous table until the provider answers again
+        logger.warning("Market table refresh failed: %s", e.detail)
+        return
+
+    for window, indicators in zip(windows, results):
+        MARKET_TABLE[window] = indicators
+        MARKET_TABLE_UPDATED[window] = time.time()
+
+    today = max(window[1] for window in windows)
+    for key in list(MARKET_TABLE):
+        if key[1] < today:
+            MARKET_TABLE.pop(key, None)
+            MARKET_TABLE_UPDATED.pop(key, None)
+            table_locks.pop(key, None)
+
+
+### Background job refreshing the table every refresh_minutes
+async def run_market_table_scheduler(refresh_minutes: float = 60):
+    while True:
+        try:
+            await refresh_market_table()
+        except Exception:
+            logger.exception("Market table refresh failed")
+        await asyncio.sleep(refresh_minutes * 60)
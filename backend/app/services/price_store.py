@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import tempfile
+import weakref
+import pandas as pd
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import Callable
+from decouple import config
+from util.market_calendar import market_today, trading_days
+from util.metrics import metrics
+
+PROJECT_DIR = Path(__file__).parent.parent
+
+
+### Local OHLCV history, one Parquet file per symbol and interval
+class PriceStore:
+    '''
+        Serves price history from disk and only asks the provider for the bars it has never seen.
+
+        Next to every Parquet file a small JSON file keeps the coverage, i.e. the [start, end) range
+        already requested from the provider, so weekends and holidays inside it are not fetched again.
+        Missing ranges are trimmed to their trading days before asking, a range without any is covered
+        without a download, so an empty answer for the rest is a failed download and is asked again.
+        Bars from today onwards are still forming, so they are always fetched live and never stored.
+    '''
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        # (symbol, interval) -> lock held while that series' gaps are filled, dropped once no request holds
+        # or waits for it, so tickers asked for once don't stay here
+        self.locks = weakref.WeakValueDictionary()
+
+    def _file(self, symbol: str, interval: str, suffix: str) -> Path:
+        name = symbol.replace("/", "_")
+        return self.path / f"{name}_{interval}.{suffix}"
+
+    def read_bars(self, symbol: str, interval: str) -> pd.DataFrame:
+        file = self._file(symbol, interval, "parquet")
+        if not file.exists():
+            return pd.DataFrame()
+        return pd.read_parquet(file)
+
+    def read_coverage(self, symbol: str, interval: str):
+        file = self._file(symbol, interval, "json")
+        if not file.exists():
+            return None
+        with open(file) as f:
+            coverage = json.load(f)
+        return pd.Timestamp(coverage["start"]), pd.Timestamp(coverage["end"])
+
+    # Merge new bars into the stored history, coverage is written last so a crash never over-reports it
+    def write_bars(self, symbol: str, interval: str, bars: pd.DataFrame, coverage: tuple):
+        self.path.mkdir(parents=True, exist_ok=True)
+        # No bars (a range without trading days) only moves the coverage
+        if not bars.empty:
+            stored = self.read_bars(symbol, interval)
+            if not stored.empty:
+                bars = pd.concat([stored, bars])
+            bars = bars.drop_duplicates(subset="Date", keep="last").sort_values("Date").reset_index(drop=True)
+            self._replace(self._file(symbol, interval, "parquet"), lambda f: bars.to_parquet(f, index=False))
+
+        self._replace(self._file(symbol, interval, "json"), lambda f: f.write(
+            json.dumps({"start": coverage[0].isoformat(), "end": coverage[1].isoformat()}).encode()))
+
+    # Written to a temporary file of its own first, processes (gunicorn workers) never share one
+    def _replace(self, file: Path, write: Callable):
+        with tempfile.NamedTemporaryFile(dir=self.path, prefix=f"{file.name}.", suffix=".tmp", delete=False) as f:
+            try:
+                write(f)
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, file)
+
+    # Ranges of [start, end) the stored coverage doesn't have yet
+    @staticmethod
+    def missing_ranges(start: pd.Timestamp, end: pd.Timestamp, coverage) -> list:
+        if coverage is None:
+            return [(start, end)] if start < end else []
+
+        # Gaps between the request and the coverage are fetched too, so coverage stays one range
+        ranges = []
+        if start < coverage[0]:
+            ranges.append((start, coverage[0]))
+        if end > coverage[1]:
+            ranges.append((coverage[1], end))
+        return ranges
+
+    async def get_prices(self, symbols: list, start_date: str, end_date: str, interval: str,
+                         download: Callable[[list, str, str, str], dict]) -> dict:
+        '''
+            Args:
+                symbols (list): Tickers to read.
+                start_date, end_date (str): Requested [start, end) range.
+                interval (str): Bar size, each interval is stored separately.
+                download: sync provider call (symbols, start, end, interval) -> {symbol: bars}
+                    with a datetime "Date" column, run in a worker thread.
+
+            Returns:
+                Dict of symbol -> bars within the range (empty frame when the provider has none).
+        '''
+        start = pd.Timestamp(start_date)
+        end = pd.Timestamp(end_date)
+        today = pd.Timestamp(market_today())
+        stored_end = min(end, today)
+
+        # Only one request at a time fills a series' gaps, the others then find them on disk.
+        # Locks are taken in sorted order, so requests sharing some symbols never deadlock
+        async with AsyncExitStack() as locked:
+            for symbol in sorted(set(symbols)):
+                await locked.enter_async_context(self.locks.setdefault((symbol, interval), asyncio.Lock()))
+            coverage = {symbol: await asyncio.to_thread(self.read_coverage, symbol, interval) for symbol in symbols}
+
+            # Symbols missing the same range are fetched together in one provider call
+            groups = {}
+            for symbol in symbols:
+                for missing in self.missing_ranges(start, stored_end, coverage[symbol]):
+                    groups.setdefault(missing, []).append(symbol)
+
+            metrics.inc("price_store_series_total", len(symbols), interval=interval)
+            metrics.inc("price_store_gaps_total", sum(len(group) for group in groups.values()), interval=interval)
+            for (missing_start, missing_end), group in groups.items():
+                # Weekends and holidays at the ends of the range are not asked for
+                days = trading_days(missing_start, missing_end)
+                fetched = {}
+                if len(days):
+                    fetched = await asyncio.to_thread(download, group, days[0].strftime('%Y-%m-%d'),
+                                                      (days[-1] + pd.Timedelta(days=1)).strftime('%Y-%m-%d'), interval)
+                for symbol in group:
+                    bars = fetched.get(symbol)
+                    if bars is None or bars.empty:
+                        # Trading days without bars are a failed download, they are asked for again next time
+                        if len(days):
+                            continue
+                        bars = pd.DataFrame()
+                    else:
+                        bars = bars[bars["Date"] < today]
+
+                    covered = (missing_start, missing_end)
+                    if coverage[symbol] is not None:
+                        covered = (min(missing_start, coverage[symbol][0]), max(missing_end, coverage[symbol][1]))
+                    await asyncio.to_thread(self.write_bars, symbol, interval, bars, covered)
+                    coverage[symbol] = covered
+
+        frames = {}
+        for symbol in symbols:
+            bars = await asyncio.to_thread(self.read_bars, symbol, interval)
+            if not bars.empty:
+                bars = bars[(bars["Date"] >= start) & (bars["Date"] < stored_end)]
+            frames[symbol] = bars
+
+        # Bars that are still forming come straight from the provider
+        if end > today:
+            live = await asyncio.to_thread(download, symbols, max(start, today).strftime('%Y-%m-%d'),
+                                           end.strftime('%Y-%m-%d'), interval)
+            for symbol in symbols:
+                if live.get(symbol) is not None and not live[symbol].empty:
+                    frames[symbol] = pd.concat([frames[symbol], live[symbol]]).reset_index(drop=True)
+
+        return {symbol: bars.reset_index(drop=True) for symbol, bars in frames.items()}
+
+
+price_store = PriceStore(config("PRICE_STORE_DIR", default=str(PROJECT_DIR / "data" / "prices")))
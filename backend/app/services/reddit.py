@@ -1,85 +1,129 @@
-import asyncpraw
 import asyncio
 import math
 import os
+import re
 from fastapi import HTTPException
 import pandas as pd
 from decouple import config
-from datetime import datetime
-from zoneinfo import ZoneInfo
+from datetime import date, datetime, timedelta
 from services.resource_init import MODELS
+from services.reddit_crawler import crawl, merge_searches, unique_submissions
+from services.market_store import market_store
+from util.market_calendar import MARKET_TIMEZONE, market_today
+from util.metrics import timed, timer, waited
+
+# Reddit client, built on first use so importing the app doesn't import asyncpraw or need the credentials
+reddit = None
+
+
+def get_reddit():
+    global reddit
+    if reddit is None:
+        import asyncpraw
+        reddit = asyncpraw.Reddit(
+            client_id=config("REDDIT_CLIENT_ID"),
+            client_secret=config("REDDIT_SECRET"),
+            user_agent=config("REDDIT_USER_AGENT"),
+            username=config("REDDIT_USERNAME"),
+            password=config("REDDIT_PASSWORD"),
+        )
+    return reddit
+
+# Sentiment scoring is CPU bound, Reddit requests go through the crawler's adaptive I/O limit
+cpu_semaphore = asyncio.Semaphore(config("SENTIMENT_CONCURRENCY", default=os.cpu_count() * 2, cast=int))
+
+# Posts scored at once per request and the size of the queues between the pipeline stages
+PIPELINE_WORKERS = config("SENTIMENT_PIPELINE_WORKERS", default=16, cast=int)
+PIPELINE_QUEUE_SIZE = config("SENTIMENT_PIPELINE_QUEUE_SIZE", default=64, cast=int)
+
+# Scored posts written to the store per batch while a search is still being scored
+STORE_BATCH_SIZE = config("SOCIAL_STORE_BATCH_SIZE", default=200, cast=int)
 
-# Initialize the Reddit client
-reddit = asyncpraw.Reddit(
-    client_id=config("REDDIT_CLIENT_ID"),
-    client_secret=config("REDDIT_SECRET"),
-    user_agent=config("REDDIT_USER_AGENT"),
-    username=config("REDDIT_USERNAME"),
-    password=config("REDDIT_PASSWORD"),
-)
+# Stored days count as covered, the one they were written on included, for this long after the write
+SOCIAL_STORE_MAX_AGE_MINUTES = config("SOCIAL_STORE_MAX_AGE_MINUTES", default=60, cast=float)
 
-# Take into account the computer resource
-semaphore = asyncio.Semaphore(os.cpu_count() * 2) 
 
 
+### Subreddit names of "technology", "technology+stocks", "technology,stocks" or a list, in the given order
+def subreddit_names(subreddit) -> list:
+    names = subreddit if isinstance(subreddit, (list, tuple)) else re.split(r"[+,]", subreddit)
+    unique = {}
+    for name in names:
+        name = name.strip().removeprefix("r/")
+        if name:
+            unique.setdefault(name.lower(), name)
+    if not unique:
+        raise HTTPException(status_code=400, detail="No subreddit given")
+    return list(unique.values())
 
-### Fetch reddit posts from Reddit API
-# limit = 251 (trading days in a year)
-async def fetch_reddit_posts(
-        subreddit_name: str, query: str, 
-        time_filter: str, limit: int) -> list:
+
+### Reddit posts in the order they finish loading, `rank` is the submission's position in the search
+async def stream_reddit_posts(subreddit_name, query: str, time_filter: str, limit: int, created_between: tuple = None,
+                              known: dict = None):
     '''
-    Args:
-        subreddit_name (str): The name of the subreddit (e.g., 'stocks').
-        query (str): The search query within the subreddit.
-        time_filter: search the submissions (hour, day, week, month, year, all)
-        batch_size (int): Number of posts to fetch per batch.
-        start_date (datetime): Start of the time range.
+        subreddit_name: "technology" or several, e.g. ["technology", "stocks"] -> searched concurrently,
+            `limit` is the budget of unique posts shared by all of them
+        created_between: (start, end) UTC epoch seconds -> only submissions created in [start, end) are loaded
+        known: {id: stored post} -> these submissions yield the stored record instead of loading their comments
     '''
-    
-    subreddit = await reddit.subreddit(subreddit_name)
-
-    # Run the processing of the reddit post concurrently
-    async def fetch_one_post(submission: asyncpraw.models.Submission):
-        async with semaphore:
-            # Top 10 most interacted comment
-            submission.comment_sort = "top"
-            submission.comment_limit = 10
-            await submission.load()
-            await submission.comments.replace_more(limit=0)
-
-            interest_score = engagement_rate(submission)
-
-            time_stamp = None
-            if time_filter in ["year", "month", "week"]:
-                time_stamp = datetime.fromtimestamp(submission.created_utc, ZoneInfo("US/Eastern")).strftime('%Y-%m-%d')
-            elif time_filter == "day":
-                time_stamp = datetime.fromtimestamp(submission.created_utc, ZoneInfo("US/Eastern")).strftime('%Y-%m-%d %H:%M:%S')
-            
-            return {
-                "title": submission.title,
-                "timestamp": time_stamp,
-                "interest_score": interest_score,
-                "article_url": submission.url, 
-                "comments": [(comment.body, comment.score)  for comment in submission.comments]
-            }
-
-    # Queue the tasks to run concurrently
-    tasks = []
-    async for submission in subreddit.search(f'title:{query}', time_filter=time_filter, sort="top", limit=limit):
-        tasks.append(fetch_one_post(submission))
-
-    posts = await asyncio.gather(*tasks, return_exceptions=False)
-
-    # Sort posts by timestamp
-    sorted_posts = sorted(posts, key=lambda x: x["timestamp"])
-    
-    return sorted_posts
+    client = get_reddit()
+    searches = []
+    for name in subreddit_names(subreddit_name):
+        subreddit = await client.subreddit(name)
+        submissions = subreddit.search(f'title:{query}', time_filter=time_filter, sort="top", limit=limit)
+        if created_between is not None:
+            submissions = created_in(submissions, *created_between)
+        searches.append(submissions)
+
+    # Cross-posts and repeats of an article are dropped from the listings, before their comments load
+    submissions = unique_submissions(searches[0] if len(searches) == 1 else merge_searches(searches), limit)
+
+    # Posts load concurrently while the search is still paging, failing ones are skipped
+    async for post in crawl(submissions, load_post, client=client, buffer=PIPELINE_QUEUE_SIZE,
+                            known=(lambda submission: known.get(submission.id)) if known else None):
+        yield post
+
+
+
+# Search results are ranked by score, not date, out of range ones are dropped before their comments load
+async def created_in(submissions, start: float, end: float):
+    async for submission in submissions:
+        if start <= submission.created_utc < end:
+            yield submission
+
+
+
+### Load the top comments of a submission and turn it into a post record
+async def load_post(submission: "asyncpraw.models.Submission") -> dict:
+    # Top 10 most interacted comment
+    submission.comment_sort = "top"
+    submission.comment_limit = 10
+    with timer("reddit_load"):
+        await submission.load()
+        await submission.comments.replace_more(limit=0)
+
+    interest_score = engagement_rate(submission)
+
+    # Market time to the second, the daily and hourly rows are taken from it (see DailyTopPosts)
+    time_stamp = datetime.fromtimestamp(submission.created_utc, MARKET_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')
+
+    return {
+        "id": submission.id,
+        "subreddit": str(submission.subreddit),
+        "title": submission.title,
+        "timestamp": time_stamp,
+        "interest_score": interest_score,
+        "article_url": submission.url, 
+        # Only the first 512 characters of a comment are scored, the top comment is kept whole for the response
+        "comments": [(comment.body if i == 0 else comment.body[:512], comment.score)
+                     for i, comment in enumerate(submission.comments)]
+    }
 
 
 
 ### Calculate the influential index of a submission based of engagement rate in the comments volume, 
-def engagement_rate(submission: asyncpraw.models.Submission, max_interest: int=100000) -> float:
+def engagement_rate(submission: "asyncpraw.models.Submission", max_interest: int=100000) -> float:
+    from asyncpraw.models import MoreComments
     try:
         # Metrics:
         post_score = submission.score
@@ -91,7 +135,7 @@ def engagement_rate(submission: asyncpraw.models.Submission, max_interest: int=1
         post_interest = post_score * upvote_ratio
         discussion_volume = total_comments
         discussion_quality = (
-            sum(comment.score for comment in top_comments if not isinstance(comment, asyncpraw.models.MoreComments)) 
+            sum(comment.score for comment in top_comments if not isinstance(comment, MoreComments)) 
             / (1 + math.log(post_score + 1) + math.log(total_comments + 1))
         )
         
@@ -108,52 +152,304 @@ def engagement_rate(submission: asyncpraw.models.Submission, max_interest: int=1
 
 
 ### Calculate social sentiment
-async def fetch_social_sentiment(subreddit: str, query: str, time_filter: str, limit: int = 250) -> pd.DataFrame:
+@timed("social_sentiment")
+async def fetch_social_sentiment(subreddit, query: str, time_filter: str, limit: int = 250) -> pd.DataFrame:
     """
     API endpoint to fetch Reddit posts from a subreddit.
 
     Args:
-        subreddit (str): Subreddit name.
+        subreddit (str | list): Subreddit name, or several ("technology+stocks" or a list) sharing `limit`,
+            the daily top post is then picked across all of them.
         query (str): query within the subreddit
         sort_by (str): sort the post by hot, popularity, best, relevance
         limit (int): Number of posts to fetch (default: 10).
 
     Returns:
-        JSON response with that subreddit posts sentiment score
+        JSON response with that subreddit posts sentiment score, one row per day ("day" filter: per hour)
     """
     try:
-        # Run the the sentiment analysis in parrallel
-        async def analyze_post_sentiment(post: dict):
-            async with semaphore:
-                sentiment = await calculate_post_sentiment(post['title'], post['comments'], post["interest_score"])
-                return {
-                    "timestamp": post["timestamp"],
-                    "sentiment": sentiment,
-                    "article_url": post["article_url"],
-                    "title": post["title"],
-                    "top_comment": post["comments"][0][0] if len(post["comments"]) > 0 else "",
-                }
-
-        posts = await fetch_reddit_posts(subreddit, query, time_filter, limit)
-        
-        tasks = [analyze_post_sentiment(post) for post in posts]
-        
-        analyzed_sentiment = await asyncio.gather(*tasks, return_exceptions=False)
-        # TODO: store data in MongoDB and use Redis for fast retrieval
-                                                
-        analyzed_sentiment = pd.DataFrame(analyzed_sentiment)
-
-        # Get the top post of each day
-        analyzed_sentiment['Abs'] = analyzed_sentiment['sentiment'].abs()
-        analyzed_sentiment = analyzed_sentiment.loc[analyzed_sentiment.groupby('timestamp')['Abs'].idxmax()]
-        analyzed_sentiment = analyzed_sentiment.drop(columns=['Abs'])
-
-        return analyzed_sentiment
+        subreddits = subreddit_names(subreddit)
+        start, end = social_range(time_filter)
+        # The store keeps days, the hourly rows of the "day" filter are picked from its posts
+        hourly = time_filter == "day"
+
+        # Days are stored per subreddit, those of a search at least as dense as this one's are reused
+        # and only the missing ones are crawled
+        scope = search_time_filter(start), search_share(limit, subreddits)
+        stored = await asyncio.gather(*(
+            market_store.read_social_days(name, query, start, end, *scope, max_age=SOCIAL_STORE_MAX_AGE_MINUTES * 60)
+            for name in subreddits))
+        span = missing_span(start, end, stored)
+
+        crawled = {}
+        if span is not None:
+            crawled = await crawl_social_days(subreddits, query, *span, limit, hourly=hourly)
+
+        stored_posts = {}
+        if hourly:
+            stored_posts = dict(zip(subreddits, await asyncio.gather(*(
+                market_store.read_posts(market_store.social_key(name, query), start, end) for name in subreddits))))
+
+        with timer("sentiment_postprocess"):
+            # The strongest post of each day (hour) across the subreddits, stored ones outside the crawl as they were
+            daily = DailyTopPosts(hourly=hourly)
+            outside_span = lambda timestamp: span is None or timestamp < span[0] or timestamp >= span[1]
+            for order, (name, days) in enumerate(zip(subreddits, stored)):
+                if hourly:
+                    for post in stored_posts[name]:
+                        if outside_span(post["timestamp"]):
+                            daily.add(ScoredPost.from_record(post), rank=order)
+                elif days is not None:
+                    for row in days[0].itertuples(index=False):
+                        if outside_span(row.timestamp):
+                            daily.add(row, rank=order)
+                if name in crawled:
+                    for row in crawled[name].itertuples(index=False):
+                        daily.add(row, rank=order)
+            return daily.frame()
 
     except Exception as e:
         # TODO:Logging in the server and send a payload to the client
         raise HTTPException(status_code=500, detail=str(e))
-   
+
+
+
+# Days each time filter analyzes, today included
+TIME_FILTER_DAYS = {"day": 2, "week": 7, "month": 30, "year": 365}
+
+### [start, end) market days of a time filter as "%Y-%m-%d" strings, "all" starts before any post
+def social_range(time_filter: str, today: date = None) -> tuple:
+    today = today or market_today().date()
+    end = str(today + timedelta(days=1))
+    if time_filter not in TIME_FILTER_DAYS:
+        return "", end
+    return str(today - timedelta(days=TIME_FILTER_DAYS[time_filter] - 1)), end
+
+
+### Smallest Reddit time filter still reaching back to the `start` day
+def search_time_filter(start: str, today: date = None) -> str:
+    if not start:
+        return "all"
+    days = ((today or market_today().date()) - date.fromisoformat(start)).days
+    for time_filter, max_days in (("day", 1), ("week", 7), ("month", 30), ("year", 365)):
+        if days < max_days:
+            return time_filter
+    return "all"
+
+
+# UTC epoch seconds of a market day's midnight, "" is before any post
+def day_epoch(day: str) -> float:
+    if not day:
+        return 0.0
+    return datetime.combine(date.fromisoformat(day), datetime.min.time(), MARKET_TIMEZONE).timestamp()
+
+
+### Smallest [start, end) holding every day of the range some subreddit has no stored row for, None when all do
+def missing_span(start: str, end: str, stored: list):
+    '''
+        stored: per subreddit (rows, covered_start, covered_end) of MarketStore.read_social_days, or None
+    '''
+    gaps = []
+    for days in stored:
+        if days is None:
+            gaps.append((start, end))
+            continue
+        _, covered_start, covered_end = days
+        if covered_start > start:
+            gaps.append((start, covered_start))
+        if covered_end < end:
+            gaps.append((covered_end, end))
+    if not gaps:
+        return None
+    return min(gap[0] for gap in gaps), max(gap[1] for gap in gaps)
+
+
+# Posts each subreddit gets of a search limit they share, their listings take turns (see merge_searches)
+def search_share(limit: int, subreddits: list) -> int:
+    return limit // len(subreddits)
+
+
+### Crawl and score the posts of [start, end), returns the daily (hourly) top posts of each subreddit
+async def crawl_social_days(subreddits: list, query: str, start: str, end: str, limit: int, hourly: bool = False) -> dict:
+    '''
+        Posts already in the store keep their sentiment, only new ones load their comments and reach the model.
+        The daily rows and new posts of every subreddit are written back, with the range as covered by this search.
+        hourly: True -> the returned frames have a row per hour, what is stored stays daily
+    '''
+    names = {name.lower(): name for name in subreddits}
+    time_filter = search_time_filter(start)
+    stored_posts = await asyncio.gather(*(
+        market_store.read_posts(market_store.social_key(name, query), start, end) for name in subreddits))
+    known = {post["id"]: post for posts in stored_posts for post in posts}
+
+    # Run the the sentiment analysis in parrallel
+    async def analyze_post_sentiment(post: dict):
+        async with waited(cpu_semaphore, "post_sentiment"):
+            sentiment = await calculate_post_sentiment(post['title'], post['comments'], post["interest_score"])
+            return scored_post(post, sentiment)
+
+    # search -> load -> score -> aggregate, scoring starts on the first loaded post
+    # while later ones are still downloading, bounded queues hold back whichever side is ahead
+    posts = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    scored = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    done = object()
+
+    async def load_posts():
+        try:
+            async for post in stream_reddit_posts(subreddits, query, time_filter, limit,
+                                                  created_between=(day_epoch(start), day_epoch(end)), known=known):
+                # A stored post is already scored
+                await (scored.put(ScoredPost.from_record(post)) if post["id"] in known else posts.put(post))
+            for _ in range(PIPELINE_WORKERS):
+                await posts.put(done)
+        except Exception as e:
+            await scored.put(e)
+
+    async def score_posts():
+        try:
+            while (post := await posts.get()) is not done:
+                await scored.put(await analyze_post_sentiment(post))
+            await scored.put(done)
+        except Exception as e:
+            await scored.put(e)
+
+    tasks = [asyncio.create_task(load_posts())] + [asyncio.create_task(score_posts()) for _ in range(PIPELINE_WORKERS)]
+    # Only the strongest post of each day stays in memory, the others go to the store in batches
+    daily = {name: DailyTopPosts() for name in subreddits}
+    hours = {name: DailyTopPosts(hourly=True) for name in subreddits} if hourly else {}
+    unstored = {name: [] for name in subreddits}
+    try:
+        finished = 0
+        while finished < PIPELINE_WORKERS:
+            item = await scored.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is done:
+                finished += 1
+                continue
+
+            name = names.get(item.subreddit.lower(), subreddits[0])
+            daily[name].add(item)
+            if hourly:
+                hours[name].add(item)
+            if market_store.enabled and item.id not in known:
+                unstored[name].append(item)
+                if len(unstored[name]) >= STORE_BATCH_SIZE:
+                    await market_store.write_posts(market_store.social_key(name, query),
+                                                   [post.record() for post in unstored[name]])
+                    unstored[name] = []
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    frames = {name: daily[name].frame() for name in subreddits}
+    await asyncio.gather(*(coroutine for name in subreddits for coroutine in (
+        market_store.write_posts(market_store.social_key(name, query), [post.record() for post in unstored[name]]),
+        market_store.write_social_days(name, query, frames[name], start, end, time_filter,
+                                       search_share(limit, subreddits)))))
+    if hourly:
+        return {name: hours[name].frame() for name in subreddits}
+    return frames
+
+
+
+### Scored post, what the store keeps for every post, fields in slots instead of a dict per post
+class ScoredPost:
+    __slots__ = ("timestamp", "sentiment", "article_url", "title", "top_comment", "rank", "id", "subreddit",
+                 "interest_score")
+
+    def __init__(self, timestamp: str, sentiment: float, article_url: str, title: str, top_comment: str,
+                 rank: int, id: str, subreddit: str, interest_score: float):
+        self.timestamp = timestamp
+        self.sentiment = sentiment
+        self.article_url = article_url
+        self.title = title
+        self.top_comment = top_comment
+        self.rank = rank
+        self.id = id
+        self.subreddit = subreddit
+        self.interest_score = interest_score
+
+    # From a stored post, `rank` is this search's
+    @classmethod
+    def from_record(cls, record: dict) -> "ScoredPost":
+        return cls(**{field: record.get(field) for field in cls.__slots__})
+
+    # Stored document, the search rank only means something to the request that crawled it
+    def record(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__ if field != "rank"}
+
+
+def scored_post(post: dict, sentiment: float) -> ScoredPost:
+    return ScoredPost(
+        timestamp=post["timestamp"],
+        sentiment=sentiment,
+        article_url=post["article_url"],
+        title=post["title"],
+        top_comment=post["comments"][0][0] if len(post["comments"]) > 0 else "",
+        rank=post["rank"],
+        id=post["id"],
+        subreddit=post["subreddit"],
+        interest_score=post["interest_score"],
+    )
+
+
+### The post with the strongest sentiment of each day (or hour), kept while posts are being scored
+class DailyTopPosts:
+    '''
+        Picks what sorting every post by (day, rank) and taking the largest |sentiment| of each
+        day picks, ties go to the better ranked post. Only one row per day is held, as a tuple,
+        instead of every scored post until the end.
+
+        hourly: True -> one row per hour ("%Y-%m-%d %H:00:00"), what the "day" filter analyzes
+    '''
+    __slots__ = ("best", "hourly")
+    COLUMNS = ["timestamp", "sentiment", "article_url", "title", "top_comment"]
+
+    def __init__(self, hourly: bool = False):
+        # day -> (|sentiment|, rank, row)
+        self.best = {}
+        self.hourly = hourly
+
+    # post: a ScoredPost or a row with the COLUMNS as attributes, rank: its search rank when it has none
+    def add(self, post, rank: int = None):
+        if post.timestamp is None:
+            return
+        bucket = self.bucket(post.timestamp)
+        rank = post.rank if rank is None else rank
+        sentiment = post.sentiment
+        # Like idxmax, a post without a sentiment never beats one with it
+        strength = abs(sentiment) if sentiment == sentiment else -1.0
+        current = self.best.get(bucket)
+        if current is None or strength > current[0] or (strength == current[0] and rank < current[1]):
+            self.best[bucket] = (strength, rank, (bucket, sentiment, post.article_url, post.title, post.top_comment))
+
+    # Posts stored before they had a time of day fall in their day's first hour
+    def bucket(self, timestamp: str) -> str:
+        if not self.hourly:
+            return timestamp[:10]
+        return f"{timestamp[:13]}:00:00" if len(timestamp) > 10 else f"{timestamp} 00:00:00"
+
+    def frame(self) -> pd.DataFrame:
+        return pd.DataFrame([self.best[bucket][2] for bucket in sorted(self.best)], columns=self.COLUMNS)
+
+
+def daily_top_posts(scored_posts: list) -> pd.DataFrame:
+    daily = DailyTopPosts()
+    for post in scored_posts:
+        daily.add(post)
+    return daily.frame()
+
+
+# Daily rows of hourly ones (the "day" filter), sentiment post-processing is daily
+def daily_rows(rows: pd.DataFrame) -> pd.DataFrame:
+    if not rows["timestamp"].astype(str).str.len().gt(10).any():
+        return rows
+    daily = DailyTopPosts()
+    for rank, row in enumerate(rows.itertuples(index=False)):
+        daily.add(row, rank=rank)
+    return daily.frame()
+
 
 
 ### Analyze each submission sentiment
@@ -161,15 +457,18 @@ async def calculate_post_sentiment(title: str, comments: list, interest_score: f
     try:
         total_votes = sum(comment[1] for comment in comments) or 1 # avoid division by 0
         sentiment_scores = []
-        
-        # Run the model for comments sentiment analysis
-        for comment in comments:
-            # Model max input token is 512
-            sentiments = await asyncio.to_thread(
-                MODELS['social_sentiment']["predict"], 
-                comment[0][:512]
+
+        # Queue the title and every comment at once so they land in the same inference batches
+        # Model max input token is 512
+        predict = MODELS['social_sentiment']["predict"]
+        with timer("inference_wait"):
+            title_sentiment, *comment_sentiments = await asyncio.gather(
+                predict(title),
+                *(predict(comment[0][:512]) for comment in comments)
                 )
-        
+
+        # Run the model for comments sentiment analysis
+        for comment, sentiments in zip(comments, comment_sentiments):
             sentiment_scores.append({
                 "NEGATIVE": sentiments[0],
                 "POSITIVE": sentiments[1],
@@ -180,13 +479,6 @@ async def calculate_post_sentiment(title: str, comments: list, interest_score: f
         comments_negative_score = sum(s["NEGATIVE"] * s["weight"] for s in sentiment_scores)
         comments_positive_score = sum(s["POSITIVE"] * s["weight"] for s in sentiment_scores)
 
-        
-        # Run the model for title sentiment analysis
-        title_sentiment = await asyncio.to_thread(
-            MODELS['social_sentiment']["predict"],
-            title
-            )
-
         overall_negative_score = title_sentiment[0] * title_weight + comments_negative_score * comments_weight
         overall_positive_score = title_sentiment[1] * title_weight + comments_positive_score * comments_weight
 
@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from typing import AsyncIterator, Awaitable, Callable
+from urllib.parse import urlsplit
+from asyncprawcore.exceptions import RequestException, ServerError, TooManyRequests
+from decouple import config
+from util.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Worth another try: network errors, Reddit 5xx, rate limited, timeouts
+TRANSIENT_ERRORS = (RequestException, ServerError, TooManyRequests, asyncio.TimeoutError)
+
+
+### Concurrency limit for Reddit requests that follows latency and the rate limit budget
+class AdaptiveLimiter:
+    '''
+        Works like a semaphore whose size changes: it grows by one while requests are fast and
+        every slot is busy, shrinks by one when responses get slow and halves when Reddit throttles.
+        Once less than one request per second is left until the rate limit window resets, it allows
+        no more requests in flight than that budget sustains at the observed latency.
+
+        target_latency: 2 -> seconds per request considered healthy
+    '''
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 32, target_latency: float = 2.0):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.active = 0
+        self.latency = None
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        metrics.observe("semaphore_wait_seconds", time.perf_counter() - start, stage="reddit_io")
+
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    async def record(self, latency: float = None, throttled: bool = False):
+        previous = self.limit
+        if throttled:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif latency is not None:
+            # Smoothed latency so one slow response doesn't halve the crawl
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if self.latency > 2 * self.target_latency:
+                self.limit = max(self.minimum, self.limit - 1)
+            elif self.latency < self.target_latency and self.active >= self.limit:
+                self.limit = min(self.maximum, self.limit + 1)
+        metrics.set("reddit_io_limit", self.limit)
+        if self.limit > previous:
+            # Requests waiting for a slot only check again when woken
+            async with self.condition:
+                self.condition.notify_all()
+
+    # remaining requests until the rate limit window resets in `reset_in` seconds
+    def apply_rate_limit(self, remaining: float, reset_in: float):
+        if remaining is None or reset_in is None or self.latency is None:
+            return
+        metrics.set("reddit_rate_limit_remaining", remaining)
+        # Plenty of budget left for this window, bursts are fine
+        if remaining >= reset_in:
+            return
+        sustainable = int(remaining / max(reset_in, 1) * self.latency)
+        self.limit = max(self.minimum, min(self.limit, sustainable))
+        metrics.set("reddit_io_limit", self.limit)
+
+
+# Shared by every crawl, so concurrent requests together stay within Reddit's budget
+io_limiter = AdaptiveLimiter(
+    initial=config("REDDIT_IO_CONCURRENCY", default=8, cast=int),
+    maximum=config("REDDIT_IO_MAX_CONCURRENCY", default=32, cast=int),
+    target_latency=config("REDDIT_TARGET_LATENCY_SECONDS", default=2.0, cast=float),
+)
+
+
+# Remaining requests and seconds until reset as asyncpraw last saw them in the response headers
+def rate_limit_state(client) -> tuple:
+    limiter = getattr(getattr(client, "_core", None), "_rate_limiter", None)
+    remaining = getattr(limiter, "remaining", None)
+    reset_timestamp = getattr(limiter, "reset_timestamp", None)
+    reset_in = reset_timestamp - time.time() if reset_timestamp is not None else None
+    return remaining, reset_in
+
+
+### Run a Reddit request under the I/O limit, transient errors are retried with exponential backoff
+async def with_retries(call: Callable[[], Awaitable], client=None, limiter: AdaptiveLimiter = io_limiter,
+                       attempts: int = 3, base_delay: float = 0.5):
+    for attempt in range(attempts):
+        try:
+            async with limiter:
+                start = time.perf_counter()
+                result = await call()
+                # Still holding the slot, so a saturated limiter can tell it is saturated
+                await limiter.record(latency=time.perf_counter() - start)
+            limiter.apply_rate_limit(*rate_limit_state(client))
+            return result
+
+        except TRANSIENT_ERRORS as e:
+            await limiter.record(throttled=isinstance(e, TooManyRequests))
+            if attempt == attempts - 1:
+                raise
+            metrics.inc("reddit_retries_total", error=type(e).__name__)
+            # Jitter so retries of a burst don't hit Reddit at the same moment again
+            await asyncio.sleep(base_delay * 2 ** attempt * (1 + random.random()))
+
+
+### Load submissions while the search is still paging, posts come out as soon as they are loaded
+async def crawl(submissions: AsyncIterator, load: Callable[[object], Awaitable[dict]], client=None,
+                buffer: int = None, known: Callable[[object], dict] = None) -> AsyncIterator[dict]:
+    '''
+        submissions: async iterator of submissions, e.g. subreddit.search(...)
+        load: submission -> post record, retried on transient errors
+        known: submission -> stored post record or None, a stored one comes out as it is, without a request,
+            so it never holds an I/O slot or tells the limiter about a latency Reddit didn't have
+        buffer: 64 -> at most 64 submissions loading or waiting for the consumer, the search pauses meanwhile
+        Posts get a `rank`, the submission's position in the search, since they come out in completion order.
+        Posts that still fail are logged and skipped, they don't fail the crawl.
+    '''
+    queue = asyncio.Queue()
+    tasks = []
+    finished = object()
+    capacity = asyncio.Semaphore(buffer) if buffer else None
+
+    async def load_one(rank: int, submission):
+        try:
+            stored = known(submission) if known is not None else None
+            record = stored if stored is not None else await with_retries(lambda: load(submission), client=client)
+            post = {**record, "rank": rank}
+        except Exception as e:
+            logger.warning("Skipping submission %s: %s", getattr(submission, "id", "?"), e)
+            metrics.inc("reddit_posts_skipped_total")
+            post = None
+        await queue.put(post)
+
+    async def search():
+        try:
+            async for submission in submissions:
+                if capacity is not None:
+                    await capacity.acquire()
+                tasks.append(asyncio.create_task(load_one(len(tasks), submission)))
+            await asyncio.gather(*tasks)
+        finally:
+            await queue.put(finished)
+
+    search_task = asyncio.create_task(search())
+    try:
+        while (post := await queue.get()) is not finished:
+            if capacity is not None:
+                capacity.release()
+            if post is not None:
+                yield post
+        # Errors of the search itself are not skipped
+        await search_task
+    finally:
+        search_task.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+### Round-robin over several searches, one submission of each per round so every source gets its share
+async def merge_searches(searches: list) -> AsyncIterator:
+    active = list(searches)
+    finished = object()
+    while active:
+        # Each round pages the searches concurrently
+        results = await asyncio.gather(*(anext(search, finished) for search in active))
+        active = [search for search, result in zip(active, results) if result is not finished]
+        for result in results:
+            if result is not finished:
+                yield result
+
+
+# Tracking parameters don't make a different article: utm_* and these exact names (ref_id, reference, ... do)
+IGNORED_QUERY_PREFIX = "utm_"
+IGNORED_QUERY_PARAMS = {"ref", "ref_src", "ref_url", "fbclid", "gclid"}
+
+
+def is_tracking_param(pair: str) -> bool:
+    name = pair.split("=", 1)[0].lower()
+    return name.startswith(IGNORED_QUERY_PREFIX) or name in IGNORED_QUERY_PARAMS
+
+
+def normalize_url(url: str) -> str:
+    if not url:
+        return ""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().removeprefix("www.").removeprefix("old.")
+    query = "&".join(sorted(pair for pair in parts.query.split("&") if pair and not is_tracking_param(pair)))
+    return f"{host}{parts.path.rstrip('/')}" + (f"?{query}" if query else "")
+
+
+def normalize_title(title: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", (title or "").lower()).split())
+
+
+# Everything that identifies the article behind a submission, read from the listing without loading it
+def submission_keys(submission) -> list:
+    keys = [("id", submission.id)]
+    parent = getattr(submission, "crosspost_parent", None)
+    if parent:
+        # Crossposts point at the original as t3_<id>
+        keys.append(("id", parent.split("_", 1)[-1]))
+    url = normalize_url(getattr(submission, "url", ""))
+    if url:
+        keys.append(("url", url))
+    title = normalize_title(getattr(submission, "title", ""))
+    if title:
+        keys.append(("title", title))
+    return keys
+
+
+### Drop crossposts and submissions of an article already seen, stop after `limit` unique ones
+async def unique_submissions(submissions: AsyncIterator, limit: int = None) -> AsyncIterator:
+    '''
+        Runs on the search listing, so duplicates never load their comments or reach the model.
+        The first submission of an article wins, with merge_searches that is the best ranked one.
+    '''
+    seen = set()
+    count = 0
+    async for submission in submissions:
+        keys = submission_keys(submission)
+        duplicate = next((kind for kind, value in keys if (kind, value) in seen), None)
+        seen.update(keys)
+        if duplicate is not None:
+            metrics.inc("reddit_duplicates_skipped_total", match=duplicate)
+            continue
+        yield submission
+        count += 1
+        if limit is not None and count >= limit:
+            return
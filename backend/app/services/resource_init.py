@@ -1,45 +1,267 @@
+import asyncio
+import logging
+import time
 from fastapi import FastAPI
-from torch.nn.functional import softmax
-from optimum.onnxruntime import ORTModelForSequenceClassification
-from transformers import AutoTokenizer
+import numpy as np
 from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import Awaitable, Callable
+from decouple import config
+from services.batch_inference import BatchInferenceEngine
+from services.inference_server import RemoteModel, INFERENCE_SOCKET
+from services.sentiment_cache import SentimentCache
+from services.market_table import run_market_table_scheduler
+from services.job_queue import analysis_jobs
+from services.market_store import market_store
+from util.metrics import metrics, timed, timer, monitor_event_loop_lag, SIZE_BUCKETS
+logger = logging.getLogger(__name__)
+
 # Dict to hold preloaded pretrained models
 MODELS = {}
 
-# TODO: convert model ONX runtime for faster inference
+PROJECT_DIR = Path(__file__).parent.parent
+MODEL_PATH = PROJECT_DIR / 'onnx_model'
+MODEL_FILE = "model_quantized.onnx"
+
+# local -> every process loads its own model, remote -> the inference server hosts it (see gunicorn.conf.py)
+INFERENCE_MODE = config("INFERENCE_MODE", default="local")
+
+# Threads per ONNX session, 0 lets onnxruntime use one per core. With N processes running
+# a model each, intra-op threads should add up to the cores so they don't fight over them
+ONNX_INTRA_OP_THREADS = config("ONNX_INTRA_OP_THREADS", default=0, cast=int)
+ONNX_INTER_OP_THREADS = config("ONNX_INTER_OP_THREADS", default=1, cast=int)
+
+# background -> serve right away and load the model meanwhile, startup -> load it before serving
+MODEL_LOAD = config("MODEL_LOAD", default="background")
+
+# Short and long texts, so the warm-up runs the length buckets requests use
+WARMUP_TEXTS = ["Stocks rally", "The company reported record revenue this quarter and raised its guidance",
+                " ".join(["Analysts are divided on whether the new product line can offset slowing growth."] * 8)]
+
+# Longest wait between two attempts at loading the model or reaching the inference server
+MODEL_RETRY_MAX_SECONDS = config("MODEL_RETRY_MAX_SECONDS", default=60, cast=float)
+
+# Where the model load stands, reported by /health
+MODEL_STATE = {"status": "loading", "error": None, "load_seconds": None}
+model_ready = asyncio.Event()
+
+SENTIMENT_CACHE_PATH = config("SENTIMENT_CACHE_PATH", default=str(PROJECT_DIR / "data" / "sentiment_cache.sqlite"))
+
+
+def onnx_session_options() -> "onnxruntime.SessionOptions":
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+    options.inter_op_num_threads = ONNX_INTER_OP_THREADS
+    # The graph is a single chain of operators, parallel execution only adds scheduling
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+
+# Load the quantized ONNX model and its tokenizer
+# onnxruntime, optimum and transformers are imported here, they take longer to import than the rest of the app
+def load_sentiment_model():
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+    from transformers import AutoTokenizer
+    model = ORTModelForSequenceClassification.from_pretrained(
+                MODEL_PATH, file_name=MODEL_FILE, repo_type="model", session_options=onnx_session_options())
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
+    return model, tokenizer
+
+
+# Cache keys of this exact model file, shared by the API and the backfill workers
+def sentiment_model_id() -> str:
+    model_stat = (MODEL_PATH / MODEL_FILE).stat()
+    return f"{MODEL_FILE}:{model_stat.st_size}:{model_stat.st_mtime_ns}"
+
+
 # Preload model upon app initialization
 @asynccontextmanager
 async def lifespan(app:FastAPI):
     # MODELS["social_sentiment"] = pipeline("text-classification", model="distilbert/distilbert-base-uncased-finetuned-sst-2-english")
-    
-    PROJECT_DIR = Path(__file__).parent.parent
-    model_path = PROJECT_DIR / 'onnx_model'
 
-    model = ORTModelForSequenceClassification.from_pretrained(
-                model_path, file_name="model_quantized.onnx", repo_type="model")
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    global model_ready
+    model_ready = asyncio.Event()
+    MODEL_STATE.update(status="loading", error=None, load_seconds=None)
+    loaded = {}
+
+    # Texts from all concurrent requests share padded forward passes
+    engine = BatchInferenceEngine(
+        lambda texts: loaded["predict_batch"](texts),
+        max_batch_size=config("INFERENCE_MAX_BATCH_SIZE", default=32, cast=int),
+        max_wait_ms=config("INFERENCE_MAX_WAIT_MS", default=10, cast=float),
+    )
+    await engine.start()
 
+    # Texts the cache doesn't have wait for the model
+    async def predict_when_ready(text: str):
+        await wait_for_model()
+        return await engine.predict(text)
+
+    # The sentiment cache takes over once prepare_model knows the model file
     MODELS["social_sentiment"] = {
-        "model": model,
-        "tokenizer": tokenizer,
-        "predict": lambda text: predict_sentiment(model, tokenizer, text),
+        "model": None,
+        "tokenizer": None,
+        "engine": engine,
+        "cache": None,
+        "predict": predict_when_ready,
     }
 
+    # The app serves (/, stock prices, market indicators) as soon as the model load is started
+    model_task = asyncio.create_task(prepare_model(loaded, predict_when_ready))
+    if MODEL_LOAD == "startup":
+        # Until the first attempt is done, a failed one keeps retrying in the background
+        await model_ready.wait()
+
+    # An unreachable database only means every read misses, it doesn't hold up startup
+    index_task = asyncio.create_task(market_store.ensure_indexes())
+
+    # Keep the market-wide fear / greed table warm in the background
+    market_table_task = asyncio.create_task(run_market_table_scheduler(
+        refresh_minutes=config("MARKET_TABLE_REFRESH_MINUTES", default=60, cast=float)))
+
+    # Workers for queued analyses
+    await analysis_jobs.start()
+
+    # Values owned by other objects are read when /metrics is scraped
+    def social_sentiment_values():
+        values = [("inference_queue_depth", engine.queue.qsize(), {})]
+        if "cache" in loaded:
+            cache = loaded["cache"]
+            values += [("sentiment_cache_lookups", count, {"result": result}) for result, count in cache.stats.items()]
+            values.append(("sentiment_cache_hit_rate", cache.hit_rate(), {}))
+        return values
+    metrics.register_collector("social_sentiment", social_sentiment_values)
+    metrics.register_collector("analysis_jobs", lambda: [
+        ("analysis_jobs", sum(1 for job in analysis_jobs.jobs.values() if job["status"] == status), {"status": status})
+        for status in ("queued", "running", "done", "failed")
+    ])
+    lag_task = asyncio.create_task(monitor_event_loop_lag(
+        interval=config("EVENT_LOOP_LAG_INTERVAL_SECONDS", default=0.5, cast=float)))
+
     yield
+    lag_task.cancel()
+    index_task.cancel()
+    model_task.cancel()
+    await analysis_jobs.stop()
+    market_table_task.cancel()
+    await engine.stop()
+    if "cache" in loaded:
+        await loaded["cache"].close()
+    if "remote" in loaded:
+        loaded["remote"].close()
     MODELS.clear()
 
 
 
-# Helper function for inference
-def predict_sentiment(model, tokenizer, text: str):
-    # Tokenize input text
-    inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=512)
+### Load the model (or connect to the inference server) and run a warm-up batch, off the event loop
+async def prepare_model(loaded: dict, predict: Callable[[str], Awaitable], retry_seconds: float = 1):
+    '''
+        predict: scores one text once the model is ready, the sentiment cache is put in front of it
+        A failed attempt is reported (requests needing the model fail fast, /health says why) and retried
+        with a doubling delay up to MODEL_RETRY_MAX_SECONDS, e.g. while the inference server restarts
+        or the model file is missing.
+    '''
+    start = time.time()
+    while True:
+        try:
+            if "cache" not in loaded:
+                # Texts that were already scored by this exact model file skip the model,
+                # cached ones are answered while it is still loading
+                loaded["cache"] = SentimentCache(
+                    predict,
+                    model_id=sentiment_model_id(),
+                    path=SENTIMENT_CACHE_PATH,
+                    max_entries=config("SENTIMENT_CACHE_SIZE", default=100000, cast=int),
+                )
+                MODELS["social_sentiment"].update(cache=loaded["cache"], predict=loaded["cache"].predict)
+
+            if INFERENCE_MODE == "remote":
+                # One model for every worker, only the socket client lives here
+                if "remote" not in loaded:
+                    loaded["remote"] = RemoteModel(INFERENCE_SOCKET)
+                loaded["predict_batch"] = loaded["remote"].predict_batch
+            else:
+                model, tokenizer = await asyncio.to_thread(load_sentiment_model)
+                MODELS["social_sentiment"].update(model=model, tokenizer=tokenizer)
+                loaded["predict_batch"] = lambda texts: predict_sentiment_batch(model, tokenizer, texts)
+
+            # The first runs of an ONNX session are slow, they shouldn't land on a user's request
+            with timer("model_warmup"):
+                await asyncio.to_thread(loaded["predict_batch"], WARMUP_TEXTS)
+            MODEL_STATE.update(status="ready", error=None, load_seconds=round(time.time() - start, 2))
+            logger.info("Sentiment model ready in %.1fs", time.time() - start)
+            model_ready.set()
+            return
+        except Exception as e:
+            logger.exception("Sentiment model failed to load, retrying in %.0fs", retry_seconds)
+            MODEL_STATE.update(status="failed", error=str(e))
+            model_ready.set()
+        await asyncio.sleep(retry_seconds)
+        retry_seconds = min(retry_seconds * 2, MODEL_RETRY_MAX_SECONDS)
+
+
+### Wait until the model is usable, requests needing it arrive before that in background mode
+async def wait_for_model():
+    if not model_ready.is_set():
+        with timer("model_load_wait"):
+            await model_ready.wait()
+    if MODEL_STATE["status"] != "ready":
+        raise RuntimeError(f"Sentiment model is not available: {MODEL_STATE['error']}")
+
+
+
+# Group token sequences by length so each forward pass pads only to its own bucket's longest text
+def length_buckets(encoded: list, max_bucket_size: int = 16) -> list:
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+
+    buckets = []
+    for i in order:
+        # Power of two length classes: 1-16, 17-32, 33-64, ... tokens
+        length_class = max(len(encoded[i]) - 1, 15).bit_length()
+        if buckets and buckets[-1][0] == length_class and len(buckets[-1][1]) < max_bucket_size:
+            buckets[-1][1].append(i)
+        else:
+            buckets.append((length_class, [i]))
+
+    return [bucket for _, bucket in buckets]
+
+
+# Helper function for batched inference, one [NEGATIVE, POSITIVE] probability row per text
+@timed("inference")
+def predict_sentiment_batch(model, tokenizer, texts: list) -> list:
+    metrics.observe("inference_batch_size", len(texts), buckets=SIZE_BUCKETS)
+
+    # Tokenize without padding, model max input token is 512
+    with timer("tokenize"):
+        encoded = tokenizer(texts, truncation=True, max_length=512)["input_ids"]
+
+    # NumPy tensors go straight to the ONNX Runtime session behind the optimum model
+    session = model.model
+    input_names = {i.name for i in session.get_inputs()}
+    probabilities = np.empty((len(texts), 2), dtype=np.float32)
+
+    for bucket in length_buckets(encoded):
+        max_length = max(len(encoded[i]) for i in bucket)
+        input_ids = np.full((len(bucket), max_length), tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(bucket), max_length), dtype=np.int64)
+        for row, i in enumerate(bucket):
+            input_ids[row, :len(encoded[i])] = encoded[i]
+            attention_mask[row, :len(encoded[i])] = 1
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+
+        # Perform inference
+        with timer("onnx_run"):
+            logits = session.run(None, inputs)[0]
+        metrics.observe("inference_padded_tokens", input_ids.size, buckets=(512, 1024, 2048, 4096, 8192, 16384))
+        probabilities[bucket] = softmax(logits)
 
-    # Perform inference
-    outputs = model(**inputs)
-    logits = outputs.logits
-    probabilities = softmax(logits, dim=1)
+    return list(probabilities)
 
-    return probabilities[0]
 
+def softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable
+
+
+### Content-addressed cache for per-text sentiment results
+class SentimentCache:
+    '''
+        Sits in front of the model predict function. Results are keyed by a hash of the model identity
+        and the normalized text, so the same title or comment is only scored once per model.
+
+        Tiers: in-memory LRU -> SQLite file -> model. Writes to SQLite are buffered and flushed in batches.
+        SQLite only runs on worker threads, the texts of one event loop tick share one SELECT, so a
+        lock held by another process (API workers and backfills share the file) never stalls the loop.
+
+        predict: async function taking one text and returning its [NEGATIVE, POSITIVE] probabilities
+        model_id: changes whenever the model file changes, old entries then simply stop matching
+        max_entries: 100000 -> size of the in-memory tier
+    '''
+    def __init__(self, predict: Callable[[str], Awaitable], model_id: str, path: Path,
+                 max_entries: int = 100000, flush_every: int = 256):
+        self.predict_uncached = predict
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+
+        self.memory = OrderedDict()
+        self.in_flight = {}
+        self.pending_writes = []
+        self.flush_task = None
+        # coalesced: joined a concurrent scoring of the same text, neither a hit nor a model call
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0}
+
+        # key -> future of its disk row, collected until the next batched read
+        self.lookups = {}
+        self.lookup_task = None
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # One connection used from worker threads, one at a time
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        # Readers don't wait for writers and writers only wait for each other
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sentiment (key TEXT PRIMARY KEY, negative REAL, positive REAL)")
+        self.db.commit()
+
+    # Whitespace and case don't change the tokens of the uncased model
+    def key(self, text: str) -> str:
+        normalized = " ".join(text.split()).lower()
+        return hashlib.sha256(f"{self.model_id}\0{normalized}".encode()).hexdigest()
+
+    def _remember(self, key: str, probabilities: np.ndarray):
+        self.memory[key] = probabilities
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    async def predict(self, text: str) -> np.ndarray:
+        key = self.key(text)
+
+        if key in self.memory:
+            self.stats["memory_hits"] += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        row = await self.read(key)
+        if key in self.memory:
+            # Scored by a concurrent request while the row was being read
+            self.stats["coalesced"] += 1
+            return self.memory[key]
+        if row is not None:
+            self.stats["disk_hits"] += 1
+            probabilities = np.array(row, dtype=np.float32)
+            self._remember(key, probabilities)
+            return probabilities
+
+        # The same text requested twice at once is only scored once
+        if key in self.in_flight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        self.stats["misses"] += 1
+        future = asyncio.ensure_future(self.predict_uncached(text))
+        self.in_flight[key] = future
+        future.add_done_callback(functools.partial(self._scored, key))
+        return np.asarray(await asyncio.shield(future), dtype=np.float32)
+
+    # Runs once the scoring finishes, stored even when the request that started it was cancelled
+    def _scored(self, key: str, future: asyncio.Future):
+        self.in_flight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        probabilities = np.asarray(future.result(), dtype=np.float32)
+        self._remember(key, probabilities)
+        self.pending_writes.append((key, float(probabilities[0]), float(probabilities[1])))
+        if len(self.pending_writes) >= self.flush_every and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.ensure_future(self.flush())
+
+    ### Disk row of a key, every key asked for in the same loop tick is read by one query
+    async def read(self, key: str):
+        future = self.lookups.get(key)
+        if future is None:
+            future = self.lookups[key] = asyncio.get_running_loop().create_future()
+            if self.lookup_task is None:
+                self.lookup_task = asyncio.ensure_future(self.read_batch())
+        return await asyncio.shield(future)
+
+    async def read_batch(self):
+        # Texts gathered together (a post's title and comments) are all queued by the next tick
+        await asyncio.sleep(0)
+        batch, self.lookups, self.lookup_task = self.lookups, {}, None
+        try:
+            rows = await asyncio.to_thread(self.select, list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(rows.get(key))
+
+    # SQLite caps the parameters of a statement, long batches are split
+    def select(self, keys: list, chunk_size: int = 500) -> dict:
+        rows = {}
+        with self.db_lock:
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
+                rows.update((key, (negative, positive)) for key, negative, positive in self.db.execute(
+                    f"SELECT key, negative, positive FROM sentiment WHERE key IN ({', '.join('?' * len(chunk))})", chunk))
+        return rows
+
+    async def flush(self):
+        if not self.pending_writes:
+            return
+        rows, self.pending_writes = self.pending_writes, []
+        await asyncio.to_thread(self.write, rows)
+
+    def write(self, rows: list):
+        with self.db_lock:
+            self.db.executemany("INSERT OR REPLACE INTO sentiment VALUES (?, ?, ?)", rows)
+            self.db.commit()
+
+    # Share of the texts found in a tier, joins of a concurrent scoring were never in the cache
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    # Every text scored so far is on disk once this returns, including a flush already running
+    async def drain(self):
+        if self.flush_task is not None:
+            await self.flush_task
+        await self.flush()
+
+    async def close(self):
+        await self.drain()
+        with self.db_lock:
+            self.db.close()
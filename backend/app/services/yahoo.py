@@ -1,42 +1,146 @@
 import yfinance as yf
+import numpy as np
 import pandas as pd
 from datetime import timedelta
 import os
 import asyncio
+import threading
+import time
 from fastapi import HTTPException
+from services.price_store import price_store
+from util.metrics import metrics, timed, timer
+
+# yf.download keeps its results in module-level state, so two downloads must never overlap
+download_lock = threading.Lock()
+
+# Tickers behind the fear / greed indicators and the longest lookback they need (market momentum: 125 * 2 days)
+FEAR_GREED_TICKERS = ["^VIX", "^GSPC", "SPY", "TLT", "HYG", "LQD"]
+FEAR_GREED_LOOKBACK_DAYS = 250
+
+
+# Download several tickers in one provider call and split them per ticker
+def download_stock_data(tickers: list, start_date: str, end_date: str, interval: str) -> dict:
+    waited_at = time.perf_counter()
+    with download_lock:
+        metrics.observe("semaphore_wait_seconds", time.perf_counter() - waited_at, stage="yahoo_download")
+        with timer("yahoo_download"):
+            data = yf.download(tickers, threads=True, start=start_date, end=end_date, interval=interval,
+                               group_by="column")
+        metrics.inc("yahoo_downloads_total")
+        metrics.inc("yahoo_tickers_downloaded_total", len(tickers))
+
+    frames = {}
+    for ticker in tickers:
+        if data.empty or ticker not in data.columns.get_level_values(1):
+            frames[ticker] = pd.DataFrame()
+            continue
+
+        # Raw bars: Date, Close, High, Low, Open, Volume
+        df = data.xs(ticker, axis=1, level=1).dropna(how="all")
+        df.columns = list(df.columns)
+        df.index.name = "Date"
+        if df.index.tz is not None:
+            df.index = df.index.tz_convert("US/Eastern").tz_localize(None)
+        frames[ticker] = df.reset_index()
+
+    return frames
+
+
+# Same layout as a single ticker download: Date, Close_<ticker>, Open_<ticker>, ...
+def format_stock_data(ticker: str, data: pd.DataFrame, interval: str = "1d") -> pd.DataFrame:
+    if data.empty:
+        raise ValueError(f"No data avalaible for {ticker}")
+
+    df = data.rename(columns={col: f"{col}_{ticker}" for col in data.columns if col != "Date"})
+    df["Date"] = pd.to_datetime(df["Date"]).dt.strftime(timestamp_format(interval))
+    return df
+
+
+# Intraday bars keep their time of day
+def timestamp_format(interval: str) -> str:
+    return '%Y-%m-%d %H:%M:%S' if interval.endswith(("m", "h")) and not interval.endswith("mo") else '%Y-%m-%d'
+
+
+# Fetch several tickers at once, served from the local price store where possible
+# skip_missing: tickers without data are left out instead of failing the whole call
+async def fetch_multiple_stock_data(tickers: list, start_date: str, end_date: str, interval: str,
+                                    skip_missing: bool = False) -> dict:
+    try:
+        tickers = list(dict.fromkeys(tickers))
+        data = await price_store.get_prices(tickers, start_date=start_date, end_date=end_date,
+                                            interval=interval, download=download_stock_data)
+        if skip_missing:
+            tickers = [ticker for ticker in tickers if not data[ticker].empty]
+        return {ticker: format_stock_data(ticker, data[ticker], interval) for ticker in tickers}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)} from fetch_multiple_stock_data()")
+
 
 # Fetch stock data from Yahoo API
 async def fetch_stock_data(ticker: str, start_date: str, end_date: str, interval: str) -> pd.DataFrame:
     try: 
-        
-        data = yf.download(ticker, threads=True, start=start_date, end=end_date,interval=interval)
-        
-        if data.empty:
-            raise ValueError(f"No data avalaible for {ticker}")
-                
-        data.reset_index(inplace=True)
-        if isinstance(data.columns, pd.MultiIndex):
-            data.columns = ['_'.join(filter(None, col)).strip() for col in data.columns]
-
-        df = pd.DataFrame(data)
-        df["Date"] = pd.to_datetime(df["Date"]).dt.strftime('%Y-%m-%d')
-        
-        return df
+        data = await price_store.get_prices([ticker], start_date=start_date, end_date=end_date,
+                                            interval=interval, download=download_stock_data)
+        return format_stock_data(ticker, data[ticker], interval)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)} from fetch_stock_data()")
-    
+
+
+# Slice of a shared download starting at cutoff_date, or a fresh download when nothing was shared
+async def get_stock_slice(ticker: str, cutoff_date, end_date, interval: str, prices: dict = None) -> pd.DataFrame:
+    if prices is None or ticker not in prices:
+        return await fetch_stock_data(ticker, start_date=cutoff_date.strftime('%Y-%m-%d'),
+                                      end_date=end_date.strftime('%Y-%m-%d'),
+                                      interval=interval)
+
+    data = prices[ticker]
+    data = data[pd.to_datetime(data["Date"]) >= cutoff_date]
+    return data.reset_index(drop=True)
+
+
+
+# Map z-scores to a 0-100 fear / greed score: z >= bound is extreme fear (0), z <= -bound extreme greed (100)
+# Works on a Series as well as on a single value (live stream)
+def zscore_to_score(z_score: pd.Series, bound: float) -> pd.Series:
+    return 100 - (np.clip(z_score, -bound, bound) + bound) * (100 / (2 * bound))
+
+
+
+# Indicator -> (signal column, z-score bound, whether the signal is shown)
+INDICATOR_SIGNALS = {
+    "vix": ("diff", 2, False),
+    "market_momentum": ("diff_change", 3, False),
+    "safe_haven": ("safe_haven", 2, True),
+    "yield_spread": ("yield_spread", 2, True),
+}
+
+
+### Fear / greed score of an indicator's signal rows, the z-scores are normalized over the rows given
+def score_indicator(name: str, signal: pd.DataFrame) -> pd.DataFrame:
+    '''
+        The fetch_* functions return the signal of each bar from start_date on, which doesn't depend on
+        the window, so it can be stored per bar and any window scored from a range of it.
+    '''
+    column, bound, shown = INDICATOR_SIGNALS[name]
+    values = signal[column]
+    scored = signal.assign(fear_greed_score=zscore_to_score((values - values.mean()) / values.std(), bound=bound))
+    if not shown:
+        scored = scored.drop(columns=column)
+    return scored.reset_index(drop=True)
+
 
 
 # CBOE Votatility Index (VIX)
-async def fetch_vix(start_date: str, end_date: str, moving_avg: int = 50, interval: str = "1d") -> pd.DataFrame:
+@timed("indicator_vix")
+async def fetch_vix(start_date: str, end_date: str, moving_avg: int = 50, interval: str = "1d", prices: dict = None) -> pd.DataFrame:
     # Moving average unit is in days
     try: 
         # Make sure to have enough data to caculate vix
         cutoff_date = start_date - timedelta(days=moving_avg * 2)
 
-        vix_data = await fetch_stock_data("^VIX", start_date=cutoff_date.strftime('%Y-%m-%d'),
-                                            end_date=end_date.strftime('%Y-%m-%d'), 
-                                            interval=interval)
+        vix_data = await get_stock_slice("^VIX", cutoff_date=cutoff_date,
+                                            end_date=end_date, 
+                                            interval=interval, prices=prices)
         
         # Calculate moving avg of vix
         vix_data[f"VIX_{moving_avg}"] = vix_data["Close_^VIX"].rolling(window=moving_avg).mean()
@@ -44,16 +148,11 @@ async def fetch_vix(start_date: str, end_date: str, moving_avg: int = 50, interv
         vix_data["timestamp"] = vix_data["Date"]
         vix_data["VIX"] = vix_data["Close_^VIX"]
         
-        #  Calculate the fear and greed score (/100)
+        # Distance to the moving average, scored by score_indicator
         vix_data["diff"] = vix_data["VIX"] - vix_data[f"VIX_{moving_avg}"]
-        diff_mean = vix_data["diff"].mean()
-        diff_std = vix_data["diff"].std()
-        vix_data["z_score"] = (vix_data["diff"] - diff_mean) / diff_std
-        vix_data["fear_greed_score"] = vix_data["z_score"].apply(
-            lambda z: 100 - ((max(min(z, 2), -2) + 2) * 25))
         
         # Select display collumns
-        vix_data = vix_data[["timestamp", "VIX", f"VIX_{moving_avg}", "fear_greed_score"]]
+        vix_data = vix_data[["timestamp", "VIX", f"VIX_{moving_avg}", "diff"]]
      
         return vix_data
     except Exception as e:
@@ -62,32 +161,28 @@ async def fetch_vix(start_date: str, end_date: str, moving_avg: int = 50, interv
 
 
 # Calculate S&P500 market momentum
-async def fetch_market_momentum(start_date: str, end_date: str, moving_avg: int = 125, interval: str = "1d") -> pd.DataFrame:
+@timed("indicator_market_momentum")
+async def fetch_market_momentum(start_date: str, end_date: str, moving_avg: int = 125, interval: str = "1d", prices: dict = None) -> pd.DataFrame:
     try: 
         # Make sure to have enough data to caculate vix
         cutoff_date = start_date - timedelta(days=moving_avg * 2)
 
-        mm_data = await fetch_stock_data("^GSPC", start_date=cutoff_date.strftime('%Y-%m-%d'),
-                                   end_date=end_date.strftime('%Y-%m-%d'),
-                                   interval=interval)
+        mm_data = await get_stock_slice("^GSPC", cutoff_date=cutoff_date,
+                                   end_date=end_date,
+                                   interval=interval, prices=prices)
         
         # Calculate moving avg of S&P500 market momentum
         mm_data[f"S&P500_{moving_avg}"] = mm_data["Close_^GSPC"].rolling(window=moving_avg).mean()
         mm_data["timestamp"] = mm_data ["Date"]
         mm_data["S&P500"] = mm_data["Close_^GSPC"]
 
-        # Calculate the fear and greed score (out of 100)
+        # Change of the distance to the moving average, scored by score_indicator
         mm_data["diff"] = mm_data["S&P500"] - mm_data[f"S&P500_{moving_avg}"]
         mm_data["diff_change"] = mm_data["diff"].diff()
-        mean_change = mm_data["diff_change"].mean()
-        std_change = mm_data["diff_change"].std()
-        mm_data["z_score"] = (mm_data["diff_change"] - mean_change) / std_change
-        mm_data["fear_greed_score"] = mm_data["z_score"].apply(
-            lambda z: 100 - ((max(min(z, 3), -3) + 3) * (100 / 6)))
         mm_data = mm_data [pd.to_datetime(mm_data["Date"]) >= start_date]
 
         # Select display collumns
-        mm_data = mm_data[["timestamp", "S&P500", f"S&P500_{moving_avg}", "fear_greed_score"]]
+        mm_data = mm_data[["timestamp", "S&P500", f"S&P500_{moving_avg}", "diff_change"]]
      
         return mm_data
     except Exception as e:
@@ -96,20 +191,25 @@ async def fetch_market_momentum(start_date: str, end_date: str, moving_avg: int
 
 
 # Calculate safe haven demand
-async def fetch_safe_haven_demand(start_date: str, end_date: str, difference: int = 20, interval: str = "1d") -> pd.DataFrame:
+@timed("indicator_safe_haven")
+async def fetch_safe_haven_demand(start_date: str, end_date: str, difference: int = 20, interval: str = "1d", prices: dict = None) -> pd.DataFrame:
     try:
        # Make sure to have enough data to caculate vix
         cutoff_date = start_date - timedelta(days=difference * 2)
 
+        # Both legs come from one download
+        if prices is None:
+            prices = await fetch_multiple_stock_data(["SPY", "TLT"], start_date=cutoff_date.strftime('%Y-%m-%d'),
+                                                     end_date=end_date.strftime('%Y-%m-%d'),
+                                                     interval=interval)
+
         # S&P 500 ETF represent stocks
-        spy = await fetch_stock_data("SPY", start_date=cutoff_date.strftime('%Y-%m-%d'),
-                                     end_date=end_date.strftime('%Y-%m-%d'),
-                                     interval=interval)
+        spy = await get_stock_slice("SPY", cutoff_date=cutoff_date, end_date=end_date,
+                                    interval=interval, prices=prices)
         
         # 20+ Year Treasury Bond ETF represent bonds
-        tlt = await fetch_stock_data("TLT", start_date=cutoff_date.strftime('%Y-%m-%d'),
-                                     end_date=end_date.strftime('%Y-%m-%d'),
-                                     interval=interval)
+        tlt = await get_stock_slice("TLT", cutoff_date=cutoff_date, end_date=end_date,
+                                    interval=interval, prices=prices)
         
         # Calculate the percentage change in {difference} trading days
         spy["return_20"] = spy["Close_SPY"].pct_change(difference)
@@ -121,17 +221,12 @@ async def fetch_safe_haven_demand(start_date: str, end_date: str, difference: in
             "TLT_return_20": tlt["return_20"]
         }).dropna()
 
-        # Calculate the fear / greed score
+        # Stocks outperforming bonds, scored by score_indicator
         merged["safe_haven"] = merged["SPY_return_20"] - merged["TLT_return_20"]
-        merged_mean = merged["safe_haven"].mean()
-        merged_std = merged["safe_haven"].std()
-        merged["z_score"] = (merged["safe_haven"] - merged_mean) / merged_std
-        merged["fear_greed_score"] = merged["z_score"].apply(
-            lambda z: 100 - ((max(min(z, 2), -2) + 2) * 25))
         merged = merged[pd.to_datetime(merged["timestamp"]) >= start_date]
 
         # Select display collumns
-        merged = merged[["timestamp", "safe_haven", "fear_greed_score"]]
+        merged = merged[["timestamp", "safe_haven"]]
         
         return merged
     except Exception as e:
@@ -139,18 +234,23 @@ async def fetch_safe_haven_demand(start_date: str, end_date: str, difference: in
 
 
 # Yield spread: junk bonds vs investment grade
-async def fetch_yield_spread(start_date: str, end_date: str, interval: str = "1d") -> pd.DataFrame:
+@timed("indicator_yield_spread")
+async def fetch_yield_spread(start_date: str, end_date: str, interval: str = "1d", prices: dict = None) -> pd.DataFrame:
     try:
         cutoff_date = start_date - timedelta(days=5)
+        # Both legs come from one download
+        if prices is None:
+            prices = await fetch_multiple_stock_data(["HYG", "LQD"], start_date=cutoff_date.strftime('%Y-%m-%d'),
+                                                     end_date=end_date.strftime('%Y-%m-%d'),
+                                                     interval=interval)
+
         # Junk Bond ETF (HYG)
-        hyg = await fetch_stock_data("HYG", start_date=cutoff_date.strftime('%Y-%m-%d'),
-                                        end_date=end_date.strftime('%Y-%m-%d'),
-                                        interval=interval)
+        hyg = await get_stock_slice("HYG", cutoff_date=cutoff_date, end_date=end_date,
+                                    interval=interval, prices=prices)
 
         # Investment Grade Bond ETF (LQD)
-        lqd = await fetch_stock_data("LQD", start_date=cutoff_date.strftime('%Y-%m-%d'),
-                                        end_date=end_date.strftime('%Y-%m-%d'),
-                                        interval=interval)
+        lqd = await get_stock_slice("LQD", cutoff_date=cutoff_date, end_date=end_date,
+                                    interval=interval, prices=prices)
         
         # Calculate the rolling dividend yields (as a proxy for bond yields)
         hyg["yield"] = hyg["Close_HYG"].pct_change(periods=1) + 1
@@ -163,20 +263,12 @@ async def fetch_yield_spread(start_date: str, end_date: str, interval: str = "1d
             "LQD_yield": lqd["yield"]
         }).dropna()
 
-        # Calculate the yield spread
+        # Calculate the yield spread, scored by score_indicator
         merged["yield_spread"] = merged["HYG_yield"] - merged["LQD_yield"]
-
-        # Calculate the fear/greed score
-        merged_mean = merged["yield_spread"].mean()
-        merged_std = merged["yield_spread"].std()
-        merged["z_score"] = (merged["yield_spread"] - merged_mean) / merged_std
-        merged["fear_greed_score"] = merged["z_score"].apply(
-            lambda z: 100 - ((max(min(z, 2), -2) + 2) * 25)
-        )
         merged = merged[pd.to_datetime(merged["timestamp"]) >= start_date]
 
         # Select display columns
-        merged = merged[["timestamp", "yield_spread", "fear_greed_score"]]
+        merged = merged[["timestamp", "yield_spread"]]
         return merged
 
     except Exception as e:
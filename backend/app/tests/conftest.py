@@ -0,0 +1,109 @@
+import itertools
+from types import SimpleNamespace
+import pytest
+from pymongo import DeleteMany, UpdateOne
+from db.db_manager import MongoDB
+
+
+def matches(document: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        value = document.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if value is None \
+                    or (operator == "$gte" and not value >= operand) \
+                    or (operator == "$lt" and not value < operand) \
+                    or (operator == "$nin" and value in operand):
+                return False
+    return True
+
+
+def project(document: dict, projection: dict) -> dict:
+    if not projection:
+        return dict(document)
+    included = [field for field, keep in projection.items() if keep]
+    if included:
+        return {field: document[field] for field in included if field in document}
+    return {field: value for field, value in document.items() if projection.get(field, 1)}
+
+
+class Cursor:
+    def __init__(self, documents: list, projection: dict):
+        self.documents = documents
+        self.projection = projection
+
+    def batch_size(self, size: int):
+        return self
+
+    def sort(self, keys: list):
+        for field, direction in reversed(keys):
+            self.documents = sorted(self.documents, key=lambda document: document[field], reverse=direction < 0)
+        return self
+
+    async def __aiter__(self):
+        for document in self.documents:
+            yield project(document, self.projection)
+
+
+class Collection:
+    '''
+        In-memory stand-in for the part of a Motor collection MongoDB and MarketStore use
+    '''
+    ids = itertools.count()
+
+    def __init__(self):
+        self.documents = []
+        self.bulk_writes = []
+        self.failing = False
+
+    def find(self, query: dict, projection: dict = None) -> Cursor:
+        return Cursor([document for document in self.documents if matches(document, query)], projection)
+
+    async def find_one(self, query: dict, projection: dict = None):
+        if self.failing:
+            raise ConnectionError("database unreachable")
+        found = [document for document in self.documents if matches(document, query)]
+        return project(found[0], projection) if found else None
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        if self.failing:
+            raise ConnectionError("database unreachable")
+        self.bulk_writes.append(operations)
+        upserted = modified = 0
+        for operation in operations:
+            if isinstance(operation, DeleteMany):
+                self.documents = [document for document in self.documents if not matches(document, operation._filter)]
+            elif isinstance(operation, UpdateOne):
+                found = [document for document in self.documents if matches(document, operation._filter)]
+                update = operation._doc["$set"]
+                if not found:
+                    self.documents.append({"_id": next(self.ids), **operation._filter, **update})
+                    upserted += 1
+                elif any(found[0].get(field) != value for field, value in update.items()):
+                    found[0].update(update)
+                    modified += 1
+        return SimpleNamespace(upserted_count=upserted, modified_count=modified)
+
+    async def create_indexes(self, models: list):
+        return []
+
+
+class Client(dict):
+    def __missing__(self, name: str):
+        self[name] = database = Database()
+        return database
+
+
+class Database(dict):
+    def __missing__(self, name: str):
+        self[name] = collection = Collection()
+        return collection
+
+
+# MongoDB on an in-memory client, what the store writes can be read back within one test
+@pytest.fixture
+def database():
+    return MongoDB("", "test", client=Client())
@@ -0,0 +1,60 @@
+import asyncio
+import time
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+from routers import stock_price
+from services import resource_init
+from util.response_cache import ResponseCache
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # No model file, and the market table isn't refreshed from Yahoo
+    monkeypatch.setattr(resource_init, "MODEL_PATH", tmp_path / "onnx_model")
+    monkeypatch.setattr(resource_init, "SENTIMENT_CACHE_PATH", str(tmp_path / "sentiment_cache.sqlite"))
+    monkeypatch.setattr(resource_init, "run_market_table_scheduler", lambda refresh_minutes: asyncio.sleep(0))
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_app_starts_without_the_model_file(client):
+    response = client.get("/health")
+    for _ in range(100):
+        if response.json()["status"] != "loading":
+            break
+        time.sleep(0.01)
+        response = client.get("/health")
+
+    assert response.status_code == 503
+    assert response.json()["status"] == "failed"
+    assert "model_quantized.onnx" in response.json()["model"]["error"]
+    assert client.get("/").json() == {"message": "Welcome to the MarketPulse!"}
+
+
+def test_cached_routes_answer_through_the_real_app(client, monkeypatch):
+    calls = []
+
+    async def fetch_stock_data(ticker, start_date, end_date, interval):
+        calls.append(ticker)
+        return pd.DataFrame({"Date": ["2024-03-01", "2024-03-04"], f"Close_{ticker}": [100.0, 101.0]})
+
+    monkeypatch.setattr(stock_price, "fetch_stock_data", fetch_stock_data)
+    monkeypatch.setattr(main, "response_cache", ResponseCache(max_entries=8))
+
+    first = client.get("/api/stock-price/AAPL", params={"time_filter": "year"})
+    again = client.get("/api/stock-price/AAPL", params={"time_filter": "year"}, headers={"If-None-Match": first.headers["ETag"]})
+
+    assert first.status_code == 200 and list(first.json()) == ["AAPL"]
+    # Only the response cache answers with a 304
+    assert again.status_code == 304 and again.headers["ETag"] == first.headers["ETag"]
+    assert calls == ["AAPL"]
+    assert 'route="/api/stock-price/{ticker}"' in client.get("/metrics").text
+
+
+@pytest.mark.parametrize("priority", [-1, 4, 10 ** 9])
+def test_job_priority_is_bounded(client, priority):
+    response = client.post("/api/analyze-market/Apple/jobs", params={"ticker": "AAPL", "priority": priority})
+
+    assert response.status_code == 422
@@ -0,0 +1,176 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import pytest
+import services.backfill
+import services.reddit
+import services.resource_init
+from benchmarks.fixtures import FakeReddit, synthetic_fixtures
+from services.backfill import Checkpoint, backfill, backfill_unit
+from services.market_store import MarketStore
+from services.reddit import fetch_social_sentiment, scored_post
+from util.market_calendar import market_today
+
+
+# Process pool stand-in, the chunks are scored in threads of this process
+class Pool(ThreadPoolExecutor):
+    def __init__(self, max_workers: int, mp_context=None, initializer=None, initargs=()):
+        super().__init__(max_workers)
+
+
+def sentiment(post_id: str) -> float:
+    return (sum(map(ord, post_id)) % 7 - 3) / 3
+
+
+class Scorer:
+    '''
+        score_chunk stand-in with a sentiment derived from the post id, fails the posts of `failing` queries
+    '''
+    def __init__(self):
+        self.scored = []
+        self.failing = set()
+
+    def __call__(self, posts: list) -> list:
+        if any(post["title"].split()[0] in self.failing for post in posts):
+            raise RuntimeError("worker died")
+        self.scored.extend(post["id"] for post in posts)
+        return [scored_post(post, sentiment(post["id"])) for post in posts]
+
+
+@pytest.fixture
+def today():
+    return market_today().date()
+
+
+@pytest.fixture
+def store(database, monkeypatch):
+    store = MarketStore(database)
+    monkeypatch.setattr(services.backfill, "market_store", store)
+    monkeypatch.setattr(services.reddit, "market_store", store)
+    return store
+
+
+@pytest.fixture
+def scorer(monkeypatch):
+    scorer = Scorer()
+    monkeypatch.setattr(services.backfill, "score_chunk", scorer)
+    monkeypatch.setattr(services.backfill, "ProcessPoolExecutor", Pool)
+    return scorer
+
+
+@pytest.fixture
+def posts(monkeypatch):
+    posts = []
+    for seed, company in enumerate(["Apple", "Tesla"]):
+        fixtures = synthetic_fixtures(20, "technology", company, posts_per_day=2.0, comments_per_post=3, seed=seed)
+        posts += [{**post, "id": f"{company}-{post['id']}"} for post in fixtures["posts"]]
+    monkeypatch.setattr(services.reddit, "reddit", FakeReddit(posts))
+    return posts
+
+
+def test_checkpoint_resumes_and_skips_completed_units(tmp_path, today, store, scorer, posts):
+    path = tmp_path / "checkpoint.json"
+    start = today - timedelta(days=29)
+
+    def run(companies: list):
+        return asyncio.run(backfill(companies, ["technology"], start, today, workers=2, checkpoint=path,
+                                    chunk_size=8, cache_path=str(tmp_path / "cache.sqlite")))
+
+    # Tesla's worker fails, only Apple is recorded
+    scorer.failing = {"Tesla"}
+    first = run(["Apple", "Tesla"])
+    apple, tesla = Checkpoint.unit("technology", "Apple", start, today), Checkpoint.unit("technology", "Tesla", start, today)
+    assert "error" in first[tesla] and first[apple]["scored"] == first[apple]["posts"] > 0
+    assert Checkpoint(path).done(apple) and not Checkpoint(path).done(tesla)
+
+    # The rerun reads the checkpoint back and only runs what is left
+    scorer.failing = set()
+    scored = len(scorer.scored)
+    second = run(["Apple", "Tesla"])
+    assert list(second) == [tesla]
+    assert all(post_id.startswith("Tesla-") for post_id in scorer.scored[scored:])
+    assert Checkpoint(path).done(apple) and Checkpoint(path).done(tesla)
+    assert Checkpoint(path).units[apple]["posts"] == first[apple]["posts"]
+
+    assert run(["Apple", "Tesla"]) == {}
+
+
+def test_backfilled_days_are_what_live_requests_read(monkeypatch, today, store, scorer, posts):
+    async def crawl(*args, **kwargs):
+        raise AssertionError("backfilled days were crawled again")
+    monkeypatch.setattr(services.reddit, "crawl_social_days", crawl)
+
+    async def main():
+        with ThreadPoolExecutor(2) as pool:
+            # The "month" filter covers the last 30 days, today included
+            summary = await backfill_unit(pool, "Technology", "Apple", today - timedelta(days=29), today, chunk_size=8)
+            rerun = await backfill_unit(pool, "technology", "APPLE", today - timedelta(days=29), today, chunk_size=8)
+        live = await fetch_social_sentiment("technology", "apple", "month")
+        stored_posts = await store.read_posts(store.social_key("technology", "Apple"), "", "~")
+        stored_days, _, _ = await store.read_social_days("technology", "Apple", "", "~", "all", 0)
+        return summary, rerun, live, stored_posts, stored_days
+
+    summary, rerun, live, stored_posts, stored_days = asyncio.run(main())
+    apple = [post for post in posts if post["title"].startswith("Apple")]
+    assert summary["scored"] == summary["posts"] == len(apple)
+    # Stored posts keep their sentiment, a rerun scores nothing
+    assert rerun["scored"] == 0 and rerun["posts"] == len(apple)
+    assert len(scorer.scored) == len(apple) and len(stored_posts) == len(apple)
+
+    assert all(post["sentiment"] == sentiment(post["id"]) for post in stored_posts)
+
+    # One row per day with posts, and the live request answers from them alone
+    assert stored_days["timestamp"].tolist() == sorted({post["timestamp"][:10] for post in stored_posts})
+    assert len(live) > 0 and live.to_dict("records") == stored_days.to_dict("records")
+
+
+def test_backfilled_days_only_answer_requests_as_sparse(monkeypatch, today, store, scorer, posts):
+    crawled = []
+
+    async def crawl(subreddits: list, query: str, start: str, end: str, limit: int, hourly: bool = False):
+        crawled.append((start, end, limit))
+        return {}
+    monkeypatch.setattr(services.reddit, "crawl_social_days", crawl)
+
+    async def main():
+        with ThreadPoolExecutor(2) as pool:
+            # A month of the top 10 posts
+            await backfill_unit(pool, "technology", "Apple", today - timedelta(days=29), today, limit=10, chunk_size=8)
+        for time_filter, limit in (("month", 10), ("month", 250), ("week", 10)):
+            await fetch_social_sentiment("technology", "Apple", time_filter, limit=limit)
+
+    asyncio.run(main())
+    # The month of 10 posts answers itself, a larger limit or fewer days would find posts it never saw
+    week = str(today - timedelta(days=6))
+    assert crawled == [(str(today - timedelta(days=29)), str(today + timedelta(days=1)), 250),
+                       (week, str(today + timedelta(days=1)), 10)]
+
+
+def test_worker_keeps_one_engine_and_cache_across_chunks(tmp_path, monkeypatch):
+    batches = []
+    monkeypatch.setattr(services.resource_init, "load_sentiment_model", lambda: (None, None))
+    monkeypatch.setattr(services.resource_init, "predict_sentiment_batch",
+                        lambda model, tokenizer, texts: batches.append(texts) or [[0.25, 0.75]] * len(texts))
+    monkeypatch.setattr(services.resource_init, "sentiment_model_id", lambda: "model:1")
+    monkeypatch.setattr(services.backfill, "WORKER", {})
+    # Restored afterwards, init_worker replaces the predict function live requests use
+    monkeypatch.setitem(services.resource_init.MODELS, "social_sentiment", None)
+    chunk = [{"id": post_id, "title": f"Post {post_id}", "comments": [("Nice", 3)], "interest_score": 1.0,
+              "timestamp": "2024-03-01", "article_url": "", "rank": 1, "subreddit": "technology"}
+             for post_id in ("a", "b")]
+
+    services.backfill.init_worker(1, str(tmp_path / "cache.sqlite"))
+    worker = services.backfill.WORKER
+    cache = worker["cache"]
+    first = services.backfill.score_chunk(chunk)
+    again = services.backfill.score_chunk(chunk)
+    on_disk = cache.select([cache.key("Post a"), cache.key("Nice")])
+    worker["loop"].run_until_complete(worker["engine"].stop())
+    worker["loop"].run_until_complete(cache.close())
+    worker["loop"].close()
+
+    assert worker["cache"] is cache and services.resource_init.MODELS["social_sentiment"]["predict"] == cache.predict
+    # The second chunk is answered by the worker's cache, its texts were written before the first returned
+    assert sorted(text for batch in batches for text in batch) == ["Nice", "Post a", "Post b"]
+    assert cache.stats["memory_hits"] == 4 and len(on_disk) == 2
+    assert [post.sentiment for post in again] == [post.sentiment for post in first]
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+import pytest
+from services.batch_inference import BatchInferenceEngine
+
+
+class Model:
+    def __init__(self, error: Exception = None):
+        self.batches = []
+        self.error = error
+
+    def __call__(self, texts: list) -> list:
+        self.batches.append(list(texts))
+        if self.error is not None:
+            raise self.error
+        return [f"scored {text}" for text in texts]
+
+
+def run(model: Model, texts: list, **kwargs) -> list:
+    async def main():
+        engine = BatchInferenceEngine(model, **kwargs)
+        await engine.start()
+        try:
+            return await asyncio.gather(*(engine.predict(text) for text in texts), return_exceptions=True)
+        finally:
+            await engine.stop()
+    return asyncio.run(main())
+
+
+def test_concurrent_texts_share_one_model_call():
+    model = Model()
+    results = run(model, [f"text {i}" for i in range(5)], max_batch_size=32, max_wait_ms=50)
+
+    assert model.batches == [[f"text {i}" for i in range(5)]]
+    # Every caller gets the result of its own text
+    assert results == [f"scored text {i}" for i in range(5)]
+
+
+def test_batches_are_capped_at_max_batch_size():
+    model = Model()
+    results = run(model, [f"text {i}" for i in range(10)], max_batch_size=4, max_wait_ms=50)
+
+    assert [len(batch) for batch in model.batches] == [4, 4, 2]
+    assert [text for batch in model.batches for text in batch] == [f"text {i}" for i in range(10)]
+    assert results == [f"scored text {i}" for i in range(10)]
+
+
+def test_batch_is_flushed_once_max_wait_runs_out():
+    model = Model()
+
+    async def main():
+        engine = BatchInferenceEngine(model, max_batch_size=32, max_wait_ms=30)
+        await engine.start()
+        start = time.perf_counter()
+        first = asyncio.ensure_future(engine.predict("early"))
+        # Arrives after the first batch stopped waiting, it gets a batch of its own
+        await asyncio.sleep(0.15)
+        assert first.done()
+        second = await engine.predict("late")
+        await engine.stop()
+        return first.result(), second, time.perf_counter() - start
+
+    first, second, elapsed = asyncio.run(main())
+    assert model.batches == [["early"], ["late"]]
+    assert (first, second) == ("scored early", "scored late")
+    assert elapsed < 1
+
+
+def test_model_error_reaches_every_waiter():
+    error = ValueError("model failed")
+    results = run(Model(error=error), ["a", "b", "c"], max_batch_size=32, max_wait_ms=20)
+
+    assert all(result is error for result in results)
+
+
+def test_stop_fails_the_batch_being_scored():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_model(texts: list) -> list:
+        started.set()
+        release.wait(5)
+        return [f"scored {text}" for text in texts]
+
+    async def main():
+        engine = BatchInferenceEngine(slow_model, max_batch_size=32, max_wait_ms=5)
+        await engine.start()
+        running = [asyncio.ensure_future(engine.predict(text)) for text in ("a", "b")]
+        await asyncio.to_thread(started.wait, 5)
+        queued = asyncio.ensure_future(engine.predict("c"))
+        await asyncio.sleep(0)
+        try:
+            await engine.stop()
+            return await asyncio.wait_for(asyncio.gather(*running, queued, return_exceptions=True), timeout=1)
+        finally:
+            release.set()
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_engine_must_be_started():
+    engine = BatchInferenceEngine(Model())
+    with pytest.raises(RuntimeError):
+        asyncio.run(engine.predict("text"))
@@ -0,0 +1,102 @@
+import asyncio
+import time
+import pytest
+from util.coalesce import coalesce
+
+
+def counted(ttl: float = 0, normalize: dict = None, error: Exception = None):
+    '''
+        Coalesced async function that records every real run and yields once so calls overlap
+    '''
+    runs = []
+
+    @coalesce(ttl=ttl, normalize=normalize)
+    async def fetch(ticker: str, company: str = None, days: list = None):
+        runs.append((ticker, company, days))
+        await asyncio.sleep(0.01)
+        if error is not None:
+            raise error
+        return {"ticker": ticker, "runs": len(runs)}
+
+    return fetch, runs
+
+
+def test_identical_concurrent_calls_run_once():
+    fetch, runs = counted()
+
+    async def main():
+        return await asyncio.gather(*(fetch("SPY", company="Apple", days=[1, 2]) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(runs) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_different_arguments_do_not_share_a_call():
+    fetch, runs = counted(normalize={"company": str.lower})
+
+    async def main():
+        return await asyncio.gather(fetch("SPY", "Apple"), fetch("QQQ", "Apple"), fetch("SPY", "Tesla"),
+                                    fetch("SPY", "Apple", [1]),
+                                    # Only the normalized parameter may differ and still share
+                                    fetch("SPY", company="APPLE"))
+
+    results = asyncio.run(main())
+    assert len(runs) == 4
+    assert results[0] is results[4]
+
+
+def test_results_are_reused_until_the_ttl_expires():
+    fetch, runs = counted(ttl=0.1)
+
+    async def main():
+        first = await fetch("SPY")
+        second = await fetch("SPY")
+        await asyncio.sleep(0.15)
+        third = await fetch("SPY")
+        return first, second, third
+
+    first, second, third = asyncio.run(main())
+    assert first is second
+    assert third is not first and len(runs) == 2
+
+
+def test_without_ttl_only_overlapping_calls_share():
+    fetch, runs = counted()
+
+    async def main():
+        await fetch("SPY")
+        await fetch("SPY")
+
+    asyncio.run(main())
+    assert len(runs) == 2
+
+
+def test_error_reaches_every_joined_caller_and_is_not_cached():
+    error = ValueError("provider down")
+    fetch, runs = counted(ttl=60, error=error)
+
+    async def main():
+        results = await asyncio.gather(*(fetch("SPY") for _ in range(3)), return_exceptions=True)
+        with pytest.raises(ValueError):
+            await fetch("SPY")
+        return results
+
+    results = asyncio.run(main())
+    assert all(result is error for result in results)
+    # The failure was not reused, the later call ran again
+    assert len(runs) == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_call():
+    fetch, runs = counted()
+
+    async def main():
+        first = asyncio.ensure_future(fetch("SPY"))
+        second = asyncio.ensure_future(fetch("SPY"))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main())["ticker"] == "SPY"
+    assert len(runs) == 1
@@ -0,0 +1,150 @@
+import asyncio
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.lib.stride_tricks import sliding_window_view
+from util.correlation import lagged_rolling_correlations, EXACT_MAX_WINDOW
+
+
+# Reference: every window centered on its own mean, no running sums
+def exact_rolling_corr(x: np.ndarray, y: np.ndarray, window: int) -> np.ndarray:
+    result = np.full(len(x), np.nan)
+    xs = sliding_window_view(x, window)
+    ys = sliding_window_view(y, window)
+    xs = xs - xs.mean(axis=1, keepdims=True)
+    ys = ys - ys.mean(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result[window - 1:] = (xs * ys).sum(axis=1) / np.sqrt((xs * xs).sum(axis=1) * (ys * ys).sum(axis=1))
+    return result
+
+
+def pandas_rolling_corr(x: np.ndarray, y: np.ndarray, window: int, lag: int = 0) -> np.ndarray:
+    return pd.Series(x).rolling(window).corr(pd.Series(y).shift(lag)).to_numpy()
+
+
+def kernel(x, y, window: int, lag: int = 0) -> np.ndarray:
+    return lagged_rolling_correlations(x, y, [window], [lag])[0, 0, :, 0, 0]
+
+
+def price_path(rng, rows: int, start: float = 100, volatility: float = 0.01) -> np.ndarray:
+    return start * np.exp(np.cumsum(rng.normal(0, volatility, rows)))
+
+
+@pytest.mark.parametrize("window", [3, 7, 14, 30])
+@pytest.mark.parametrize("lag", [0, 1, 5, -2])
+def test_matches_pandas_on_well_conditioned_series(window, lag):
+    rng = np.random.default_rng(window * 10 + lag)
+    x, y = rng.normal(0, 1, 500), rng.normal(0, 1, 500) + rng.normal(0, 1, 500)
+
+    expected = pandas_rolling_corr(x, y, window, lag)
+    result = kernel(x, y, window, lag)
+
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-9, equal_nan=True)
+
+
+@pytest.mark.parametrize("window", [2, 3, 7, 30])
+def test_price_series_match_exact_correlation(window):
+    rng = np.random.default_rng(window)
+    x, y = price_path(rng, 1000), rng.normal(50, 20, 1000)
+
+    exact = exact_rolling_corr(x, y, window)
+    result = kernel(x, y, window)
+
+    np.testing.assert_allclose(result, exact, rtol=0, atol=1e-10 if window <= EXACT_MAX_WINDOW else 1e-9, equal_nan=True)
+    # pandas loses digits on these, most of all at window 2 (up to ~1e-4)
+    np.testing.assert_allclose(result, pandas_rolling_corr(x, y, window), rtol=0, atol=1e-3, equal_nan=True)
+
+
+def test_window_of_two_is_plus_or_minus_one():
+    rng = np.random.default_rng(2)
+    x, y = price_path(rng, 500, start=1e4), price_path(rng, 500, start=3e3)
+
+    result = kernel(x, y, 2)[1:]
+
+    np.testing.assert_allclose(np.abs(result), 1, rtol=0, atol=1e-12)
+    np.testing.assert_array_equal(np.sign(result), np.sign(np.diff(x) * np.diff(y)))
+
+
+@pytest.mark.parametrize("window", [2, 5, 7, 20])
+def test_near_flat_windows_match_exact_correlation(window):
+    rng = np.random.default_rng(window)
+    # Moves of 1e-6 on a level of 1000, pandas is off by up to ~1e-2 at window 2 here
+    x, y = 1000 + rng.normal(0, 1e-6, 600), rng.normal(0, 1, 600)
+
+    result = kernel(x, y, window)
+
+    np.testing.assert_allclose(result, exact_rolling_corr(x, y, window), rtol=0, atol=1e-8, equal_nan=True)
+    assert not np.isnan(result[window - 1:]).any()
+
+
+def test_constant_windows_are_nan():
+    rng = np.random.default_rng(0)
+    x = rng.normal(100, 5, 200)
+    x[50:80] = 101.25
+    y = rng.normal(0, 1, 200)
+
+    for window in (2, 7, 14):
+        result = kernel(x, y, window)
+        expected = pandas_rolling_corr(x, y, window)
+        constant = np.zeros(200, dtype=bool)
+        constant[50 + window - 1:80] = True
+
+        # pandas gives ±inf or NaN for a window with no variance, there is no correlation to give
+        assert np.isnan(result[constant]).all()
+        assert not np.isfinite(expected[constant]).any()
+        np.testing.assert_allclose(result[~constant], expected[~constant], rtol=0, atol=1e-6, equal_nan=True)
+
+
+def test_constant_signal_is_nan():
+    x = np.random.default_rng(0).normal(0, 1, 100)
+    assert np.isnan(kernel(x, np.full(100, 3.0), 7)).all()
+
+
+def test_windows_with_missing_values_are_nan_like_pandas():
+    rng = np.random.default_rng(3)
+    x, y = rng.normal(0, 1, 300), rng.normal(0, 1, 300)
+    x[[20, 21, 150]] = np.nan
+    y[200] = np.nan
+
+    for window in (3, 7, 30):
+        expected = pandas_rolling_corr(x, y, window)
+        result = kernel(x, y, window)
+        np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-9, equal_nan=True)
+
+
+def test_many_lags_and_windows_match_one_at_a_time():
+    rng = np.random.default_rng(4)
+    targets = np.column_stack([price_path(rng, 400) for _ in range(3)])
+    signals = rng.normal(0, 1, (400, 2))
+    windows, lags = [2, 7, 30], [0, 1, 3]
+
+    result = lagged_rolling_correlations(targets, signals, windows, lags)
+
+    assert result.shape == (3, 3, 400, 3, 2)
+    for i, lag in enumerate(lags):
+        for j, window in enumerate(windows):
+            for t in range(3):
+                for s in range(2):
+                    np.testing.assert_allclose(result[i, j, :, t, s], kernel(targets[:, t], signals[:, s], window, lag),
+                                               rtol=0, atol=1e-12, equal_nan=True)
+
+
+def test_calculate_rolling_correlations_fills_warm_up_and_constant_windows_with_zero():
+    from util.util import calculate_rolling_correlations
+
+    rng = np.random.default_rng(5)
+    timestamps = pd.date_range("2024-01-01", periods=60).strftime("%Y-%m-%d")
+    price = price_path(rng, 60)
+    price[20:35] = price[20]
+    stock_data = pd.DataFrame({"timestamp": timestamps, "price": price})
+    fear_greed = pd.DataFrame({"timestamp": timestamps, "fear_greed_score": rng.uniform(0, 100, 60)})
+
+    result = asyncio.run(calculate_rolling_correlations(stock_data, fear_greed, window_size=7))
+    expected = pandas_rolling_corr(price, fear_greed["fear_greed_score"].to_numpy(), 7)
+
+    assert list(stock_data.columns) == ["timestamp", "price"]
+    finite = np.isfinite(expected)
+    np.testing.assert_allclose(result["correlation"][finite], expected[finite], rtol=0, atol=1e-9)
+    assert (result["correlation"][~finite] == 0).all()
@@ -0,0 +1,100 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+import pytest
+from services.inference_server import RemoteModel
+
+APP_DIR = Path(__file__).parent.parent
+
+# The server with a stub model in place of the ONNX one, each answer carries the server's generation
+SERVER = '''
+import asyncio, sys, types
+import numpy as np
+
+def predict_sentiment_batch(model, tokenizer, texts):
+    if "fail" in texts:
+        raise ValueError("model failed")
+    return [np.array([len(text), model], dtype=np.float32) for text in texts]
+
+stub = types.ModuleType("services.resource_init")
+stub.load_sentiment_model = lambda: (float(sys.argv[2]), None)
+stub.predict_sentiment_batch = predict_sentiment_batch
+sys.modules["services.resource_init"] = stub
+
+from services.inference_server import serve
+asyncio.run(serve(sys.argv[1]))
+'''
+
+
+def start_server(path: Path, generation: int) -> subprocess.Popen:
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(APP_DIR), os.environ.get("PYTHONPATH")]))}
+    server = subprocess.Popen([sys.executable, "-c", SERVER, str(path), str(generation)], cwd=APP_DIR, env=env)
+
+    # Listening once a connection is accepted
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        assert server.poll() is None, "inference server exited"
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(path))
+                return server
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.05)
+    server.kill()
+    raise TimeoutError("inference server did not start")
+
+
+def stop_server(server: subprocess.Popen):
+    server.kill()
+    server.wait()
+
+
+@pytest.fixture
+def path(tmp_path) -> Path:
+    return tmp_path / "inference.sock"
+
+
+def test_round_trip(path):
+    server = start_server(path, generation=1)
+    model = RemoteModel(str(path), connect_timeout=5, request_timeout=5)
+    try:
+        probabilities = model.predict_batch(["up", "down", ""])
+        assert [p.tolist() for p in probabilities] == [[2, 1], [4, 1], [0, 1]]
+        assert all(p.dtype.name == "float32" for p in probabilities)
+
+        # A failed batch is reported, the connection stays usable
+        with pytest.raises(RuntimeError, match="model failed"):
+            model.predict_batch(["ok", "fail"])
+        assert model.predict_batch(["again"])[0].tolist() == [5, 1]
+    finally:
+        model.close()
+        stop_server(server)
+
+
+def test_client_reconnects_after_the_server_restarts(path):
+    server = start_server(path, generation=1)
+    model = RemoteModel(str(path), connect_timeout=5, request_timeout=5, backoff=0.05)
+    try:
+        assert model.predict_batch(["text"])[0].tolist() == [4, 1]
+        connection = model.sock
+
+        stop_server(server)
+        server = start_server(path, generation=2)
+
+        # The broken connection is dropped and the batch sent again to the new server
+        assert model.predict_batch(["text"])[0].tolist() == [4, 2]
+        assert model.sock is not connection
+    finally:
+        model.close()
+        stop_server(server)
+
+
+def test_no_server_fails_once_connect_timeout_runs_out(path):
+    model = RemoteModel(str(path), connect_timeout=0.2, backoff=0.05)
+    start = time.monotonic()
+    with pytest.raises(FileNotFoundError):
+        model.predict_batch(["text"])
+    assert time.monotonic() - start < 2
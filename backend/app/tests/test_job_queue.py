@@ -0,0 +1,136 @@
+import asyncio
+import pytest
+import routers.analysis_jobs
+import services.job_queue
+from services.job_queue import JobQueue, QueueFullError
+
+
+def job(name: str, delay: float = 0.01):
+    async def run(progress):
+        await asyncio.sleep(delay)
+        return name
+    return run
+
+
+def test_overflowing_max_queued_is_rejected():
+    queue = JobQueue(workers=1, max_queued=2)
+
+    async def main():
+        await queue.start()
+        try:
+            first = queue.submit(job("a"), key="a")
+            queue.submit(job("b"))
+            with pytest.raises(QueueFullError):
+                queue.submit(job("c"))
+            # A job already waiting under the same key is returned, not queued again
+            assert queue.submit(job("a"), key="a") is first
+            assert queue.queued() == 2
+        finally:
+            await queue.stop()
+
+    asyncio.run(main())
+
+
+def test_full_queue_answers_429(monkeypatch):
+    queue = JobQueue(workers=1, max_queued=1)
+    monkeypatch.setattr(routers.analysis_jobs, "analysis_jobs", queue)
+
+    async def main():
+        await queue.start()
+        try:
+            accepted = await routers.analysis_jobs.submit_market_analysis("SPY", "Apple")
+            same = await routers.analysis_jobs.submit_market_analysis("SPY", "apple")
+            rejected = await routers.analysis_jobs.submit_market_analysis("QQQ", "Nvidia")
+        finally:
+            await queue.stop()
+        return accepted, same, rejected
+
+    accepted, same, rejected = asyncio.run(main())
+    assert accepted["status"] == "queued" and accepted["queue_position"] == 0
+    # The same analysis joins the queued job instead of taking another place
+    assert same["job_id"] == accepted["job_id"]
+    assert rejected.status_code == 429 and rejected.headers["Retry-After"] == "30"
+
+
+def test_jobs_run_by_priority_with_bounded_concurrency():
+    queue = JobQueue(workers=2, max_queued=10)
+    started = []
+    concurrent = 0
+    peak = 0
+
+    def tracked(name: str):
+        async def run(progress):
+            nonlocal concurrent, peak
+            started.append(name)
+            concurrent += 1
+            peak = max(peak, concurrent)
+            await asyncio.sleep(0.01)
+            concurrent -= 1
+            return name
+        return run
+
+    async def main():
+        await queue.start()
+        # Submitted before any worker gets to run, so the queue orders them all
+        jobs = [queue.submit(tracked(name), priority=priority)
+                for name, priority in [("low", 0), ("high", 5), ("low 2", 0), ("urgent", 9), ("mid", 2)]]
+        while any(j["status"] != "done" for j in jobs):
+            await asyncio.sleep(0.005)
+        await queue.stop()
+        return jobs
+
+    jobs = asyncio.run(main())
+    assert started == ["urgent", "high", "mid", "low", "low 2"]
+    assert peak == 2
+    assert [j["result"] for j in jobs] == ["low", "high", "low 2", "urgent", "mid"]
+
+
+def test_progress_updates_the_job_status():
+    queue = JobQueue(workers=1)
+    seen = []
+    release = None
+
+    async def run(progress):
+        progress("prices", 0.25)
+        await release.wait()
+        progress("sentiment", 0.5)
+        await asyncio.sleep(0)
+        raise ValueError("no posts")
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        await queue.start()
+        submitted = queue.submit(run)
+        await asyncio.sleep(0.01)
+        seen.append((submitted["status"], submitted["stage"], submitted["progress"]))
+        release.set()
+        await queue.queue.join()
+        await queue.stop()
+        return queue.get(submitted["job_id"])
+
+    finished = asyncio.run(main())
+    assert seen == [("running", "prices", 0.25)]
+    # A failed job keeps the stage it got to
+    assert (finished["status"], finished["stage"], finished["progress"]) == ("failed", "sentiment", 0.5)
+    assert finished["error"] == "no posts"
+
+
+def test_finished_jobs_are_pruned_after_retention(monkeypatch):
+    queue = JobQueue(workers=1, retention_seconds=60)
+    now = [1000.0]
+    monkeypatch.setattr(services.job_queue.time, "time", lambda: now[0])
+
+    async def main():
+        await queue.start()
+        done = queue.submit(job("done", delay=0), key="k")
+        await queue.queue.join()
+        await queue.stop()
+        return done["job_id"]
+
+    job_id = asyncio.run(main())
+    now[0] += 60
+    assert queue.get(job_id)["status"] == "done"
+    now[0] += 1
+    assert queue.get(job_id) is None
+    assert job_id not in queue.jobs and "k" not in queue.active
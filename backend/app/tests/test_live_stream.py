@@ -0,0 +1,109 @@
+import asyncio
+import pandas as pd
+import pytest
+import services.live_stream
+from services.live_stream import LiveFeed, completed_bars
+from util.market_calendar import market_today
+
+
+class Prices:
+    '''
+        Price store stand-in, every poll returns three bars per symbol of which the last is still forming
+    '''
+    def __init__(self):
+        self.calls = []
+
+    async def get_prices(self, symbols: list, start_date: str, end_date: str, interval: str, download) -> dict:
+        self.calls.append(tuple(symbols))
+        dates = pd.date_range(start_date, periods=3, freq="h")
+        return {symbol: pd.DataFrame({"Date": dates, "Close": [1.0, 2.0, 3.0]}) for symbol in symbols}
+
+
+@pytest.fixture
+def prices(monkeypatch):
+    prices = Prices()
+    monkeypatch.setattr(services.live_stream, "price_store", prices)
+    monkeypatch.setattr(services.live_stream, "BAR_POLLERS", {})
+    # Half way through the third bar
+    prices.now = market_today() + pd.Timedelta(hours=2, minutes=30)
+    monkeypatch.setattr(services.live_stream, "market_now", lambda: prices.now)
+    return prices
+
+
+def test_streams_of_a_symbol_set_share_one_poller(prices):
+    async def main():
+        feeds = [LiveFeed("1h", "technology", "Apple", poll_seconds=0.05) for _ in range(3)]
+        queues = [asyncio.Queue() for _ in range(4)]
+        tasks = [asyncio.create_task(feed.poll_bars(["AAPL", "^VIX"], queue, {})) for feed, queue in zip(feeds, queues)]
+        other = asyncio.create_task(feeds[0].poll_bars(["TSLA", "^VIX"], queues[3], {}))
+        await asyncio.sleep(0.12)
+
+        pollers = dict(services.live_stream.BAR_POLLERS)
+        shared = pollers[(("AAPL", "^VIX"), "1h")]
+        polls = prices.calls.count(("AAPL", "^VIX"))
+        subscribers = len(shared.subscribers)
+
+        # The poller outlives every subscriber but the last
+        for task in tasks[:-1]:
+            task.cancel()
+        await asyncio.sleep(0)
+        still_polling = services.live_stream.BAR_POLLERS.get((("AAPL", "^VIX"), "1h")) is shared and not shared.task.done()
+
+        poller_task = shared.task
+        tasks[-1].cancel()
+        other.cancel()
+        await asyncio.gather(*tasks, other, return_exceptions=True)
+        await asyncio.sleep(0)
+        return pollers, polls, subscribers, still_polling, poller_task, queues
+
+    pollers, polls, subscribers, still_polling, poller_task, queues = asyncio.run(main())
+    assert set(pollers) == {(("AAPL", "^VIX"), "1h"), (("TSLA", "^VIX"), "1h")}
+    assert subscribers == 3
+    # One download per poll, not one per stream
+    assert 1 <= polls <= 3
+    assert still_polling
+    assert services.live_stream.BAR_POLLERS == {} and poller_task.cancelled()
+
+    # Every stream got the completed bars of both symbols, the forming one is held back
+    for queue in queues:
+        events = [queue.get_nowait() for _ in range(queue.qsize())]
+        assert sorted(close for _, _, _, close in events) == [1.0, 1.0, 2.0, 2.0]
+
+
+def test_bars_already_sent_are_not_sent_again(prices):
+    async def main():
+        queue = asyncio.Queue()
+        since = {"AAPL": pd.Timestamp("2000-01-01")}
+        task = asyncio.create_task(LiveFeed("1h", "technology", "Apple", poll_seconds=0.02).poll_bars(["AAPL"], queue, since))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return [queue.get_nowait() for _ in range(queue.qsize())], len(prices.calls)
+
+    events, polls = asyncio.run(main())
+    # Several polls returned the same two completed bars
+    assert polls > 1
+    assert [close for _, _, _, close in events] == [1.0, 2.0]
+
+
+def test_last_bar_is_sent_once_its_interval_ended(prices):
+    async def main():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(LiveFeed("1h", "technology", "Apple", poll_seconds=0.02).poll_bars(["AAPL"], queue, {}))
+        await asyncio.sleep(0.05)
+        # No later bar comes, e.g. after the close
+        prices.now += pd.Timedelta(hours=1)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    assert [close for _, _, _, close in asyncio.run(main())] == [1.0, 2.0, 3.0]
+
+
+def test_session_close_completes_the_last_bar():
+    bars = pd.DataFrame({"Date": pd.to_datetime(["2024-06-03 14:30", "2024-06-03 15:30"]), "Close": [1.0, 2.0]})
+    # The 15:30 hourly bar ends with the session, not at 16:30
+    assert len(completed_bars(bars, "1h", pd.Timestamp("2024-06-03 15:59"))) == 1
+    assert len(completed_bars(bars, "1h", pd.Timestamp("2024-06-03 16:00"))) == 2
+    assert len(completed_bars(bars.iloc[:0], "1h", pd.Timestamp("2024-06-03 16:00"))) == 0
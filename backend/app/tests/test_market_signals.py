@@ -0,0 +1,121 @@
+import asyncio
+import numpy as np
+import pandas as pd
+import pytest
+from routers.analyze_market import build_market_signals
+from util.util import process_sentiment_data
+
+ACTIONS = ["Momentum trade", "Potential exit", "Mixed signal", "no signal"]
+
+
+def social_days(sentiments: list, start: str = "2024-03-01") -> pd.DataFrame:
+    days = pd.date_range(start, periods=len(sentiments))
+    return pd.DataFrame({
+        "timestamp": days.strftime("%Y-%m-%d"),
+        "sentiment": sentiments,
+        "article_url": [f"https://example.com/{i}" for i in range(len(sentiments))],
+        "title": [f"title {i}" for i in range(len(sentiments))],
+        "top_comment": [f"comment {i}" for i in range(len(sentiments))],
+    })
+
+
+def price_rows(timestamps, correlations) -> pd.DataFrame:
+    return pd.DataFrame({
+        "timestamp": list(timestamps),
+        "price": np.linspace(100, 110, len(correlations)),
+        "fear_greed_score": np.linspace(40, 60, len(correlations)),
+        "correlation": correlations,
+    })
+
+
+# The rules build_market_signals applies, one row at a time
+def expected_action(positive_spike: bool, negative_spike: bool, correlation: float) -> str:
+    if positive_spike and correlation > 0.3:
+        return "Momentum trade"
+    if negative_spike and correlation > 0.3:
+        return "Potential exit"
+    if (positive_spike or negative_spike) and correlation <= 0:
+        return "Mixed signal"
+    return "no signal"
+
+
+def test_actions_follow_spikes_and_correlation_thresholds():
+    # Flat sentiment with one strong positive and one strong negative day
+    sentiments = [0.0] * 30
+    sentiments[10], sentiments[20] = 40.0, -40.0
+    social = social_days(sentiments)
+    days = social["timestamp"].tolist()
+    # Around each spike: above 0.3, exactly 0.3, between 0 and 0.3, exactly 0 and negative
+    correlations = np.full(30, 0.5)
+    correlations[[11, 21]] = 0.3
+    correlations[[12, 22]] = 0.1
+    correlations[[13, 23]] = 0.0
+    correlations[[14, 24]] = -0.6
+
+    result = asyncio.run(build_market_signals(price_rows(days, correlations), social.copy()))
+    merged = result["market_analyzed"]
+
+    positive, negative, processed = asyncio.run(process_sentiment_data(pd.Timestamp(days[0]), social.copy(), missing=None))
+    assert result["extreme_postive_threshold"] == pytest.approx(positive)
+    assert result["extreme_negative_threshold"] == pytest.approx(negative)
+
+    assert processed["positive_spike"].iloc[10:15].all() and processed["negative_spike"].iloc[20:25].all()
+    expected = [expected_action(p, n, c) for p, n, c in zip(processed["positive_spike"], processed["negative_spike"], correlations)]
+    assert merged["action"].astype(str).tolist() == expected
+    assert merged["action"].iloc[10] == "Momentum trade"
+    assert merged["action"].iloc[11:13].tolist() == ["no signal", "no signal"]
+    assert merged["action"].iloc[13:15].tolist() == ["Mixed signal", "Mixed signal"]
+    assert merged["action"].iloc[20] == "Potential exit"
+
+
+def test_action_is_categorical_with_every_label():
+    social = social_days(list(np.random.default_rng(0).normal(0, 10, 40)))
+    correlations = np.random.default_rng(1).uniform(-1, 1, 40)
+
+    merged = asyncio.run(build_market_signals(price_rows(social["timestamp"], correlations), social.copy()))["market_analyzed"]
+
+    assert isinstance(merged["action"].dtype, pd.CategoricalDtype)
+    assert merged["action"].cat.categories.tolist() == ACTIONS
+    assert not merged["action"].isna().any()
+    assert list(merged.columns[:4]) == ["timestamp", "price", "fear_greed_score", "correlation"]
+
+
+def test_price_days_without_sentiment_have_no_signal():
+    social = social_days([5.0, -5.0, 30.0, -30.0, 2.0] * 4)
+    # Price rows go on for a week after the last post
+    days = pd.date_range("2024-03-01", periods=27).strftime("%Y-%m-%d")
+
+    merged = asyncio.run(build_market_signals(price_rows(days, np.full(27, 0.8)), social.copy()))["market_analyzed"]
+
+    assert len(merged) == 27
+    assert (merged["action"].iloc[20:] == "no signal").all()
+
+
+def test_hourly_bars_take_the_sentiment_of_their_day():
+    sentiments = [0.0] * 10 + [40.0]
+    social = social_days(sentiments)
+    hours = pd.date_range("2024-03-10 09:00", periods=30, freq="h").strftime("%Y-%m-%d %H:%M:%S")
+
+    merged = asyncio.run(build_market_signals(price_rows(hours, np.full(30, 0.5)), social.copy()))["market_analyzed"]
+
+    assert merged["timestamp"].tolist() == list(hours)
+    on_spike_day = merged["timestamp"].str.startswith("2024-03-11")
+    assert (merged.loc[on_spike_day, "action"] == "Momentum trade").all()
+    assert (merged.loc[~on_spike_day, "action"] == "no signal").all()
+    assert merged["sentiment"].notna().all()
+
+
+def test_hourly_posts_count_with_the_strongest_of_their_day():
+    sentiments = [0.0] * 10 + [40.0]
+    daily = social_days(sentiments)
+    # The same days as hourly rows, a weaker post in another hour of every day
+    hourly = pd.concat([daily.assign(timestamp=daily["timestamp"] + " 10:00:00"),
+                        daily.assign(timestamp=daily["timestamp"] + " 15:00:00", sentiment=daily["sentiment"] / 4,
+                                     title="weaker")]).sort_values("timestamp", kind="stable").reset_index(drop=True)
+    hours = pd.date_range("2024-03-10 09:00", periods=30, freq="h").strftime("%Y-%m-%d %H:%M:%S")
+
+    from_daily = asyncio.run(build_market_signals(price_rows(hours, np.full(30, 0.5)), daily.copy()))
+    from_hourly = asyncio.run(build_market_signals(price_rows(hours, np.full(30, 0.5)), hourly.copy()))
+
+    pd.testing.assert_frame_equal(from_hourly["market_analyzed"], from_daily["market_analyzed"])
+    assert from_hourly["extreme_postive_threshold"] == from_daily["extreme_postive_threshold"]
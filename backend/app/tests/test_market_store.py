@@ -0,0 +1,190 @@
+import asyncio
+import pandas as pd
+from services.market_store import MarketStore
+from services.reddit import missing_span
+
+
+def days(*timestamps, sentiment: float = 0.5) -> pd.DataFrame:
+    return pd.DataFrame({"timestamp": list(timestamps), "sentiment": [sentiment] * len(timestamps)})
+
+
+def stored(collection, key: str) -> dict:
+    return {document["timestamp"]: document["sentiment"] for document in collection.documents if document["key"] == key}
+
+
+def test_bulk_upsert_updates_inserts_and_prunes_in_one_batch(database):
+    collection = database.get_collection("daily_sentiment")
+
+    async def main():
+        first = await database.bulk_upsert(collection, [
+            {"key": "a", "timestamp": day, "sentiment": 0.1} for day in ("2024-03-01", "2024-03-02", "2024-03-03")
+        ] + [{"key": "b", "timestamp": "2024-03-02", "sentiment": 0.9}], keys=("key", "timestamp"))
+
+        second = await database.bulk_upsert(collection, [
+            {"key": "a", "timestamp": "2024-03-02", "sentiment": 0.1},
+            {"key": "a", "timestamp": "2024-03-03", "sentiment": -0.4},
+            {"key": "a", "timestamp": "2024-03-04", "sentiment": 0.2},
+        ], keys=("key", "timestamp"), prune={"key": "a", "timestamp": {
+            "$gte": "2024-03-02", "$lt": "2024-03-05", "$nin": ["2024-03-02", "2024-03-03", "2024-03-04"]}})
+
+        nothing = await database.bulk_upsert(collection, [], keys=("key", "timestamp"))
+        return first, second, nothing
+
+    first, second, nothing = asyncio.run(main())
+    assert first == 4
+    # One changed and one new row, the unchanged one doesn't count
+    assert second == 2
+    assert nothing == 0 and len(collection.bulk_writes) == 2
+    assert stored(collection, "a") == {"2024-03-01": 0.1, "2024-03-02": 0.1, "2024-03-03": -0.4, "2024-03-04": 0.2}
+    assert stored(collection, "b") == {"2024-03-02": 0.9}
+
+
+def test_rewritten_range_prunes_rows_that_are_gone(database):
+    store = MarketStore(database)
+    collection = database.get_collection("indicators")
+
+    async def main():
+        await store.write_series("indicators", "k", days("2024-03-01", "2024-03-02", "2024-03-03"), "2024-03-01", "2024-03-04")
+        await store.write_series("indicators", "k", days("2024-03-03", "2024-03-04", sentiment=-0.5), "2024-03-02", "2024-03-05")
+        return await store.read_series("indicators", "k", "2024-03-02", "2024-03-05")
+
+    rows = asyncio.run(main())
+    # 03-02 was in the rewritten range but not in the new rows, 03-01 was outside it
+    assert stored(collection, "k") == {"2024-03-01": 0.5, "2024-03-03": -0.5, "2024-03-04": -0.5}
+    assert rows.to_dict("list") == {"timestamp": ["2024-03-03", "2024-03-04"], "sentiment": [-0.5, -0.5]}
+    assert len(collection.bulk_writes) == 2
+
+
+def test_read_series_only_answers_for_covered_and_fresh_ranges(database):
+    store = MarketStore(database)
+
+    async def main():
+        await store.write_series("indicators", "k", days("2024-03-01", "2024-03-02"), "2024-03-01", "2024-03-08")
+        return (await store.read_series("indicators", "k", "2024-03-02", "2024-03-08"),
+                await store.read_series("indicators", "k", "2024-02-28", "2024-03-08"),
+                await store.read_series("indicators", "k", "2024-03-01", "2024-03-09"),
+                await store.read_series("indicators", "k", "2024-03-01", "2024-03-08", max_age=-1),
+                await store.read_series("indicators", "other", "2024-03-01", "2024-03-08"))
+
+    inside, before, after, stale, other = asyncio.run(main())
+    assert inside["timestamp"].tolist() == ["2024-03-02"] and list(inside.columns) == ["timestamp", "sentiment"]
+    assert before is None and after is None and stale is None and other is None
+
+
+def test_coverage_of_one_search_grows_over_touching_ranges(database):
+    store = MarketStore(database)
+
+    async def main():
+        await store.write_social_days("Technology", "Apple", days("2024-03-01"), "2024-03-01", "2024-03-05", "month", 250)
+        await store.write_social_days("technology", "apple", days("2024-03-06"), "2024-03-05", "2024-03-10", "month", 250)
+        # Not touching, the days between stay missing
+        await store.write_social_days("technology", "other", days("2024-03-01"), "2024-03-01", "2024-03-05", "month", 250)
+        await store.write_social_days("technology", "other", days("2024-03-07"), "2024-03-07", "2024-03-10", "month", 250)
+        return (await store.read_social_days("technology", "apple", "2024-02-01", "2024-04-01", "month", 250),
+                await store.read_social_days("technology", "other", "2024-03-01", "2024-03-10", "month", 250))
+
+    (rows, covered_start, covered_end), (_, *other) = asyncio.run(main())
+    assert (covered_start, covered_end) == ("2024-03-01", "2024-03-10")
+    assert rows["timestamp"].tolist() == ["2024-03-01", "2024-03-06"]
+    assert len(database.get_collection("coverage").documents[0]["segments"]) == 1
+    # Crawling from 03-05 to the end is shorter than up to 03-07
+    assert other == ["2024-03-01", "2024-03-05"]
+
+
+def test_days_only_cover_searches_at_most_as_sparse(database):
+    store = MarketStore(database)
+    start, end = "2024-03-01", "2024-03-08"
+
+    async def main():
+        # A "year" search of 250 posts spreads them over many more days than a "week" one
+        await store.write_social_days("technology", "Apple", days("2024-03-02"), "2024-02-01", end, "year", 250)
+        sparse = [await store.read_social_days("technology", "Apple", start, end, time_filter, limit)
+                  for time_filter, limit in (("year", 250), ("all", 100), ("week", 250), ("year", 500))]
+        # The week's days are rewritten by the denser search, the rest of the year's stay as they were
+        await store.write_social_days("technology", "Apple", days("2024-03-03"), "2024-03-03", end, "week", 500)
+        dense = [await store.read_social_days("technology", "Apple", start, end, time_filter, limit)
+                 for time_filter, limit in (("week", 250), ("day", 500), ("year", 250))]
+        return sparse, dense
+
+    (year, wider, week, more), (week_again, day, year_again) = asyncio.run(main())
+    assert year[1:] == wider[1:] == (start, end) and week is None and more is None
+    assert week_again[1:] == ("2024-03-03", end) and day is None
+    assert missing_span(start, end, [week_again]) == (start, "2024-03-03")
+    assert year_again[1:] == (start, end) and year_again[0]["timestamp"].tolist() == ["2024-03-02", "2024-03-03"]
+
+
+def test_indicator_windows_share_one_series_per_interval(database):
+    store = MarketStore(database)
+    collection = database.get_collection("indicators")
+
+    async def main():
+        await store.write_indicators({"vix": days("2024-03-01", "2024-03-04")}, "1d", "2024-03-01", "2024-03-05")
+        # Overlapping window, only the bars after the stored ones are written
+        await store.write_indicators({"vix": days("2024-03-04", "2024-03-07", sentiment=-0.5)}, "1d", "2024-03-04", "2024-03-08")
+        await store.write_indicators({"vix": days("2024-03-05")}, "1d", "2024-03-04", "2024-03-06")
+        return [await store.read_indicators(["vix"], "1d", start, end)
+                for start, end in (("2024-03-02", "2024-03-08"), ("2024-03-01", "2024-03-09"), ("2024-03-01", "2024-03-05"))]
+
+    inside, longer, first = asyncio.run(main())
+    assert stored(collection, "vix:1d") == {"2024-03-01": 0.5, "2024-03-04": 0.5, "2024-03-07": -0.5}
+    # The covered window adds nothing
+    assert len(collection.bulk_writes) == 2
+    assert len(database.get_collection("coverage").documents[0]["segments"]) == 1
+    assert inside["vix"].to_dict("list") == {"timestamp": ["2024-03-04", "2024-03-07"], "sentiment": [0.5, -0.5]}
+    assert longer is None
+    assert first["vix"]["timestamp"].tolist() == ["2024-03-01", "2024-03-04"]
+
+
+def test_missing_span_holds_every_uncovered_day(database):
+    store = MarketStore(database)
+    start, end = "2024-02-25", "2024-03-12"
+
+    async def read(*subreddits, max_age: float = None):
+        return await asyncio.gather(*(store.read_social_days(name, "Apple", start, end, "month", 250, max_age=max_age)
+                                      for name in subreddits))
+
+    async def main():
+        await store.write_social_days("technology", "Apple", days("2024-03-01"), "2024-03-01", "2024-03-10", "month", 250)
+        await store.write_social_days("stocks", "Apple", days("2024-02-20"), "2024-02-20", end, "month", 250)
+        return (await read("technology"), await read("stocks"), await read("technology", "stocks"),
+                await read("technology", "wallstreetbets"))
+
+    technology, stocks, both, unknown = asyncio.run(main())
+    # Both ends of the range are missing, one span holds them and the covered days between
+    assert technology[0][1:] == ("2024-03-01", "2024-03-10")
+    assert missing_span(start, end, technology) == (start, end)
+    assert missing_span(start, end, stocks) is None
+    assert missing_span(start, end, unknown) == (start, end)
+    assert missing_span(start, end, [None]) == (start, end)
+    assert missing_span(start, end, [(None, start, "2024-03-10")]) == ("2024-03-10", end)
+    assert missing_span(start, end, [(None, "2024-03-01", end), (None, start, "2024-03-05")]) == (start, end)
+
+
+def test_days_from_a_stale_write_are_not_covered(database):
+    store = MarketStore(database)
+    written_at = pd.Timestamp("2024-03-07 15:00", tz="America/New_York").timestamp()
+
+    async def main():
+        await store.write_social_days("technology", "Apple", days("2024-03-01", "2024-03-07"), "2024-03-01", "2024-03-08",
+                                      "week", 250)
+        database.get_collection("coverage").documents[0]["segments"][0]["updated_at"] = written_at
+        return await store.read_social_days("technology", "Apple", "2024-03-01", "2024-03-08", "week", 250, max_age=3600)
+
+    rows, covered_start, covered_end = asyncio.run(main())
+    # The day it was written on may have had more posts since, only that day is crawled again
+    assert (covered_start, covered_end) == ("2024-03-01", "2024-03-07")
+    assert rows["timestamp"].tolist() == ["2024-03-01"]
+    assert missing_span("2024-03-01", "2024-03-08", [(rows, covered_start, covered_end)]) == ("2024-03-07", "2024-03-08")
+
+
+def test_database_errors_read_as_misses(database):
+    store = MarketStore(database)
+    database.get_collection("coverage").failing = True
+
+    async def main():
+        await store.write_series("indicators", "k", days("2024-03-01"), "2024-03-01", "2024-03-02")
+        return (await store.read_series("indicators", "k", "2024-03-01", "2024-03-02"),
+                await store.read_social_days("technology", "Apple", "2024-03-01", "2024-03-02", "day", 250))
+
+    assert asyncio.run(main()) == (None, None)
+    assert asyncio.run(MarketStore().read_series("indicators", "k", "2024-03-01", "2024-03-02")) is None
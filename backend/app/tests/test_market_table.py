@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+import services.market_table
+import util.util
+from services.market_store import MarketStore
+from services.market_table import get_market_indicators, is_fresh
+from util.market_calendar import market_today
+from util.util import INDICATOR_NAMES, convert_time_filter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(services.market_table, "time", SimpleNamespace(time=lambda: clock.now))
+    monkeypatch.setattr(services.market_table, "MARKET_TABLE", {})
+    monkeypatch.setattr(services.market_table, "MARKET_TABLE_UPDATED", {})
+    monkeypatch.setattr(services.market_table, "table_locks", {})
+    monkeypatch.setattr(services.market_table, "INTRADAY_MAX_AGE_MINUTES", 5)
+    return clock
+
+
+@pytest.fixture
+def computed(monkeypatch):
+    computed = []
+
+    async def calculate_market_indicators(start_date, end_date, interval):
+        computed.append((start_date, end_date, interval))
+        return {"vix": pd.DataFrame({"timestamp": [start_date], "value": [len(computed)]})}
+    monkeypatch.setattr(services.market_table, "calculate_market_indicators", calculate_market_indicators)
+    return computed
+
+
+def read(start_date: str, end_date: str, interval: str) -> int:
+    return asyncio.run(get_market_indicators(start_date, end_date, interval))["vix"]["value"].iloc[0]
+
+
+def test_intraday_window_expires_after_max_age(clock, computed):
+    window = ("2024-06-03", "2024-06-04", "1h")
+    assert not is_fresh(window)
+    assert read(*window) == 1
+
+    clock.now += 5 * 60
+    assert is_fresh(window) and read(*window) == 1
+
+    # Older than INTRADAY_MAX_AGE_MINUTES, the next request computes it again
+    clock.now += 1
+    assert not is_fresh(window)
+    assert read(*window) == 2 and len(computed) == 2
+
+
+def test_daily_window_is_left_to_the_scheduler(clock, computed):
+    window = ("2023-06-03", "2024-06-04", "1d")
+    assert read(*window) == 1
+
+    clock.now += 24 * 3600
+    assert is_fresh(window) and read(*window) == 1
+    assert computed == [window]
+
+
+def test_concurrent_requests_for_an_expired_window_compute_it_once(clock, computed):
+    window = ("2024-06-03", "2024-06-04", "1h")
+    read(*window)
+    clock.now += 10 * 60
+
+    async def main():
+        return await asyncio.gather(*(get_market_indicators(*window) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(computed) == 2
+    assert all(result["vix"]["value"].iloc[0] == 2 for result in results)
+    # Every caller gets a copy of its own
+    assert results[0]["vix"] is not results[1]["vix"]
+
+
+def test_closed_windows_are_stored_and_read_back(monkeypatch, clock, database):
+    store = MarketStore(database)
+    monkeypatch.setattr(util.util, "market_store", store)
+    downloads = []
+
+    async def fetch_multiple_stock_data(tickers, start_date, end_date, interval):
+        downloads.append((start_date, end_date, interval))
+        dates = pd.bdate_range(start_date, end_date, inclusive="left")
+        return {ticker: pd.DataFrame({"Date": dates.strftime("%Y-%m-%d"),
+                                      f"Close_{ticker}": 100 + np.sin(np.arange(len(dates)) / (3 + i))})
+                for i, ticker in enumerate(tickers)}
+    monkeypatch.setattr(util.util, "fetch_multiple_stock_data", fetch_multiple_stock_data)
+
+    async def main():
+        window = await convert_time_filter("month")
+        computed = await get_market_indicators(*window)
+        # A restarted server only has the store
+        services.market_table.MARKET_TABLE.clear()
+        stored = await get_market_indicators(*window)
+        return window, computed, stored
+
+    window, computed, stored = asyncio.run(main())
+    # The "month" window ends at today's midnight, its bars are all closed
+    assert window[1] == market_today() and len(downloads) == 1
+    assert set(stored) == set(INDICATOR_NAMES) and len(computed["fear_greed_score"]) > 0
+    for name in INDICATOR_NAMES:
+        pd.testing.assert_frame_equal(stored[name].reset_index(drop=True), computed[name].reset_index(drop=True),
+                                      check_dtype=False)
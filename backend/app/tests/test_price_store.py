@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime
+import pandas as pd
+import pytest
+import services.price_store
+from services.price_store import PriceStore
+
+
+class Provider:
+    '''
+        Daily bars for every weekday in the asked range, or nothing while `failing`
+    '''
+    def __init__(self):
+        self.calls = []
+        self.failing = False
+
+    def __call__(self, symbols: list, start: str, end: str, interval: str) -> dict:
+        self.calls.append((tuple(symbols), start, end))
+        if self.failing:
+            return {}
+        days = pd.bdate_range(start, end, inclusive="left")
+        return {symbol: pd.DataFrame({"Date": days, "Close": range(len(days))}) for symbol in symbols}
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # Sunday 2024-06-09, the last session was Friday 2024-06-07
+    monkeypatch.setattr(services.price_store, "market_today", lambda: datetime(2024, 6, 9))
+    return PriceStore(tmp_path)
+
+
+def get(store, provider, start: str, end: str) -> pd.DataFrame:
+    return asyncio.run(store.get_prices(["SPY"], start, end, "1d", provider))["SPY"]
+
+
+def test_weekend_at_the_end_is_covered_without_a_download(store):
+    provider = Provider()
+    bars = get(store, provider, "2024-06-03", "2024-06-09")
+    assert provider.calls == [(("SPY",), "2024-06-03", "2024-06-08")]
+    assert len(bars) == 5
+    assert store.read_coverage("SPY", "1d") == (pd.Timestamp("2024-06-03"), pd.Timestamp("2024-06-09"))
+
+    # Asked again on the same (non-trading) day, everything is on disk
+    assert len(get(store, provider, "2024-06-03", "2024-06-09")) == 5
+    assert len(provider.calls) == 1
+
+
+def test_range_of_weekend_and_holiday_only_is_covered_without_a_download(store):
+    provider = Provider()
+    # Good Friday 2024-03-29 through Easter Sunday
+    assert get(store, provider, "2024-03-29", "2024-04-01").empty
+    assert provider.calls == []
+    assert store.read_coverage("SPY", "1d") == (pd.Timestamp("2024-03-29"), pd.Timestamp("2024-04-01"))
+
+
+def test_failed_download_is_asked_again(store):
+    provider = Provider()
+    provider.failing = True
+    assert get(store, provider, "2024-06-03", "2024-06-09").empty
+    assert store.read_coverage("SPY", "1d") is None
+
+    provider.failing = False
+    assert len(get(store, provider, "2024-06-03", "2024-06-09")) == 5
+    assert len(provider.calls) == 2
+
+
+def test_range_is_trimmed_to_its_trading_days(store):
+    provider = Provider()
+    get(store, provider, "2024-06-03", "2024-06-06")
+    # The gap after the coverage starts on the Thursday and ends before the weekend
+    get(store, provider, "2024-06-03", "2024-06-09")
+    assert provider.calls[-1] == (("SPY",), "2024-06-06", "2024-06-08")
+    assert store.read_coverage("SPY", "1d") == (pd.Timestamp("2024-06-03"), pd.Timestamp("2024-06-09"))
+
+
+def test_concurrent_requests_share_a_lock_that_is_dropped_afterwards(store):
+    provider = Provider()
+
+    async def main():
+        return await asyncio.gather(*(store.get_prices(["SPY", "QQQ"], "2024-06-03", "2024-06-08", "1d", provider)
+                                      for _ in range(3)))
+
+    results = asyncio.run(main())
+    # The first request filled the gap, the others waited for it and read it from disk
+    assert len(provider.calls) == 1
+    assert all(len(result["SPY"]) == 5 for result in results)
+    assert len(store.locks) == 0
@@ -0,0 +1,86 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+import services.reddit_crawler
+from services.reddit_crawler import AdaptiveLimiter, crawl, normalize_url
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.example.com/article/?utm_source=reddit&utm_medium=social", "example.com/article"),
+    ("https://example.com/a?ref=reddit&id=7", "example.com/a?id=7"),
+    ("https://example.com/a?ref_src=twsrc&fbclid=x&gclid=y", "example.com/a"),
+    # Only the exact tracking names are dropped, parameters that merely start like them stay
+    ("https://example.com/a?ref_id=42", "example.com/a?ref_id=42"),
+    ("https://example.com/a?reference=10-K&page=2", "example.com/a?page=2&reference=10-K"),
+    ("https://example.com/a?REF=x&Utm_Campaign=y", "example.com/a"),
+])
+def test_normalize_url(url, expected):
+    assert normalize_url(url) == expected
+
+
+def test_growing_the_limit_wakes_waiting_requests():
+    async def main():
+        limiter = AdaptiveLimiter(initial=1, maximum=4, target_latency=1.0)
+        entered = []
+
+        async def request(name: str):
+            async with limiter:
+                entered.append(name)
+                await asyncio.sleep(10)
+
+        first = asyncio.create_task(request("first"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(request("second"))
+        await asyncio.sleep(0.01)
+        assert entered == ["first"]
+
+        # A fast response while every slot is busy raises the limit, no slot was released
+        await limiter.record(latency=0.1)
+        await asyncio.sleep(0.01)
+        assert limiter.limit == 2
+        assert entered == ["first", "second"]
+
+        for task in (first, second):
+            task.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+
+    asyncio.run(main())
+
+
+def test_throttling_halves_the_limit():
+    async def main():
+        limiter = AdaptiveLimiter(initial=8)
+        await limiter.record(throttled=True)
+        assert limiter.limit == 4
+
+    asyncio.run(main())
+
+
+def test_known_posts_take_no_io_slot(monkeypatch):
+    limiter = AdaptiveLimiter(initial=2, target_latency=1.0)
+    requests = []
+    with_retries = services.reddit_crawler.with_retries
+
+    async def limited(call, client=None):
+        requests.append(call)
+        return await with_retries(call, client=client, limiter=limiter)
+    monkeypatch.setattr(services.reddit_crawler, "with_retries", limited)
+
+    stored = {"b": {"id": "b", "title": "stored"}}
+
+    async def submissions():
+        for id in ("a", "b", "c"):
+            yield SimpleNamespace(id=id)
+
+    async def load(submission):
+        await asyncio.sleep(0.01)
+        return {"id": submission.id, "title": "loaded"}
+
+    async def main():
+        return [post async for post in crawl(submissions(), load, known=lambda submission: stored.get(submission.id))]
+
+    posts = asyncio.run(main())
+    assert {post["id"]: (post["title"], post["rank"]) for post in posts} == \
+           {"a": ("loaded", 0), "b": ("stored", 1), "c": ("loaded", 2)}
+    # Only the two requests Reddit answered went through the limiter and were timed
+    assert len(requests) == 2 and limiter.latency >= 0.01
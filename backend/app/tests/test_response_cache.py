@@ -0,0 +1,49 @@
+from datetime import datetime
+import pytest
+import util.response_cache
+from util.market_calendar import MARKET_TIMEZONE
+from util.response_cache import ResponseCache, etag_matches, response_ttl
+
+ETAG = '"3f786850e387550fdab836ed7e6dc881de23001b"'
+
+
+@pytest.mark.parametrize("header, expected", [
+    (ETAG, True),
+    (f'W/{ETAG}', True),
+    (f' "other" ,  {ETAG} ', True),
+    (f'"other", W/{ETAG}', True),
+    ("*", True),
+    ("", False),
+    ('"other"', False),
+    # Tags that merely contain the entry's tag text
+    (f'"x{ETAG[1:]}', False),
+    (f'{ETAG[:-1]}0"', False),
+    (f'W/"prefix-{ETAG[1:-1]}"', False),
+])
+def test_etag_matches_whole_tags_only(header, expected):
+    assert etag_matches(header, ETAG) is expected
+
+
+def test_key_changes_with_the_market_day(monkeypatch):
+    monkeypatch.setattr(util.response_cache, "market_today", lambda: datetime(2024, 6, 3))
+    monday = ResponseCache.key("/api/stock-price", {"ticker": "SPY"})
+    monkeypatch.setattr(util.response_cache, "market_today", lambda: datetime(2024, 6, 4))
+    tuesday = ResponseCache.key("/api/stock-price", {"ticker": "SPY"})
+
+    assert monday.endswith("|2024-06-03") and tuesday.endswith("|2024-06-04")
+    assert ResponseCache.key("/api/stock-price", {"ticker": "spy"}, {"ticker": str.upper}) == tuesday
+
+
+def test_daily_responses_expire_at_the_market_midnight():
+    # 23:00 in New York is already the next day in UTC
+    now = datetime(2024, 6, 3, 23, 0, tzinfo=MARKET_TIMEZONE)
+    assert response_ttl("year", now=now) == 3600
+    assert response_ttl("week", now=datetime(2024, 6, 3, 22, 45, tzinfo=MARKET_TIMEZONE)) == 900
+
+
+def test_day_filter_is_only_refreshed_often_while_the_market_is_open():
+    # Saturday noon -> until midnight, the next session is further away
+    assert response_ttl("day", now=datetime(2024, 6, 8, 12, 0, tzinfo=MARKET_TIMEZONE)) == 12 * 3600
+    # Monday 6:30 -> until the session opens at 9:30
+    assert response_ttl("day", now=datetime(2024, 6, 10, 6, 30, tzinfo=MARKET_TIMEZONE)) == 3 * 3600
+    assert response_ttl("day", now=datetime(2024, 6, 4, 11, 0, tzinfo=MARKET_TIMEZONE), intraday_ttl=60) == 60
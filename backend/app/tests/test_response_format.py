@@ -0,0 +1,90 @@
+import io
+import json
+import math
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+import util.response_format
+from util.response_format import ARROW_MEDIA_TYPE, fill_missing, render
+
+
+def frame() -> pd.DataFrame:
+    return pd.DataFrame({
+        "timestamp": ["2024-03-01", "2024-03-02", "2024-03-03"],
+        "close": [101.5, np.nan, 99.25],
+        "volume": [1200, 900, 1500],
+        "title": ["Apple beats", "", None],
+        "sentiment": [0.4, -0.2, np.nan],
+    })
+
+
+def payload() -> dict:
+    return {"subreddit": "technology", "analyzed_sentiment": frame()}
+
+
+# Rows with every missing value as None, which is what null reads back as
+def rows(records: list) -> list:
+    return [{key: None if isinstance(value, float) and math.isnan(value) else value for key, value in row.items()}
+            for row in records]
+
+
+def columns_to_rows(columns: dict) -> list:
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def test_records_keep_missing_values_unless_filled():
+    records = render(payload())["analyzed_sentiment"]
+    assert math.isnan(records[1]["close"]) and records[1]["title"] == "" and records[2]["title"] is None
+
+    filled = render(payload(), fill="")["analyzed_sentiment"]
+    assert filled[1]["close"] == "" and filled[2]["title"] == "" and filled[2]["sentiment"] == ""
+    # Only missing cells are filled
+    assert filled[0] == render(payload())["analyzed_sentiment"][0]
+
+
+@pytest.mark.parametrize("encoder", ["orjson", "json"])
+def test_columnar_json_matches_the_records(monkeypatch, encoder):
+    if encoder == "json":
+        monkeypatch.setattr(util.response_format, "orjson", None)
+    response = render(payload(), "columnar")
+    body = json.loads(response.body)
+
+    assert response.media_type == "application/json"
+    assert body["subreddit"] == "technology"
+    assert list(body["analyzed_sentiment"]) == list(frame().columns)
+    # NaN and None are both null, "" stays a string
+    assert columns_to_rows(body["analyzed_sentiment"]) == rows(render(payload())["analyzed_sentiment"])
+
+
+def test_arrow_stream_matches_the_records():
+    pa = pytest.importorskip("pyarrow")
+    response = render(payload(), "arrow")
+    assert response.media_type == ARROW_MEDIA_TYPE
+
+    table = pa.ipc.open_stream(io.BytesIO(response.body)).read_all()
+    metadata = table.schema.metadata
+    assert json.loads(metadata[b"marketpulse.table"]) == ["analyzed_sentiment"]
+    assert json.loads(metadata[b"marketpulse.meta"]) == {"subreddit": "technology", "analyzed_sentiment": None}
+
+    decoded = table.to_pandas()
+    pd.testing.assert_frame_equal(decoded, frame())
+    assert rows(decoded.to_dict("records")) == rows(render(payload())["analyzed_sentiment"])
+
+
+def test_arrow_needs_exactly_one_table():
+    pytest.importorskip("pyarrow")
+    with pytest.raises(HTTPException) as error:
+        render({"a": frame(), "b": frame()}, "arrow")
+    assert error.value.status_code == 406
+
+
+def test_fill_missing_only_touches_columns_with_gaps():
+    filled = fill_missing(frame(), "")
+    assert filled["volume"].dtype == np.int64 and filled["timestamp"].tolist() == frame()["timestamp"].tolist()
+    assert filled["close"].tolist() == [101.5, "", 99.25]
+    assert filled["title"].tolist() == ["Apple beats", "", ""]
+
+    complete = frame().dropna()
+    assert fill_missing(complete, "") is complete
+    assert fill_missing(frame(), None).equals(frame())
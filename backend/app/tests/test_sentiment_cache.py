@@ -0,0 +1,95 @@
+import asyncio
+import numpy as np
+import pytest
+from services.sentiment_cache import SentimentCache
+
+
+class Model:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, text: str):
+        self.calls.append(text)
+        await asyncio.sleep(0.01)
+        return [0.25, 0.75]
+
+
+def test_texts_are_scored_once_and_read_back_from_disk(tmp_path):
+    async def main():
+        model = Model()
+        cache = SentimentCache(model, model_id="model:1", path=tmp_path / "cache.sqlite")
+        first = await cache.predict("Stocks rally")
+        # Same tokens for the uncased model
+        again = await cache.predict("  stocks   RALLY ")
+        await cache.close()
+
+        reopened = SentimentCache(model, model_id="model:1", path=tmp_path / "cache.sqlite")
+        from_disk = await reopened.predict("Stocks rally")
+        other_model = SentimentCache(model, model_id="model:2", path=tmp_path / "cache.sqlite")
+        await other_model.predict("Stocks rally")
+        await reopened.close()
+        await other_model.close()
+        return model, cache, reopened, first, again, from_disk
+
+    model, cache, reopened, first, again, from_disk = asyncio.run(main())
+    np.testing.assert_array_equal(first, again)
+    np.testing.assert_array_equal(first, from_disk)
+    assert model.calls == ["Stocks rally", "Stocks rally"]
+    assert cache.stats == {"memory_hits": 1, "disk_hits": 0, "misses": 1, "coalesced": 0}
+    assert reopened.stats["disk_hits"] == 1
+
+
+def test_joining_a_concurrent_scoring_is_not_a_hit(tmp_path):
+    async def main():
+        model = Model()
+        cache = SentimentCache(model, model_id="model:1", path=tmp_path / "cache.sqlite")
+        await asyncio.gather(*(cache.predict("Stocks rally") for _ in range(3)))
+        concurrent = dict(cache.stats), cache.hit_rate()
+        await cache.predict("Stocks rally")
+        await cache.close()
+        return model, cache, concurrent
+
+    model, cache, (concurrent_stats, concurrent_rate) = asyncio.run(main())
+    assert len(model.calls) == 1
+    assert concurrent_stats == {"memory_hits": 0, "disk_hits": 0, "misses": 1, "coalesced": 2}
+    assert concurrent_rate == 0
+    assert cache.hit_rate() == pytest.approx(0.5)
+
+
+def test_scoring_is_stored_when_the_request_that_started_it_is_cancelled(tmp_path):
+    async def main():
+        model = Model()
+        cache = SentimentCache(model, model_id="model:1", path=tmp_path / "cache.sqlite", flush_every=1)
+        started = asyncio.ensure_future(cache.predict("Stocks rally"))
+        while not cache.in_flight:
+            await asyncio.sleep(0.001)
+        joined = asyncio.ensure_future(cache.predict("Stocks rally"))
+        while not cache.stats["coalesced"]:
+            await asyncio.sleep(0.001)
+        started.cancel()
+        result = await joined
+        await cache.close()
+
+        reopened = SentimentCache(model, model_id="model:1", path=tmp_path / "cache.sqlite")
+        from_disk = await reopened.predict("Stocks rally")
+        await reopened.close()
+        return model, cache, reopened, result, from_disk
+
+    model, cache, reopened, result, from_disk = asyncio.run(main())
+    np.testing.assert_array_equal(result, from_disk)
+    assert model.calls == ["Stocks rally"]
+    assert cache.stats["coalesced"] == 1 and len(cache.memory) == 1 and not cache.in_flight
+    assert reopened.stats["disk_hits"] == 1
+
+
+def test_many_texts_share_one_disk_read(tmp_path, monkeypatch):
+    async def main():
+        cache = SentimentCache(Model(), model_id="model:1", path=tmp_path / "cache.sqlite")
+        selects = []
+        select = cache.select
+        monkeypatch.setattr(cache, "select", lambda keys: selects.append(len(keys)) or select(keys))
+        await asyncio.gather(*(cache.predict(f"text {i}") for i in range(1200)))
+        await cache.close()
+        return selects
+
+    assert asyncio.run(main()) == [1200]
@@ -0,0 +1,247 @@
+import asyncio
+import math
+import random
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from util.streaming import SentimentProcessor, SentimentProcessors
+from util.util import process_sentiment_data
+
+
+### process_sentiment_data before it became incremental (util.streaming.SentimentProcessor), the reference
+def reference_process_sentiment_data(start_date, data: pd.DataFrame, threshold: int = 5,
+                                     rolling_avg: int = 7, pos_std_multiplier: int = 1, neg_std_multiplier: int = 1):
+    data["timestamp"] = pd.to_datetime(data["timestamp"])
+    date_range = pd.date_range(start=start_date, end=data['timestamp'].max())
+
+    merged = pd.DataFrame({'timestamp': date_range})
+    merged = data.merge(merged, on='timestamp', how='outer')
+    merged['sentiment_filled'] = merged['sentiment'].copy()
+    gap_sizes = merged['timestamp'].diff().dt.days
+    large_gaps = gap_sizes > threshold
+    small_gaps = ~large_gaps
+
+    merged.loc[small_gaps, "sentiment_filled"] = merged.loc[small_gaps, "sentiment_filled"].interpolate(method="linear")
+
+    merged.loc[large_gaps, "sentiment_filled"] = merged["sentiment_filled"].ffill().bfill()
+    merged["sentiment_filled"] = merged["sentiment_filled"].bfill()
+
+    merged["is_filled"] = merged['sentiment'].isna()
+    merged["rolling_avg"] = merged["sentiment_filled"].rolling(window=rolling_avg, min_periods=1).mean()
+
+    positive_spike_threshold = merged["rolling_avg"].mean() + merged["rolling_avg"].std() * pos_std_multiplier
+    negative_spike_threshold = merged["rolling_avg"].mean() - merged["rolling_avg"].std() * neg_std_multiplier
+
+    merged["positive_spike"] = (merged["rolling_avg"] > positive_spike_threshold) & (~merged['is_filled'])
+    merged["negative_spike"] = (merged["rolling_avg"] < negative_spike_threshold) & (~merged['is_filled'])
+
+    merged = merged.fillna("")
+
+    merged["sentiment"] = merged["rolling_avg"]
+    merged["timestamp"] = merged["timestamp"].dt.strftime('%Y-%m-%d')
+    merged = merged[['timestamp', 'sentiment', 'article_url', 'title', 'top_comment', 'positive_spike', 'negative_spike',]]
+
+    return positive_spike_threshold, negative_spike_threshold, merged
+
+
+START = pd.Timestamp("2024-03-01")
+
+
+def daily_posts(days: list, sentiments: list) -> pd.DataFrame:
+    return pd.DataFrame({
+        "timestamp": [(START + pd.Timedelta(days=day)).strftime("%Y-%m-%d") for day in days],
+        "sentiment": sentiments,
+        "article_url": [f"https://example.com/{day}" for day in days],
+        "title": [f"title {day}" for day in days],
+        "top_comment": [f"comment {day}" for day in days],
+    })
+
+
+def random_posts(seed: int, missing_rate: float = 0.0) -> pd.DataFrame:
+    rng = random.Random(seed)
+    # Days before START are spread out, so the series has gaps over the 5 day threshold
+    days = sorted(rng.sample(range(-40, 40), rng.randint(1, 25)))
+    return daily_posts(days, [math.nan if rng.random() < missing_rate else rng.uniform(-20, 20) for _ in days])
+
+
+def assert_same_result(expected: tuple, result: tuple):
+    positive, negative, frame = result
+    expected_positive, expected_negative, expected_frame = expected
+
+    np.testing.assert_allclose([positive, negative], [expected_positive, expected_negative], rtol=0, atol=1e-9)
+    assert list(frame.columns) == list(expected_frame.columns)
+    assert frame["timestamp"].tolist() == expected_frame["timestamp"].tolist()
+    for column in ("article_url", "title", "top_comment", "positive_spike", "negative_spike"):
+        assert frame[column].tolist() == expected_frame[column].tolist(), column
+
+    # Days without a rolling average are "" in both
+    empty = expected_frame["sentiment"].eq("")
+    assert frame["sentiment"].eq("").tolist() == empty.tolist()
+    np.testing.assert_allclose(frame["sentiment"][~empty].astype(float), expected_frame["sentiment"][~empty].astype(float),
+                               rtol=0, atol=1e-9)
+
+
+def run_both(start_date, data: pd.DataFrame, **kwargs) -> tuple:
+    with warnings.catch_warnings():
+        # The old version fills object columns, pandas warns about the downcasting
+        warnings.simplefilter("ignore")
+        expected = reference_process_sentiment_data(start_date, data.copy(), **kwargs)
+    result = asyncio.run(process_sentiment_data(start_date, data.copy(), **kwargs))
+    return expected, result
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_previous_implementation(seed):
+    assert_same_result(*run_both(START, random_posts(seed)))
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_previous_implementation_with_missing_sentiments(seed):
+    assert_same_result(*run_both(START, random_posts(seed, missing_rate=0.3)))
+
+
+def test_large_gaps_carry_the_last_value_forward():
+    # 12 and 9 day gaps before START, over the threshold, then daily posts with a 3 day gap
+    data = daily_posts([-30, -18, -9, 0, 1, 4, 5], [5.0, -3.0, 8.0, 1.0, 2.0, -6.0, 4.0])
+    expected, result = run_both(START, data)
+
+    assert_same_result(expected, result)
+    assert len(result[2]) == 7 + 2
+
+
+def test_small_gaps_are_interpolated():
+    data = daily_posts([0, 4, 6], [0.0, 8.0, 2.0])
+    expected, result = run_both(START, data, rolling_avg=1)
+
+    assert_same_result(expected, result)
+    np.testing.assert_allclose(result[2]["sentiment"].astype(float), [0, 2, 4, 6, 8, 5, 2])
+    # Filled days are never spikes and have no post
+    assert result[2]["title"].tolist()[1:4] == ["", "", ""]
+    assert not result[2]["positive_spike"].iloc[1:4].any()
+
+
+@pytest.mark.parametrize("threshold, rolling_avg", [(1, 3), (3, 1), (10, 14)])
+def test_matches_previous_implementation_with_other_parameters(threshold, rolling_avg):
+    for seed in range(30):
+        data = random_posts(seed, missing_rate=0.2)
+        assert_same_result(*run_both(START, data, threshold=threshold, rolling_avg=rolling_avg,
+                                     pos_std_multiplier=1.5, neg_std_multiplier=2))
+
+
+def test_days_without_any_sentiment_are_empty_strings():
+    data = daily_posts([0, 2, 3], [math.nan, math.nan, math.nan])
+    expected, result = run_both(START, data)
+
+    assert_same_result(expected, result)
+    assert result[2]["sentiment"].tolist() == ["", "", "", ""]
+    assert math.isnan(result[0]) and math.isnan(result[1])
+
+
+def test_missing_none_keeps_a_numeric_column():
+    data = daily_posts([2, 3, 6], [math.nan, 4.0, -2.0])
+    _, _, filled = asyncio.run(process_sentiment_data(START, data.copy()))
+    _, _, numeric = asyncio.run(process_sentiment_data(START, data.copy(), missing=None))
+
+    assert numeric["sentiment"].dtype == float
+    assert numeric["sentiment"].isna().tolist() == filled["sentiment"].eq("").tolist()
+    np.testing.assert_allclose(numeric["sentiment"].dropna(), filled["sentiment"][filled["sentiment"] != ""].astype(float))
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_appending_day_by_day_gives_the_whole_series_result(seed):
+    data = random_posts(seed, missing_rate=0.2)
+    whole = asyncio.run(process_sentiment_data(START, data.copy()))
+
+    processor = SentimentProcessor(START)
+    for row in data.itertuples(index=False):
+        processor.append(row.timestamp, row.sentiment, row.article_url, row.title, row.top_comment)
+        # Reading the frame in between doesn't change the running state
+        processor.frame()
+
+    assert_same_result(whole, processor.frame())
+
+
+def count_appends(monkeypatch) -> list:
+    calls = []
+    append = SentimentProcessor.append
+
+    def counted(self, timestamp, *args, **kwargs):
+        calls.append(pd.Timestamp(timestamp))
+        return append(self, timestamp, *args, **kwargs)
+
+    monkeypatch.setattr(SentimentProcessor, "append", counted)
+    return calls
+
+
+def test_kept_processor_only_appends_the_new_closed_days(monkeypatch):
+    processors = SentimentProcessors()
+    data = random_posts(7)
+    whole = asyncio.run(process_sentiment_data(START, data.copy()))
+    calls = count_appends(monkeypatch)
+
+    # One refresh per day, every refresh gets the series up to its day (the open one included)
+    timestamps = pd.to_datetime(data["timestamp"])
+    for today in pd.date_range(timestamps.min() + pd.Timedelta(days=1), timestamps.max() + pd.Timedelta(days=1)):
+        series = data[timestamps <= today]
+        expected = asyncio.run(process_sentiment_data(START, series.copy()))
+        calls.clear()
+        processor = processors.process("AAPL", START, series.copy(), today=today)
+        assert_same_result(expected, processor.frame())
+        # The day closed since the last refresh and the open day, never the whole series
+        assert all(call >= today - pd.Timedelta(days=1) for call in calls)
+
+    assert_same_result(whole, processor.frame())
+
+
+def test_changed_closed_day_processes_the_series_again(monkeypatch):
+    processors = SentimentProcessors()
+    today = START + pd.Timedelta(days=10)
+    data = daily_posts([0, 1, 2, 4, 5, 8], [1.0, 4.0, -2.0, 6.0, 3.0, -5.0])
+    processors.process("AAPL", START, data.copy(), today=today)
+
+    # A post found later for a past day replaces its top post
+    data.loc[2, ["sentiment", "title"]] = [9.0, "later post"]
+    expected = asyncio.run(process_sentiment_data(START, data.copy()))
+    calls = count_appends(monkeypatch)
+    processor = processors.process("AAPL", START, data.copy(), today=today)
+
+    assert len(calls) == len(data)
+    assert_same_result(expected, processor.frame())
+
+
+def test_open_day_is_not_kept():
+    processors = SentimentProcessors()
+    today = START + pd.Timedelta(days=3)
+    morning = daily_posts([0, 1, 3], [1.0, 4.0, -8.0])
+    afternoon = daily_posts([0, 1, 3], [1.0, 4.0, 6.0])
+
+    processors.process("AAPL", START, morning.copy(), today=today)
+    processor = processors.process("AAPL", START, afternoon.copy(), today=today)
+
+    assert_same_result(asyncio.run(process_sentiment_data(START, afternoon.copy())), processor.frame())
+    assert len(processors.entries["AAPL"][1].timestamps) == 2
+
+
+def test_other_start_or_parameters_start_over():
+    processors = SentimentProcessors()
+    today = START + pd.Timedelta(days=10)
+    data = daily_posts([0, 1, 2, 4], [1.0, 4.0, -2.0, 6.0])
+
+    first = processors.process("AAPL", START, data.copy(), today=today)
+    later_start = START + pd.Timedelta(days=1)
+    moved = processors.process("AAPL", later_start, data.copy(), today=today)
+    assert_same_result(asyncio.run(process_sentiment_data(later_start, data.copy())), moved.frame())
+
+    smoother = processors.process("AAPL", later_start, data.copy(), today=today, rolling_avg=3)
+    assert_same_result(asyncio.run(process_sentiment_data(later_start, data.copy(), rolling_avg=3)), smoother.frame())
+    assert first.frame()[2]["timestamp"].iloc[0] == START.strftime("%Y-%m-%d")
+
+
+def test_least_recently_used_series_are_dropped():
+    processors = SentimentProcessors(max_entries=2)
+    today = START + pd.Timedelta(days=10)
+    data = daily_posts([0, 1], [1.0, 2.0])
+    for key in ("AAPL", "MSFT", "AAPL", "NVDA"):
+        processors.process(key, START, data.copy(), today=today)
+    assert list(processors.entries) == ["AAPL", "NVDA"]
@@ -0,0 +1,74 @@
+import asyncio
+import math
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+import services.reddit
+from benchmarks.fixtures import FakeReddit
+from services.reddit import DailyTopPosts, ScoredPost, MARKET_TIMEZONE, fetch_social_sentiment
+from services.resource_init import MODELS
+
+
+def post(timestamp: str, sentiment: float, rank: int = 0, id: str = None) -> ScoredPost:
+    return ScoredPost(timestamp=timestamp, sentiment=sentiment, article_url=f"https://example.com/{id or timestamp}",
+                      title=f"title {id or timestamp}", top_comment="comment", rank=rank, id=id or timestamp,
+                      subreddit="technology", interest_score=1.0)
+
+
+def test_strongest_post_of_each_day():
+    daily = DailyTopPosts()
+    for p in (post("2024-03-01 09:15:00", 0.2), post("2024-03-01 15:40:00", -0.7), post("2024-03-02 11:00:00", 0.1)):
+        daily.add(p)
+    frame = daily.frame()
+    assert frame["timestamp"].tolist() == ["2024-03-01", "2024-03-02"]
+    assert frame["sentiment"].tolist() == [-0.7, 0.1]
+
+
+def test_strongest_post_of_each_hour():
+    daily = DailyTopPosts(hourly=True)
+    for p in (post("2024-03-01 09:15:00", 0.2), post("2024-03-01 09:50:00", -0.4),
+              post("2024-03-01 15:40:00", -0.7), post("2024-03-02", 0.3)):
+        daily.add(p)
+    frame = daily.frame()
+    # A post stored without its time of day falls in the day's first hour
+    assert frame["timestamp"].tolist() == ["2024-03-01 09:00:00", "2024-03-01 15:00:00", "2024-03-02 00:00:00"]
+    assert frame["sentiment"].tolist() == [-0.4, -0.7, 0.3]
+
+
+def test_ties_go_to_the_better_rank_and_missing_sentiment_never_wins():
+    daily = DailyTopPosts()
+    daily.add(post("2024-03-01 09:00:00", math.nan, rank=0, id="nan"))
+    daily.add(post("2024-03-01 10:00:00", 0.5, rank=3, id="worse"))
+    daily.add(post("2024-03-01 11:00:00", -0.5, rank=1, id="better"))
+    assert daily.frame()["title"].tolist() == ["title better"]
+
+
+def test_stored_record_drops_the_search_rank():
+    scored = post("2024-03-01 09:15:00", 0.2, rank=4, id="abc")
+    record = scored.record()
+    assert "rank" not in record and record["id"] == "abc"
+
+    restored = ScoredPost.from_record({**record, "rank": 1})
+    assert [getattr(restored, field) for field in ScoredPost.__slots__] == \
+           [getattr(scored, field) if field != "rank" else 1 for field in ScoredPost.__slots__]
+
+
+def test_day_filter_returns_hourly_rows(monkeypatch):
+    today = datetime.now(MARKET_TIMEZONE).replace(minute=0, second=0, microsecond=0)
+    today = today.replace(hour=12) if today.hour < 12 else today
+    times = [today - timedelta(days=1, hours=2), today - timedelta(minutes=50),
+             today - timedelta(minutes=20), today - timedelta(hours=2, minutes=30)]
+    posts = [{"id": f"p{i}", "title": f"Apple post {i}", "url": f"https://example.com/{i}", "subreddit": "technology",
+              "created_utc": created.timestamp(), "score": 100 - i, "upvote_ratio": 0.9, "num_comments": 1,
+              "comments": [(f"comment {i}", 1)]} for i, created in enumerate(times)]
+    monkeypatch.setattr(services.reddit, "reddit", FakeReddit(posts))
+
+    async def predict(text: str):
+        return np.array([0.2, 0.8], dtype=np.float32)
+    monkeypatch.setitem(MODELS, "social_sentiment", {"predict": predict})
+
+    frame = asyncio.run(fetch_social_sentiment("technology", "Apple", "day"))
+
+    hours = sorted({created.strftime("%Y-%m-%d %H:00:00") for created in times})
+    assert frame["timestamp"].tolist() == hours
+    assert len(frame) == 3
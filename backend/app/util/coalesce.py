@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import inspect
+import time
+from typing import Callable
+from util.metrics import metrics
+
+
+# Turn lists / dicts / sets in the arguments into something hashable
+def freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(freeze(v) for v in value))
+    return value
+
+
+### Coalesce identical in-flight calls into one shared computation
+def coalesce(ttl: float = 0, normalize: dict = None):
+    '''
+        Concurrent calls with the same (normalized) arguments await one shared task instead of
+        each running the whole pipeline. The result optionally stays valid for ttl seconds.
+
+        ttl: 0 -> only coalesce calls that overlap in time
+        normalize: {param: function} -> e.g. {"company": str.lower}, only for params whose
+            value doesn't show up in the result, everything else is keyed as given
+    '''
+    normalize = normalize or {}
+
+    def decorator(func: Callable):
+        signature = inspect.signature(func)
+        in_flight = {}
+        results = {}
+
+        def make_key(args, kwargs) -> tuple:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return tuple(
+                (name, normalize[name](value) if name in normalize and value is not None else freeze(value))
+                for name, value in bound.arguments.items()
+            )
+
+        def on_done(key, task: asyncio.Task):
+            in_flight.pop(key, None)
+            # Failures are never reused, the next call tries again
+            if task.cancelled() or task.exception() is not None or ttl <= 0:
+                return
+
+            now = time.monotonic()
+            for expired in [k for k, (expires_at, _) in results.items() if expires_at <= now]:
+                results.pop(expired, None)
+            results[key] = (now + ttl, task.result())
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+
+            cached = results.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                metrics.inc("coalesce_calls_total", function=func.__name__, outcome="cached")
+                return cached[1]
+
+            task = in_flight.get(key)
+            metrics.inc("coalesce_calls_total", function=func.__name__, outcome="new" if task is None else "joined")
+            if task is None:
+                # Own task, so one caller going away doesn't cancel the work for the others
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                in_flight[key] = task
+                task.add_done_callback(functools.partial(on_done, key))
+
+            return await asyncio.shield(task)
+
+        # Drop reusable results, in-flight calls are left alone
+        wrapper.cache_clear = results.clear
+        return wrapper
+
+    return decorator
@@ -0,0 +1,124 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Window variances below this (relative to the series' own variance) count as constant, no correlation
+FLAT_TOLERANCE = 1e-10
+
+# Windows up to this many rows are computed directly from their own rows, differences of running sums
+# lose too many digits when a window holds only a few (e.g. window 2 of a price series)
+EXACT_MAX_WINDOW = 8
+# Same as FLAT_TOLERANCE for those, relative to the largest squared value, they are only off by rounding
+EXACT_FLAT_TOLERANCE = 1e-24
+
+
+### Shift rows down by `lag` (up when negative), like DataFrame.shift, vacated rows are NaN
+def shift_rows(values: np.ndarray, lag: int) -> np.ndarray:
+    if lag == 0:
+        return values
+    shifted = np.full_like(values, np.nan)
+    if lag > 0:
+        shifted[lag:] = values[:-lag]
+    else:
+        shifted[:lag] = values[-lag:]
+    return shifted
+
+
+# Running sums with a leading zero row, sums[t] covers rows [0, t)
+def running_sums(values: np.ndarray) -> np.ndarray:
+    sums = np.zeros((values.shape[0] + 1,) + values.shape[1:])
+    np.cumsum(values, axis=0, out=sums[1:])
+    return sums
+
+
+### Rolling Pearson correlations of every target against every signal for many lags and windows at once
+def lagged_rolling_correlations(targets: np.ndarray, signals: np.ndarray, windows: list, lags: list = (0,),
+                                dtype=np.float64) -> np.ndarray:
+    '''
+        targets: (rows,) or (rows, targets) e.g. one price column per ticker
+        signals: (rows,) or (rows, signals) e.g. fear / greed score and daily sentiment, same rows as targets
+        windows: [7, 14, 30] -> rolling window sizes in rows
+        lags: [0, 1, 2] -> lag 1 correlates today's target with yesterday's signal, negative lags look ahead
+
+        Returns a (lags, windows, rows, targets, signals) array, row t holds the correlation of the window
+        ending at t. Like pandas .rolling(window).corr() a window with a missing value or too few rows is NaN,
+        and so is a window where either side is constant.
+
+        Per lag the sums of x, y, x², y² and xy are accumulated once (cumulative sums), every window
+        size is then a difference of two rows of those sums, so the cost doesn't grow with the window.
+        Windows up to EXACT_MAX_WINDOW rows are centered on their own mean instead (two passes), they are
+        cheap and the sums would cancel out most of their digits. This is closer to the exact correlation
+        than pandas, which keeps running sums for every window size and can be off by 1e-4 or more on
+        small or near-constant windows of price-like series. A constant window is NaN here, pandas gives
+        ±inf or NaN for it.
+    '''
+    x = np.asarray(targets, dtype=np.float64)
+    y = np.asarray(signals, dtype=np.float64)
+    x = x.reshape(len(x), -1)[:, :, None]
+    y = y.reshape(len(y), -1)[:, None, :]
+
+    # Correlation doesn't change with an offset, centering keeps the sums of squares small and precise
+    x = x - np.nanmean(x, axis=0)
+    x_scale = np.nanvar(x, axis=0)
+    x_peak = np.nanmax(np.abs(x), axis=0) ** 2
+
+    rows = x.shape[0]
+    result = np.full((len(lags), len(windows), rows, x.shape[1], y.shape[2]), np.nan, dtype=dtype)
+
+    for i, lag in enumerate(lags):
+        y_lag = shift_rows(y, lag)
+        y_lag = y_lag - np.nanmean(y_lag, axis=0)
+        y_scale = np.nanvar(y_lag, axis=0)
+        y_peak = np.nanmax(np.abs(y_lag), axis=0) ** 2
+
+        valid = ~(np.isnan(x) | np.isnan(y_lag))
+        xv = np.where(valid, x, 0.0)
+        yv = np.where(valid, y_lag, 0.0)
+
+        count = running_sums(valid.astype(np.float64))
+        sum_x, sum_y = running_sums(xv), running_sums(yv)
+        sum_xx, sum_yy, sum_xy = running_sums(xv * xv), running_sums(yv * yv), running_sums(xv * yv)
+
+        for j, window in enumerate(windows):
+            if window > rows:
+                continue
+            if window <= EXACT_MAX_WINDOW:
+                result[i, j, window - 1:] = window_correlations(x, y_lag, window, x_peak, y_peak)
+                continue
+            end, start = slice(window, rows + 1), slice(0, rows + 1 - window)
+            n = count[end] - count[start]
+            sx, sy = sum_x[end] - sum_x[start], sum_y[end] - sum_y[start]
+
+            cov = (sum_xy[end] - sum_xy[start]) - sx * sy / window
+            var_x = (sum_xx[end] - sum_xx[start]) - sx * sx / window
+            var_y = (sum_yy[end] - sum_yy[start]) - sy * sy / window
+
+            flat = (var_x <= FLAT_TOLERANCE * window * x_scale) | (var_y <= FLAT_TOLERANCE * window * y_scale)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                corr = cov / np.sqrt(var_x * var_y)
+            corr = np.where((n == window) & ~flat, np.clip(corr, -1, 1), np.nan)
+            result[i, j, window - 1:] = corr
+
+    return result
+
+
+### Rolling correlations of one window size, each window centered on its own mean
+def window_correlations(x: np.ndarray, y: np.ndarray, window: int, x_peak: np.ndarray, y_peak: np.ndarray) -> np.ndarray:
+    '''
+        x: (rows, targets, 1), y: (rows, 1, signals), both already centered on the series' mean
+        x_peak, y_peak: largest squared value of each column, the scale of the rounding errors
+        Returns (rows - window + 1, targets, signals), a window with a NaN is NaN
+    '''
+    xs = sliding_window_view(x, window, axis=0)
+    ys = sliding_window_view(y, window, axis=0)
+    xs = xs - xs.mean(axis=-1, keepdims=True)
+    ys = ys - ys.mean(axis=-1, keepdims=True)
+
+    cov = np.einsum("...i,...i->...", xs, ys)
+    var_x = np.einsum("...i,...i->...", xs, xs)
+    var_y = np.einsum("...i,...i->...", ys, ys)
+
+    flat = (var_x <= EXACT_FLAT_TOLERANCE * window * x_peak) | (var_y <= EXACT_FLAT_TOLERANCE * window * y_peak)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / np.sqrt(var_x * var_y)
+    return np.where(flat, np.nan, np.clip(corr, -1, 1))
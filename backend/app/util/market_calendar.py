@@ -0,0 +1,52 @@
+from datetime import datetime, time
+from functools import cache
+from zoneinfo import ZoneInfo
+import pandas as pd
+from pandas.tseries.holiday import AbstractHolidayCalendar, Holiday, GoodFriday, USLaborDay, USMartinLutherKingJr, \
+    USMemorialDay, USPresidentsDay, USThanksgivingDay, nearest_workday, sunday_to_monday
+from pandas.tseries.offsets import CustomBusinessDay
+
+# Bars and windows are dated in market time, "today" is the market's day whatever the host's timezone
+MARKET_TIMEZONE = ZoneInfo("America/New_York")
+
+# Regular trading session, market time
+MARKET_OPEN = time(9, 30)
+MARKET_CLOSE = time(16, 0)
+
+
+### NYSE full-day closures, the days besides weekends without bars
+class MarketHolidays(AbstractHolidayCalendar):
+    rules = [
+        # No Friday off when New Year's Day is a Saturday, the year's last session stays open
+        Holiday("New Year's Day", month=1, day=1, observance=sunday_to_monday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday("Juneteenth", month=6, day=19, start_date="2022-01-01", observance=nearest_workday),
+        Holiday("Independence Day", month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday("Christmas Day", month=12, day=25, observance=nearest_workday),
+    ]
+
+
+# Built on first use, the holiday list takes a moment to generate
+@cache
+def trading_day() -> CustomBusinessDay:
+    return CustomBusinessDay(calendar=MarketHolidays())
+
+
+### Midnight of the market's current day, naive like the windows built from it
+def market_today() -> datetime:
+    return datetime.combine(datetime.now(MARKET_TIMEZONE).date(), time.min)
+
+
+# Current market time, naive like the bar timestamps
+def market_now() -> datetime:
+    return datetime.now(MARKET_TIMEZONE).replace(tzinfo=None)
+
+
+### Trading days within [start, end)
+def trading_days(start, end) -> pd.DatetimeIndex:
+    return pd.date_range(pd.Timestamp(start).normalize(), end, freq=trading_day(), inclusive="left")
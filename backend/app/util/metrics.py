@@ -0,0 +1,176 @@
+import asyncio
+import functools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+PREFIX = "marketpulse"
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Stage durations of the request being served, stage -> seconds (None outside a request)
+request_timings: ContextVar = ContextVar("request_timings", default=None)
+
+
+### In-process metrics rendered in the Prometheus text format
+class Metrics:
+    '''
+        Counters, gauges and histograms keyed by (name, labels). Values are updated from the event
+        loop as well as from worker threads (inference, downloads), so every update takes a lock.
+        Collectors are called at render time for values owned by other objects (e.g. cache stats).
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        self.collectors = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = SECONDS_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets),
+                                                    "sum": 0.0, "count": 0}
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    # fn() -> [(name, value, labels)], reported as gauges, registering a name again replaces it
+    def register_collector(self, name: str, fn: Callable[[], list]):
+        self.collectors[name] = fn
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def render(self) -> str:
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: {**h, "counts": list(h["counts"])} for key, h in self.histograms.items()}
+
+        for collector in list(self.collectors.values()):
+            for name, value, labels in collector():
+                gauges[self._key(name, labels)] = value
+
+        def labels_text(labels: tuple, extra: tuple = ()) -> str:
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                full = f"{PREFIX}_{name}"
+                if name in self.help:
+                    lines.append(f"# HELP {full} {self.help[name]}")
+                lines.append(f"# TYPE {full} {kind}")
+                for (n, labels), value in values.items():
+                    if n == name:
+                        lines.append(f"{full}{labels_text(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            full = f"{PREFIX}_{name}"
+            if name in self.help:
+                lines.append(f"# HELP {full} {self.help[name]}")
+            lines.append(f"# TYPE {full} histogram")
+            for (n, labels), h in histograms.items():
+                if n != name:
+                    continue
+                for bound, count in zip(h["buckets"], h["counts"]):
+                    lines.append(f"{full}_bucket{labels_text(labels, (('le', bound),))} {count}")
+                lines.append(f"{full}_bucket{labels_text(labels, (('le', '+Inf'),))} {h['count']}")
+                lines.append(f"{full}_sum{labels_text(labels)} {h['sum']}")
+                lines.append(f"{full}_count{labels_text(labels)} {h['count']}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("stage_seconds", "Time spent per pipeline stage")
+metrics.describe("semaphore_wait_seconds", "Time spent waiting for the Reddit semaphore")
+metrics.describe("inference_batch_size", "Texts per model forward pass")
+metrics.describe("event_loop_lag_seconds", "How late the event loop wakes up a sleeping task")
+metrics.describe("http_request_seconds", "Request latency per route")
+
+
+### Record a stage duration globally and in the current request's breakdown
+def record_stage(stage: str, seconds: float):
+    metrics.observe("stage_seconds", seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+### Decorator timing every call of a sync or async function as `stage`
+def timed(stage: str):
+    def decorator(func: Callable):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+### Acquire a semaphore (or lock) and record how long the caller queued for it
+@asynccontextmanager
+async def waited(semaphore, stage: str):
+    start = time.perf_counter()
+    async with semaphore:
+        metrics.observe("semaphore_wait_seconds", time.perf_counter() - start, stage=stage)
+        yield
+
+
+### Background task measuring event loop lag, i.e. how late a sleep of `interval` seconds wakes up
+async def monitor_event_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        metrics.observe("event_loop_lag_seconds", lag)
+        metrics.set("event_loop_lag_last_seconds", lag)
+
+
+### Server-Timing header value of a request's breakdown (durations in ms)
+def server_timing_header(timings: dict) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
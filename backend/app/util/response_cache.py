@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from datetime import time as day_time
+from util.coalesce import freeze
+from util.market_calendar import MARKET_CLOSE, MARKET_OPEN, MARKET_TIMEZONE, market_today
+
+# Redis is an optional shared tier, the in-process LRU works without it
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+### Seconds until the next trading session opens (0 while it is open)
+def seconds_until_open(now: datetime) -> float:
+    now = now.astimezone(MARKET_TIMEZONE)
+    if now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE:
+        return 0
+
+    day = now.date() if now.time() < MARKET_OPEN else now.date() + timedelta(days=1)
+    while day.weekday() >= 5:
+        day += timedelta(days=1)
+    return (datetime.combine(day, MARKET_OPEN, MARKET_TIMEZONE) - now).total_seconds()
+
+
+### How long a response for a time filter stays valid, never past the next window roll-over
+def response_ttl(time_filter: str, now: datetime = None, intraday_ttl: float = 60) -> float:
+    '''
+        year / month -> daily bars up to today's midnight, valid until convert_time_filter moves at midnight
+        week -> valid until the next full hour
+        day -> hourly bars, intraday_ttl seconds while the market is open, otherwise until it opens again
+    '''
+    # Windows roll over at the market's midnight (util.market_calendar.market_today)
+    now = now or datetime.now(MARKET_TIMEZONE)
+    midnight = datetime.combine(now.date() + timedelta(days=1), day_time.min, now.tzinfo)
+    until_midnight = (midnight - now).total_seconds()
+
+    if time_filter == "week":
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        return min(until_midnight, (next_hour - now).total_seconds())
+    if time_filter == "day":
+        closed = seconds_until_open(now)
+        return min(until_midnight, closed) if closed > 0 else intraday_ttl
+    return until_midnight
+
+
+### Whether an If-None-Match header lists the entry's ETag
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    '''
+        if_none_match: '"a", W/"b"' -> comma separated tags compared whole, weak ones like strong ones
+            (If-None-Match uses the weak comparison), "*" matches any entry
+    '''
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+### Serialized responses kept in an in-process LRU and optionally in Redis
+class ResponseCache:
+    '''
+        Entries are the final response bytes with their content type and ETag, so a hit skips
+        the endpoint and the JSON encoding. Keys hold the route, its normalized parameters and
+        the day the time filter window was computed for, a new window never sees an old entry.
+
+        max_entries: 512 -> size of the in-process tier
+        redis_url: "" -> no shared tier, e.g. "redis://localhost:6379/0" shares entries between workers
+    '''
+    def __init__(self, max_entries: int = 512, redis_url: str = "", prefix: str = "marketpulse:response:"):
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.memory = OrderedDict()
+        self.redis = None
+        if redis_url:
+            if redis is None:
+                logger.warning("REDIS_URL is set but the redis package is not installed, caching in-process only")
+            else:
+                self.redis = redis.from_url(redis_url)
+
+    @staticmethod
+    def key(route: str, params: dict, normalize: dict = None) -> str:
+        normalize = normalize or {}
+        normalized = {name: normalize[name](value) if name in normalize else value for name, value in params.items()}
+        # Entries of yesterday's window stop matching once the market's day changes, like the price store's
+        return f"{route}|{freeze(normalized)}|{market_today().date()}"
+
+    @staticmethod
+    def etag(body: bytes) -> str:
+        return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+    async def get(self, key: str):
+        entry = self.memory.get(key)
+        if entry is not None:
+            if entry["expires_at"] > time.time():
+                self.memory.move_to_end(key)
+                return entry, "memory"
+            self.memory.pop(key, None)
+
+        if self.redis is not None:
+            try:
+                raw = await self.redis.get(self.prefix + key)
+            except Exception as e:
+                logger.warning("Response cache read failed: %s", e)
+                raw = None
+            if raw is not None:
+                header, body = raw.split(b"\n", 1)
+                entry = {**json.loads(header), "body": body}
+                self._remember(key, entry)
+                return entry, "redis"
+
+        return None, "miss"
+
+    async def set(self, key: str, body: bytes, media_type: str, ttl: float) -> dict:
+        entry = {"body": body, "media_type": media_type, "etag": self.etag(body), "expires_at": time.time() + ttl}
+        self._remember(key, entry)
+
+        if self.redis is not None:
+            header = json.dumps({k: v for k, v in entry.items() if k != "body"}).encode()
+            try:
+                await self.redis.set(self.prefix + key, header + b"\n" + body, ex=max(1, int(ttl)))
+            except Exception as e:
+                logger.warning("Response cache write failed: %s", e)
+        return entry
+
+    def _remember(self, key: str, entry: dict):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
@@ -0,0 +1,122 @@
+import io
+import json
+import numpy as np
+import pandas as pd
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+# Both encoders are optional, columnar JSON falls back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+FORMATS = ("records", "columnar", "arrow")
+
+
+### Pick the response format from the `format` query parameter, else from the Accept header
+def response_format(format: str = None, accept: str = None) -> str:
+    '''
+        records -> list of row objects (default, what the frontend reads)
+        columnar -> one JSON array per column, missing values are null
+        arrow -> Apache Arrow IPC stream, also chosen by Accept: application/vnd.apache.arrow.stream
+    '''
+    if format:
+        if format not in FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unknown format {format}, use one of {', '.join(FORMATS)}")
+        return format
+    if accept and ARROW_MEDIA_TYPE in accept:
+        return "arrow"
+    return "records"
+
+
+# Only the part of the Accept header that changes the format, so requests with any other header share coalesced calls
+def accepted_format(accept: str):
+    return "arrow" if accept and ARROW_MEDIA_TYPE in accept else None
+
+
+### Column name -> values, numeric columns stay NumPy arrays and text columns get None for missing values
+def frame_columns(frame: pd.DataFrame) -> dict:
+    columns = {}
+    for name, column in frame.items():
+        if column.dtype == object or isinstance(column.dtype, pd.CategoricalDtype):
+            columns[name] = column.astype(object).where(column.notna(), None).tolist()
+        elif orjson is None:
+            # The standard library writes NaN, which is not JSON
+            values = column.to_numpy()
+            columns[name] = np.where(pd.isna(values), None, values).tolist() if values.dtype.kind == "f" else values.tolist()
+        else:
+            columns[name] = np.ascontiguousarray(column.to_numpy())
+    return columns
+
+
+def encode_json(payload) -> bytes:
+    if orjson is not None:
+        # NumPy arrays are written straight from their buffers, NaN becomes null
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, allow_nan=False, separators=(",", ":")).encode()
+
+
+# Replace every DataFrame inside dicts / lists with convert(frame)
+def map_frames(payload, convert):
+    if isinstance(payload, pd.DataFrame):
+        return convert(payload)
+    if isinstance(payload, dict):
+        return {key: map_frames(value, convert) for key, value in payload.items()}
+    if isinstance(payload, list):
+        return [map_frames(value, convert) for value in payload]
+    return payload
+
+
+def find_frames(payload, path: tuple = ()) -> list:
+    if isinstance(payload, pd.DataFrame):
+        return [(path, payload)]
+    if isinstance(payload, dict):
+        return [found for key, value in payload.items() for found in find_frames(value, path + (key,))]
+    return []
+
+
+# Only columns with gaps are filled, the others keep their dtype instead of turning into object columns
+def fill_missing(frame: pd.DataFrame, fill):
+    if fill is None:
+        return frame
+    gaps = frame.columns[frame.isna().any()]
+    return frame.fillna({column: fill for column in gaps}) if len(gaps) else frame
+
+
+### Encode a payload holding DataFrames in the requested format
+def render(payload, format: str = "records", fill=None):
+    '''
+        payload: dict whose DataFrame values are encoded as rows, columns or the Arrow table
+        fill: "" -> records only, missing values written as "" like the frontend expects
+    '''
+    if format == "records":
+        return map_frames(payload, lambda frame: fill_missing(frame, fill).to_dict("records"))
+
+    if format == "columnar":
+        return Response(encode_json(map_frames(payload, frame_columns)), media_type="application/json")
+
+    if pa is None:
+        raise HTTPException(status_code=406, detail="Arrow responses need pyarrow installed")
+    frames = find_frames(payload)
+    if len(frames) != 1:
+        raise HTTPException(status_code=406, detail="Arrow responses hold one table, use format=columnar")
+
+    # The other fields travel as JSON in the schema metadata
+    (path, frame), = frames
+    meta = map_frames(payload, lambda frame: None)
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.replace_schema_metadata({
+        "marketpulse.table": json.dumps(list(path)),
+        "marketpulse.meta": json.dumps(meta, default=str),
+    })
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(sink.getvalue(), media_type=ARROW_MEDIA_TYPE)
@@ -0,0 +1,315 @@
+import copy
+import math
+import numpy as np
+import pandas as pd
+from collections import OrderedDict, deque
+
+
+### Mean / variance updated one value at a time (Welford), values can also be taken out again
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value: float):
+        if self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        delta = value - self.mean
+        self.mean -= delta / (self.count - 1)
+        self.m2 -= delta * (value - self.mean)
+        self.count -= 1
+
+    # Sample standard deviation like pandas .std(), nan below 2 values
+    @property
+    def std(self) -> float:
+        if self.count < 2:
+            return math.nan
+        return math.sqrt(max(self.m2, 0.0) / (self.count - 1))
+
+    def zscore(self, value: float) -> float:
+        std = self.std
+        if math.isnan(std) or std == 0:
+            return math.nan
+        return (value - self.mean) / std
+
+
+### Last `size` values with their running mean / std, like pandas .rolling(size)
+class RollingWindow:
+    def __init__(self, size: int):
+        self.size = size
+        self.values = deque()
+        self.stats = RunningStats()
+
+    # Add a value, returns the one that fell out of the window (None while filling up)
+    def push(self, value: float):
+        self.values.append(value)
+        self.stats.add(value)
+        if len(self.values) > self.size:
+            evicted = self.values.popleft()
+            self.stats.remove(evicted)
+            return evicted
+        return None
+
+    @property
+    def full(self) -> bool:
+        return len(self.values) >= self.size
+
+    # Mean of the full window, nan while filling up like .rolling(size).mean()
+    @property
+    def mean(self) -> float:
+        return self.stats.mean if self.full else math.nan
+
+    def __getitem__(self, index: int) -> float:
+        return self.values[index]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+### Daily sentiment post-processing that takes one new day at a time
+class SentimentProcessor:
+    '''
+        Incremental version of util.process_sentiment_data: days without a post between start_date and
+        the latest post are added as empty rows, filled by linear interpolation (gaps up to `threshold`
+        days) or carried forward (larger gaps), smoothed by a rolling average and flagged as spikes
+        against mean +/- std of the smoothed series.
+
+        Appending a day only touches the rows it completes (an interpolated gap, the days before the
+        first post), the rolling average and the spike statistics are kept as running state.
+        Days must come in time order.
+    '''
+    def __init__(self, start_date, threshold: int = 5, rolling_avg: int = 7,
+                 pos_std_multiplier: float = 1, neg_std_multiplier: float = 1):
+        self.threshold = threshold
+        self.rolling_avg = rolling_avg
+        self.pos_std_multiplier = pos_std_multiplier
+        self.neg_std_multiplier = neg_std_multiplier
+
+        # Next calendar day that still needs a row
+        self.next_day = pd.Timestamp(start_date)
+
+        self.timestamps = []
+        self.sentiments = []
+        self.details = []
+        self.filled = []
+        self.smoothed = []
+
+        # Gap tracking: last row with a sentiment among the small gap rows and the empty ones after it
+        self.small_rows = 0
+        self.last_small = None
+        self.pending = []
+        # Empty rows before any value, they take the next value (backward fill)
+        self.leading = []
+        # Last row whose value is (or will be) known, large gaps copy it (forward fill)
+        self.last_known = None
+        # Rows waiting for another row's value: row -> [rows]
+        self.dependents = {}
+
+        # Rows [0, final_rows) won't change anymore, their rolling average and statistics are in
+        self.final_rows = 0
+        self.window = RollingWindow(rolling_avg)
+        self.stats = RunningStats()
+
+    def append(self, timestamp, sentiment: float, article_url: str = "", title: str = "", top_comment: str = ""):
+        timestamp = pd.Timestamp(timestamp)
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            raise ValueError(f"{timestamp} is older than the last day {self.timestamps[-1]}")
+
+        # Empty rows for the days without a post
+        while self.next_day < timestamp:
+            self._add_row(self.next_day, math.nan, None)
+            self.next_day += pd.Timedelta(days=1)
+        if self.next_day == timestamp:
+            self.next_day += pd.Timedelta(days=1)
+
+        self._add_row(timestamp, sentiment, (article_url, title, top_comment))
+        self._finalize()
+
+    def extend(self, data: pd.DataFrame):
+        # Daily top posts already come sorted, only unsorted frames are copied
+        timestamps = pd.to_datetime(data["timestamp"])
+        if not timestamps.is_monotonic_increasing:
+            data = data.iloc[np.argsort(timestamps.to_numpy(), kind="stable")]
+        for row in data.itertuples(index=False):
+            self.append(row.timestamp, row.sentiment, row.article_url, row.title, row.top_comment)
+
+    # Independent copy, e.g. to add days that can still change without touching this processor
+    def copy(self) -> "SentimentProcessor":
+        other = copy.copy(self)
+        for name in ("timestamps", "sentiments", "details", "filled", "smoothed", "pending", "leading"):
+            setattr(other, name, getattr(self, name).copy())
+        other.dependents = {row: rows.copy() for row, rows in self.dependents.items()}
+        other.window = copy.deepcopy(self.window)
+        other.stats = copy.copy(self.stats)
+        return other
+
+    def _add_row(self, timestamp: pd.Timestamp, sentiment: float, details):
+        row = len(self.timestamps)
+        large_gap = row > 0 and (timestamp - self.timestamps[-1]).days > self.threshold
+
+        self.timestamps.append(timestamp)
+        self.sentiments.append(sentiment)
+        self.details.append(details)
+        self.filled.append(None)
+
+        if not math.isnan(sentiment):
+            self._resolve(row, sentiment)
+            self._follow(row)
+
+            if not large_gap:
+                # Linear interpolation over the small gap rows in between
+                if self.last_small is not None:
+                    start_position, start_row = self.last_small
+                    start_value = self.filled[start_row]
+                    for position, waiting in self.pending:
+                        weight = (position - start_position) / (self.small_rows - start_position)
+                        self._resolve(waiting, start_value + (sentiment - start_value) * weight)
+                self.pending = []
+                self.last_small = (self.small_rows, row)
+                self.small_rows += 1
+            self.last_known = row
+
+        elif not large_gap:
+            if self.last_small is None:
+                self.leading.append(row)
+            else:
+                self.pending.append((self.small_rows, row))
+                self.last_known = row
+            self.small_rows += 1
+
+        # Large gap without a post: carry the last known value forward
+        elif self.last_known is None:
+            self.leading.append(row)
+        else:
+            if self.filled[self.last_known] is not None:
+                self._resolve(row, self.filled[self.last_known])
+            else:
+                self.dependents.setdefault(self.last_known, []).append(row)
+            self._follow(row)
+
+    # Empty rows before `row` take its value (backward fill), now or once it is known
+    def _follow(self, row: int):
+        for waiting in self.leading:
+            if self.filled[row] is not None:
+                self._resolve(waiting, self.filled[row])
+            else:
+                self.dependents.setdefault(row, []).append(waiting)
+        self.leading = []
+
+    def _resolve(self, row: int, value: float):
+        self.filled[row] = value
+        for waiting in self.dependents.pop(row, []):
+            self._resolve(waiting, value)
+
+    # Roll the rows that are complete into the running state
+    def _finalize(self):
+        while self.final_rows < len(self.filled) and self.filled[self.final_rows] is not None:
+            self.window.push(self.filled[self.final_rows])
+            # Like .rolling(window, min_periods=1)
+            self.smoothed.append(self.window.stats.mean)
+            self.stats.add(self.smoothed[-1])
+            self.final_rows += 1
+
+    # Rolling average of the rows still open, as if no more days came:
+    # an open gap keeps the last value, rows before any value stay empty
+    def _open_rows(self) -> list:
+        values = {}
+
+        def spread(row: int, value: float):
+            for waiting in self.dependents.get(row, []):
+                values[waiting] = value
+                spread(waiting, value)
+
+        if self.last_small is not None:
+            for _, row in self.pending:
+                values[row] = self.filled[self.last_small[1]]
+                spread(row, values[row])
+
+        filled = list(self.window.values)[-(self.rolling_avg - 1):] if self.rolling_avg > 1 else []
+        smoothed = []
+        for row in range(self.final_rows, len(self.filled)):
+            value = self.filled[row] if self.filled[row] is not None else values.get(row, math.nan)
+            filled.append(value)
+            window = [v for v in filled[-self.rolling_avg:] if not math.isnan(v)]
+            smoothed.append(sum(window) / len(window) if window else math.nan)
+        return smoothed
+
+    def thresholds(self, smoothed_open: list = None) -> tuple:
+        smoothed_open = self._open_rows() if smoothed_open is None else smoothed_open
+        stats = copy.deepcopy(self.stats)
+        for value in smoothed_open:
+            if not math.isnan(value):
+                stats.add(value)
+        return (stats.mean + stats.std * self.pos_std_multiplier,
+                stats.mean - stats.std * self.neg_std_multiplier)
+
+    # Same columns as process_sentiment_data, plus the two spike thresholds
+    # missing: "" -> value of days without a rolling average, None keeps them NaN in a float column
+    def frame(self, missing="") -> tuple:
+        smoothed_open = self._open_rows()
+        positive_threshold, negative_threshold = self.thresholds(smoothed_open)
+
+        smoothed = np.array(self.smoothed + smoothed_open, dtype=float)
+        posted = ~np.isnan(np.array(self.sentiments, dtype=float))
+        details = [d if d is not None else ("", "", "") for d in self.details]
+
+        frame = pd.DataFrame({
+            "timestamp": pd.DatetimeIndex(self.timestamps).strftime('%Y-%m-%d'),
+            # Empty rolling averages become "" like the other missing values
+            "sentiment": pd.Series(smoothed).astype(object).where(~np.isnan(smoothed), missing)
+                         if missing is not None and np.isnan(smoothed).any() else smoothed,
+            "article_url": [d[0] for d in details],
+            "title": [d[1] for d in details],
+            "top_comment": [d[2] for d in details],
+            "positive_spike": (smoothed > positive_threshold) & posted,
+            "negative_spike": (smoothed < negative_threshold) & posted,
+        })
+        return positive_threshold, negative_threshold, frame
+
+
+### SentimentProcessors kept between refreshes of the same series, e.g. (ticker, company, time_filter)
+class SentimentProcessors:
+    '''
+        Every refresh gets the whole series, its processor only appends the closed days (before `today`)
+        it hasn't seen yet. Open days can still get other posts, they are added to a copy for that refresh.
+
+        A series whose start moved or whose closed days changed (e.g. posts found later for a past day)
+        is processed again from its first day. The least recently used series are dropped past max_entries.
+    '''
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        # key -> (start_date and parameters, processor, hash of every closed row it has)
+        self.entries = OrderedDict()
+
+    def process(self, key, start_date, data: pd.DataFrame, today, **params) -> SentimentProcessor:
+        timestamps = pd.to_datetime(data["timestamp"])
+        if not timestamps.is_monotonic_increasing:
+            order = np.argsort(timestamps.to_numpy(), kind="stable")
+            data, timestamps = data.iloc[order], timestamps.iloc[order]
+        closed = int(np.searchsorted(timestamps.to_numpy(), np.datetime64(pd.Timestamp(today)), side="left"))
+        hashes = pd.util.hash_pandas_object(
+            data.iloc[:closed][["timestamp", "sentiment", "article_url", "title", "top_comment"]], index=False).to_numpy()
+
+        settings = (pd.Timestamp(start_date), tuple(sorted(params.items())))
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[0] == settings and np.array_equal(entry[2], hashes[:len(entry[2])]):
+            processor, seen = entry[1], len(entry[2])
+        else:
+            processor, seen = SentimentProcessor(start_date, **params), 0
+
+        processor.extend(data.iloc[seen:closed])
+        self.entries[key] = (settings, processor, hashes)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        current = processor.copy()
+        current.extend(data.iloc[closed:])
+        return current
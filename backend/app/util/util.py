@@ -1,109 +1,181 @@
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta
+from decouple import config
 from services.yahoo import fetch_vix, fetch_yield_spread, \
-    fetch_safe_haven_demand, fetch_market_momentum
+    fetch_safe_haven_demand, fetch_market_momentum, fetch_multiple_stock_data, score_indicator, \
+    FEAR_GREED_TICKERS, FEAR_GREED_LOOKBACK_DAYS
+from services.market_store import market_store
+from util.correlation import lagged_rolling_correlations
+from util.market_calendar import market_today
+from util.metrics import timed
+from util.streaming import SentimentProcessor, SentimentProcessors
+
+# Sentiment series refreshed by the analyses, kept per (ticker, company, time_filter)
+sentiment_processors = SentimentProcessors(max_entries=config("SENTIMENT_PROCESSOR_CACHE_SIZE", default=256, cast=int))
 
 
 ### Calculate rolling correlations between fear / greed score and stock price
+@timed("rolling_correlations")
 async def calculate_rolling_correlations(stock_data:pd.DataFrame, fear_greed_score: pd.DataFrame, window_size: int = 7) -> pd.DataFrame:
 
-    stock_data.set_index('timestamp', inplace=True)
-    fear_greed_score.set_index('timestamp', inplace=True)
-
-    data = pd.concat([stock_data, fear_greed_score], axis=1)
+    # set_index returns new frames, the caller's frames keep their timestamp column
+    data = pd.concat([stock_data.set_index('timestamp'), fear_greed_score.set_index('timestamp')], axis=1)
 
     data = data.dropna()
 
-    data["correlation"] = data["price"].rolling(window=window_size).corr(data["fear_greed_score"])
+    # Windows still warming up get 0, the other columns have no gaps left after dropna
+    correlations = lagged_rolling_correlations(data["price"].to_numpy(), data["fear_greed_score"].to_numpy(), [window_size])
+    data["correlation"] = np.nan_to_num(correlations[0, 0, :, 0, 0])
 
     data.reset_index(inplace=True)
-    data = data.fillna(0)
 
     return data
 
 
-### Calculate fear / greed score from market indicator
-async def calculate_fear_greed_score(start_date: str, end_date: str, interval: str) -> pd.DataFrame:
-    # Fetch the market sentiment indicators
+### Rolling correlations of many tickers against the fear / greed score at once
+@timed("rolling_correlations_many")
+async def calculate_rolling_correlations_many(prices: pd.DataFrame, fear_greed_score: pd.DataFrame, window_size: int = 7) -> dict:
+    '''
+        prices: timestamp index x one price column per ticker
+        Returns ticker -> the same frame calculate_rolling_correlations gives for that ticker alone
+    '''
+    score = fear_greed_score.set_index("timestamp")["fear_greed_score"]
+    data = prices.join(score, how="outer").sort_index()
+    data = data[data["fear_greed_score"].notna()]
+    prices = data.drop(columns="fear_greed_score")
+
+    # Tickers trading on the same days share one rolling pass over a price matrix,
+    # the others (e.g. listed later) get their own rows so their windows match the single ticker version
+    groups = {}
+    for ticker, valid in prices.notna().items():
+        groups.setdefault(valid.values.tobytes(), []).append(ticker)
+
+    results = {}
+    for tickers in groups.values():
+        rows = prices[tickers[0]].notna()
+        group = prices.loc[rows, tickers]
+        scores = data.loc[rows, "fear_greed_score"].values
+        correlations = np.nan_to_num(lagged_rolling_correlations(group.to_numpy(), scores, [window_size])[0, 0, :, :, 0])
+
+        for i, ticker in enumerate(tickers):
+            results[ticker] = pd.DataFrame({
+                "timestamp": group.index,
+                "price": group[ticker].values,
+                "fear_greed_score": scores,
+                "correlation": correlations[:, i],
+            })
+
+    return results
+
+
+### Average the indicator scores, only timestamps every indicator has get a combined score
+def combine_fear_greed_scores(indicators: list) -> pd.DataFrame:
+    scores = pd.concat([data.set_index("timestamp")["fear_greed_score"] for data in indicators],
+                       axis=1, join="inner").sort_index()
+
+    return scores.mean(axis=1).rename("fear_greed_score").rename_axis("timestamp").reset_index()
+
+
+INDICATOR_NAMES = ["vix", "market_momentum", "safe_haven", "yield_spread", "fear_greed_score"]
+# Indicators with a signal of their own, the combined score is computed from their scores
+SIGNAL_NAMES = INDICATOR_NAMES[:-1]
+
+
+### Signal of every market indicator in one window from already downloaded prices, see score_market_indicators
+@timed("market_indicators")
+async def compute_market_indicators(start_date: datetime, end_date: datetime, interval: str, prices: dict) -> dict:
     vix = await fetch_vix(start_date=start_date, 
-                    end_date=end_date, interval=interval)
+                    end_date=end_date, interval=interval, prices=prices)
     mm = await fetch_market_momentum(start_date=start_date, 
-                    end_date=end_date, interval=interval)
+                    end_date=end_date, interval=interval, prices=prices)
     sh = await fetch_safe_haven_demand(start_date=start_date, 
-                    end_date=end_date, interval=interval)
+                    end_date=end_date, interval=interval, prices=prices)
     ys = await fetch_yield_spread(start_date=start_date, 
-                    end_date=end_date, interval=interval)
+                    end_date=end_date, interval=interval, prices=prices)
+
+    return {"vix": vix, "market_momentum": mm, "safe_haven": sh, "yield_spread": ys}
+
+
+# Scores of the window the signals were read or computed for, and the combined fear / greed score
+def score_market_indicators(signals: dict) -> dict:
+    indicators = {name: score_indicator(name, signals[name]) for name in SIGNAL_NAMES}
+    indicators["fear_greed_score"] = combine_fear_greed_scores([indicators[name] for name in SIGNAL_NAMES])
+    return indicators
+
+
+### Calculate the market indicators of several (start_date, end_date, interval) windows
+async def calculate_market_indicators_many(windows: list) -> list:
+    # Signals don't depend on the window, a window whose bars are all stored is scored from a range read.
+    # Windows end before their end date, one ending at today's midnight only has closed bars
+    today = market_today()
+    results = {}
+    for start_date, end_date, interval in windows:
+        if end_date <= today:
+            stored = await market_store.read_indicators(SIGNAL_NAMES, interval, f"{start_date:%Y-%m-%d}",
+                                                        f"{end_date:%Y-%m-%d}")
+            if stored is not None:
+                results[(start_date, end_date, interval)] = score_market_indicators(stored)
+    missing = [window for window in windows if window not in results]
+
+    # One download per interval covering every window, each window then gets its own slices
+    prices = {}
+    for interval in {window[2] for window in missing}:
+        starts = [start for start, _, i in missing if i == interval]
+        ends = [end for _, end, i in missing if i == interval]
+        cutoff_date = min(starts) - timedelta(days=FEAR_GREED_LOOKBACK_DAYS)
+        prices[interval] = await fetch_multiple_stock_data(FEAR_GREED_TICKERS, start_date=cutoff_date.strftime('%Y-%m-%d'),
+                                                           end_date=max(ends).strftime('%Y-%m-%d'), interval=interval)
+
+    for start_date, end_date, interval in missing:
+        # Trim the shared download to the window so every indicator sees exactly its own range
+        window_prices = {ticker: data[pd.to_datetime(data["Date"]) < end_date]
+                         for ticker, data in prices[interval].items()}
+        signals = await compute_market_indicators(start_date, end_date, interval, window_prices)
+        results[(start_date, end_date, interval)] = score_market_indicators(signals)
+        # Bars from today on are still forming, the closed ones the series doesn't have yet are stored
+        await market_store.write_indicators(signals, interval, f"{start_date:%Y-%m-%d}", f"{min(end_date, today):%Y-%m-%d}")
+
+    return [results[window] for window in windows]
+
+
+### Calculate every market indicator and the combined fear / greed score
+async def calculate_market_indicators(start_date: datetime, end_date: datetime, interval: str) -> dict:
+    results = await calculate_market_indicators_many([(start_date, end_date, interval)])
+    return results[0]
 
-    data = pd.concat([vix[['timestamp', 'fear_greed_score']], 
-                     mm[['timestamp', 'fear_greed_score']], 
-                     sh[['timestamp', 'fear_greed_score']], 
-                     ys[['timestamp', 'fear_greed_score']]])
-    
-    data = (
-        data.groupby('timestamp', as_index=False)
-        .filter(lambda x: len(x) == 4)
-        .groupby('timestamp', as_index=False)['fear_greed_score']
-        .mean()
-        )
-    
-    return data
 
 ### Fill missing data, moving average, and detect spikes
+@timed("process_sentiment")
 async def process_sentiment_data(start_date: datetime, data: pd.DataFrame, threshold: int = 5, 
-                           rolling_avg: int = 7, pos_std_multiplier: int = 1, neg_std_multiplier: int = 1):
+                           rolling_avg: int = 7, pos_std_multiplier: int = 1, neg_std_multiplier: int = 1,
+                           missing="", key=None):
     '''
         threshold: 5 -> interpolation within 5 trading days else backward / forward fill
         rolling_avg: 7 -> smoother trend of sentiment
         pos_std_multiplier: 1.5 -> the larger the greater the extreme sentiment threshold
         neg_std_multiplier: 2 -> the larger the greater the extreme sentiment threshold
+        missing: "" -> sentiment of days before any rolling average, None -> NaN (numeric column)
+        key: ("AAPL", "apple", "year") -> the series' processor is kept, the next call with the same key
+            only appends the days closed since (see util.streaming.SentimentProcessors)
     '''
-    data["timestamp"] = pd.to_datetime(data["timestamp"])
-    date_range = pd.date_range(start=start_date, end=data['timestamp'].max())
-    
-    # Reindex to add all dates
-    merged = pd.DataFrame({'timestamp': date_range})
-    merged = data.merge(merged, on='timestamp', how='outer')
-    # Calculate the gaps of missing data
-    merged['sentiment_filled'] = merged['sentiment'].copy()
-    gap_sizes = merged['timestamp'].diff().dt.days
-    large_gaps = gap_sizes > threshold
-    small_gaps = ~large_gaps
-
-    # Interpolation for small gaps of missing data
-    merged.loc[small_gaps, "sentiment_filled"] = merged.loc[small_gaps, "sentiment_filled"].interpolate(method="linear")
-
-    # Backward / Forward fill for larger gaps of missing data
-    merged.loc[large_gaps, "sentiment_filled"] = merged["sentiment_filled"].ffill().bfill()
-    merged["sentiment_filled"] = merged["sentiment_filled"].bfill()
-
-    # Rolling average for smoother trends of sentiment
-    merged["is_filled"] = merged['sentiment'].isna()
-    merged["rolling_avg"] = merged["sentiment_filled"].rolling(window=rolling_avg, min_periods=1).mean()
-
-    # Threshold for extreme spikes
-    positive_spike_threshold = merged["rolling_avg"].mean() + merged["rolling_avg"].std() * pos_std_multiplier
-    negative_spike_threshold = merged["rolling_avg"].mean() - merged["rolling_avg"].std() * neg_std_multiplier
-
-    # Detect extreme
-    merged["positive_spike"] = (merged["rolling_avg"] > positive_spike_threshold) & (~merged['is_filled'])
-    merged["negative_spike"] = (merged["rolling_avg"] < negative_spike_threshold) & (~merged['is_filled'])
-
-    # Fill nan values with empty string
-    merged = merged.fillna("")
-
-    # Select columns
-    merged["sentiment"] = merged["rolling_avg"]
-    merged["timestamp"] = merged["timestamp"].dt.strftime('%Y-%m-%d')
-    merged = merged[['timestamp', 'sentiment', 'article_url', 'title', 'top_comment', 'positive_spike', 'negative_spike',]]
+    params = dict(threshold=threshold, rolling_avg=rolling_avg,
+                  pos_std_multiplier=pos_std_multiplier, neg_std_multiplier=neg_std_multiplier)
+    if key is None:
+        processor = SentimentProcessor(start_date, **params)
+        # Rows are read one by one, the frame isn't copied to convert its timestamps first
+        processor.extend(data)
+    else:
+        processor = sentiment_processors.process(key, start_date, data, today=market_today(), **params)
 
-    return positive_spike_threshold, negative_spike_threshold, merged
+    return processor.frame(missing=missing)
 
 
 ### Convert time filter to start and end dates
 async def convert_time_filter(time_filter: str):
     start_date = None
-    end_date = datetime.combine(datetime.now().date(), time.min)
+    # Windows end at the market's today, the day the price store and the market table use
+    end_date = market_today()
     interval = "1d"
 
     if time_filter == "year":
@@ -115,7 +187,11 @@ async def convert_time_filter(time_filter: str):
     elif time_filter == "week":
         start_date = end_date - timedelta(days=7)
     elif time_filter == "day":
-        #  TODO: add for live streaming
+        # Last weekday's session plus today's bars so far, live updates come from /stream
+        start_date = end_date - timedelta(days=1)
+        while start_date.weekday() >= 5:
+            start_date -= timedelta(days=1)
+        end_date = end_date + timedelta(days=1)
         interval = "1h"
 
     return  start_date, end_date, interval